@@ -1,13 +1,18 @@
+import time
+
+# Taken before all other imports, see --profile-startup
+timestampImportStart = time.perf_counter()
+
 import argparse
 import asyncio
 import logging
 import math
+import sys
 import traceback
-from copy import deepcopy
-from typing import Tuple
+from typing import Tuple, Callable, Set, Dict
+from urllib.parse import urlparse
 
-from couchdb import Database
-from furl import furl, urllib
+from couchdb import Database, ResourceConflict
 from telegram import Update, InlineKeyboardButton, InputMediaPhoto, Message
 from telegram._utils.defaultvalue import DEFAULT_NONE
 from telegram._utils.types import ReplyMarkup, ODVInput
@@ -21,27 +26,30 @@ from BaseUtils import *
 from BotUtils import loadConfig, ImageCache
 
 from Helper import *
-from Crawler import BKCrawler, UserStats
+from Crawler import BKCrawler, UserStats, CacheUpdate
 
 from UtilsCouponsDB import Coupon, User, ChannelCoupon, InfoEntry, getCouponsSeparatedByType, CouponFilter, UserFavoritesInfo, \
-    USER_SETTINGS_ON_OFF, CouponViews, sortCouponsAsList, MAX_HOURS_ACTIVITY_TRACKING, getCouponViewByIndex
+    USER_SETTINGS_ON_OFF, CouponViews, sortCouponsAsList, MAX_HOURS_ACTIVITY_TRACKING, getCouponViewByIndex, CouponSortMode, getNextSortMode, \
+    deletePaybackCardImage
 from CouponCategory import CouponCategory
 from Helper import BotAllowedCouponTypes, CouponType, TEXT_NOTIFICATION_DISABLE
 from UtilsOffers import offerGetImagePath
+from UtilsCallbackData import CallbackPattern, CallbackActions, decodeCallbackData, getDisplayCouponsCallbackData, CouponCallback
+from CouponListCache import CouponListCache, CouponListPage
+from BotWebhook import WebhookServer, UpdateDispatcher, waitForStopSignal
+from BotPersistence import CouchDBConversationPersistence, DocumentWriteBuffer
+from JobScheduler import JobScheduler, Job
+from BotCluster import ClusterEvents, ClusterEventClient, ClusterWorkerServer, getWorkerSocketPath, getEventsSocketPath, runClusterFront
 
 
 class CouponCallbackVars:
-    ALL_COUPONS = f"?a=dcs&m={CouponViews.ALL.getViewCode()}&cs="
-    ALL_COUPONS_WITHOUT_MENU = f"?a=dcs&m={CouponViews.ALL_WITHOUT_MENU.getViewCode()}&cs="
-    ALL_COUPONS_WITH_MENU = f"?a=dcs&m={CouponViews.ALL_WITH_MENU.getViewCode()}&cs="
-    MEAT_WITHOUT_PLANT_BASED = f"?a=dcs&m={CouponViews.MEAT_WITHOUT_PLANT_BASED.getViewCode()}&cs="
-    VEGGIE = f"?a=dcs&m={CouponViews.VEGGIE.getViewCode()}&cs="
+    ALL_COUPONS = getDisplayCouponsCallbackData(CouponViews.ALL.getViewCode())
+    ALL_COUPONS_WITHOUT_MENU = getDisplayCouponsCallbackData(CouponViews.ALL_WITHOUT_MENU.getViewCode())
+    ALL_COUPONS_WITH_MENU = getDisplayCouponsCallbackData(CouponViews.ALL_WITH_MENU.getViewCode())
+    MEAT_WITHOUT_PLANT_BASED = getDisplayCouponsCallbackData(CouponViews.MEAT_WITHOUT_PLANT_BASED.getViewCode())
+    VEGGIE = getDisplayCouponsCallbackData(CouponViews.VEGGIE.getViewCode())
     # MEAT_WITHOUT_PLANT_BASED = f"?a=dcs&m={CouponDisplayMode.MEAT_WITHOUT_PLANT_BASED}&cs="
-    FAVORITES = f"?a=dcs&m={CouponViews.FAVORITES.getViewCode()}&cs="
-
-
-class CallbackPattern:
-    DISPLAY_COUPONS = '.*a=dcs.*'
+    FAVORITES = getDisplayCouponsCallbackData(CouponViews.FAVORITES.getViewCode())
 
 
 def generateCallbackRegEx(settings: dict):
@@ -59,6 +67,10 @@ def generateCallbackRegEx(settings: dict):
 
 
 MAX_CACHE_AGE_SECONDS = 7 * 24 * 60 * 60
+# Max time to wait for queued updates and for running background jobs on shutdown
+SHUTDOWN_TIMEOUT_SECONDS = 30
+# ID of the document in info DB which contains the image caches stored on last shutdown
+IMAGE_CACHES_DOC_ID = 'image_caches'
 
 
 async def cleanupCache(cacheDict: dict):
@@ -91,12 +103,23 @@ class BKBot:
     my_parser.add_argument('-c', '--crawl', help='Crawler beim Start des Bots einmalig ausführen.', type=bool, default=False)
     my_parser.add_argument('-mm', '--maintenancemode', help='Wartungsmodus - zeigt im Bot und Channel eine entsprechende Meldung. Deaktiviert alle Bot Funktionen.', type=bool,
                            default=False)
+    my_parser.add_argument('-ps', '--profilestartup', help='Dauer von Imports, DB Initialisierung usw. beim Start loggen.', type=bool, default=False)
+    my_parser.add_argument('-cw', '--clusterworker', help='Intern: Als Worker-Prozess mit diesem Index im Multi-Prozess-Modus laufen, siehe config "cluster_workers".',
+                           type=int, default=None)
     args = my_parser.parse_args()
 
     def __init__(self):
+        # Name of startup step -> Duration in seconds, see --profile-startup
+        self.startupDurations = {'Imports': time.perf_counter() - timestampImportStart}
+        timestampStart = time.perf_counter()
         self.couponImageCache: dict = {}
         self.couponImageQRCache: dict = {}
         self.offerImageCache: dict = {}
+        # Payback card number -> Telegram file_id of its barcode image
+        self.paybackCardImageCache: dict = {}
+        self.couponListCache = CouponListCache()
+        # Current step of the crawler if it is running, see crawl()
+        self.crawlProgress = None
         self.maintenanceMode = self.args.maintenancemode
         self.cfg = loadConfig()
         if self.cfg is None:
@@ -111,11 +134,27 @@ class BKBot:
         self.couchdb = self.crawler.couchdb
         self.userdb = self.crawler.getUserDB()
         self.coupondb = self.crawler.getCouponDB()
-        self.application = Application.builder().token(self.cfg.bot_token).read_timeout(30).write_timeout(30).build()
+        self.application = Application.builder().token(self.cfg.bot_token).read_timeout(30).write_timeout(30).persistence(
+            CouchDBConversationPersistence(self.crawler.getConversationsDB())).post_stop(self.onPollingStopped).build()
         self.initHandlers()
         self.application.add_error_handler(self.botErrorCallback)
         self.statsCached: Union[UserStats, None] = None
         self.statsCachedTimestamp: float = -1
+        # Only used in multi process mode, see BotCluster
+        self.clusterEvents: Union[ClusterEventClient, None] = None
+        # Only set in the bot process which runs the background jobs, see createJobScheduler
+        self.scheduler: Union[JobScheduler, None] = None
+        # IDs of users with pending notifications, see enqueuePendingNotifications. None = Unknown -> All users need to be checked.
+        self.pendingNotificationUserIDs: Union[Set[str], None] = None
+        # Users are written in bulk while sending notifications, see sendPendingNotifications
+        self.userWriteBuffer = DocumentWriteBuffer(self.userdb, maxDocs=10)
+        # Set on shutdown: Long running tasks stop at the next point from which they can be continued without re-sending anything
+        self.isShuttingDown = False
+        timestampLoadImageCaches = time.perf_counter()
+        self.loadImageCaches()
+        self.startupDurations['Load image caches'] = time.perf_counter() - timestampLoadImageCaches
+        self.startupDurations.update(self.crawler.startupDurations)
+        self.startupDurations['Bot init total'] = time.perf_counter() - timestampStart
 
     def initHandlers(self):
         """ Adds all handlers to dispatcher (not error_handlers!!) """
@@ -155,7 +194,7 @@ class BKBot:
                     # Back to last coupons menu
                     CallbackQueryHandler(self.botDisplayCouponsFromBotMenu, pattern=CallbackPattern.DISPLAY_COUPONS),
                     # Display single coupon
-                    CallbackQueryHandler(self.botDisplaySingleCoupon, pattern='.*a=dc.*'),
+                    CallbackQueryHandler(self.botDisplaySingleCoupon, pattern=CallbackPattern.DISPLAY_COUPON),
                     # Back to main menu
                     CallbackQueryHandler(self.botDisplayMenuMain, pattern='^' + CallbackVars.MENU_MAIN + '$'),
                     CallbackQueryHandler(self.botDisplayEasterEgg, pattern='^' + CallbackVars.EASTER_EGG + '$'),
@@ -190,6 +229,7 @@ class BKBot:
             },
             fallbacks=[CommandHandler('start', self.botDisplayMenuMain)],
             name="MainConversationHandler",
+            persistent=True,
             allow_reentry=True
         )
         """ Handles deletion of user accounts. """
@@ -207,6 +247,7 @@ class BKBot:
             },
             fallbacks=[CommandHandler('start', self.botDisplayMenuMain)],
             name="DeleteUserConvHandler",
+            persistent=True,
             allow_reentry=True
         )
         """ Handles 'favorite buttons' below single coupon images. """
@@ -220,6 +261,7 @@ class BKBot:
             },
             fallbacks=[CommandHandler('start', self.botDisplayMenuMain)],
             name="CouponToggleFavoriteWithImageHandler",
+            persistent=True,
         )
         conv_handler4 = ConversationHandler(
             entry_points=[CallbackQueryHandler(self.botAdminSendMsgToAllUsersSTART, pattern='^' + CallbackVars.ADMIN_SEND_MSG_TO_ALL_USERS + '$')],
@@ -232,6 +274,7 @@ class BKBot:
             },
             fallbacks=[CommandHandler('start', self.botDisplayMenuMain)],
             name="AdminNewsletterSender",
+            persistent=True,
         )
         app = self.application
         app.add_handler(conv_handler)
@@ -321,18 +364,18 @@ class BKBot:
             elif couponSrc == CouponType.PAYBACK and not user.settings.displayCouponCategoryPayback:
                 # Do not display this category if disabled by user
                 continue
-            allButtons.append([InlineKeyboardButton(CouponCategory(couponSrc).namePlural, callback_data=f"?a=dcs&m={CouponViews.CATEGORY.getViewCode()}&cs={couponSrc}")])
+            allButtons.append([InlineKeyboardButton(CouponCategory(couponSrc).namePlural, callback_data=getDisplayCouponsCallbackData(CouponViews.CATEGORY.getViewCode(), couponSrc))])
             if couponCategory.numberofCouponsWithFriesAndDrink < couponCategory.numberofCouponsTotal and couponCategory.isEatable():
                 allButtons.append([InlineKeyboardButton(CouponCategory(couponSrc).namePlural + ' ohne Menü',
-                                                        callback_data=f"?a=dcs&m={CouponViews.CATEGORY_WITHOUT_MENU.getViewCode()}&cs={couponSrc}")])
+                                                        callback_data=getDisplayCouponsCallbackData(CouponViews.CATEGORY_WITHOUT_MENU.getViewCode(), couponSrc))])
             if couponSrc == CouponType.APP and couponCategory.numberofCouponsHidden > 0 and user.settings.displayCouponCategoryAppCouponsHidden:
                 allButtons.append([InlineKeyboardButton(CouponCategory(couponSrc).namePlural + ' versteckte',
-                                                        callback_data=f"?a=dcs&m={CouponViews.HIDDEN_APP_COUPONS_ONLY.getViewCode()}&cs={couponSrc}")])
+                                                        callback_data=getDisplayCouponsCallbackData(CouponViews.HIDDEN_APP_COUPONS_ONLY.getViewCode(), couponSrc))])
         # if user.settings.displayCouponCategoryAllExceptPlantBased:
         #     allButtons.append([InlineKeyboardButton(f'{SYMBOLS.MEAT}Coupons ohne PlantBased{SYMBOLS.MEAT}', callback_data=CouponCallbackVars.MEAT_WITHOUT_PLANT_BASED)])
         if user.settings.displayCouponCategoryVeggie:
             allButtons.append([InlineKeyboardButton(f'{SYMBOLS.BROCCOLI}Veggie Coupons{SYMBOLS.BROCCOLI}', callback_data=CouponCallbackVars.VEGGIE)])
-        keyboardCouponsFavorites = [InlineKeyboardButton(SYMBOLS.STAR + 'Favoriten' + SYMBOLS.STAR, callback_data=f"?a=dcs&m={CouponViews.FAVORITES.getViewCode()}"),
+        keyboardCouponsFavorites = [InlineKeyboardButton(SYMBOLS.STAR + 'Favoriten' + SYMBOLS.STAR, callback_data=CouponCallbackVars.FAVORITES),
                                     InlineKeyboardButton(SYMBOLS.STAR + 'Favoriten + Pics' + SYMBOLS.STAR, callback_data=CallbackVars.MENU_COUPONS_FAVORITES_WITH_IMAGES)]
         allButtons.append(keyboardCouponsFavorites)
         if user.settings.displayCouponCategoryPayback:
@@ -460,6 +503,10 @@ class BKBot:
         text += f'\nAnzahl gültige Coupons: {len(couponDB)}'
         text += f'\nAnzahl bald verfügbarer Coupons: {len(self.crawler.cachedFutureCoupons)}'
         text += f'\nAnzahl gültige Angebote: {len(self.crawler.getOffersActive())}'
+        if self.crawlProgress is not None:
+            text += f'\nCrawler läuft: {self.crawlProgress}'
+        if self.scheduler is not None:
+            text += '\n<b>Jobs:</b>\n' + self.scheduler.getStatusText()
         text += f'\nStatistiken generiert am: {formatDateGermanHuman(self.statsCachedTimestamp)}'
         text += '\n---'
         text += '\nDein BetterKing Account:'
@@ -478,135 +525,70 @@ class BKBot:
 
     async def displayCoupons(self, update: Update, context: CallbackContext, callbackVar: str):
         """ Displays all coupons in a pre selected mode """
-        # Important! This is required so that we can e.g. jump from "Category 'App coupons' page 2 display single coupon" back into "Category 'App coupons' page 2"
-        callbackVar += "&cb=" + urllib.parse.quote(callbackVar)
-        """ 2023-04-02:
-         Log output to find cause of:
-             view = getCouponViewByIndex(index=int(urlinfo["m"]))
-            ValueError: invalid literal for int() with base 10: 'v'
-         """
         logging.debug(f'{callbackVar=}')
-        urlquery = furl(callbackVar)
-        urlinfo = urlquery.args
-        view = getCouponViewByIndex(index=int(urlinfo["m"]))
-        action = urlinfo.get('a')
+        callback = decodeCallbackData(callbackVar)
+        view = getCouponViewByIndex(index=callback.viewCode)
         try:
             saveUserToDB = False
             userDB = self.userdb
             user = await self.getUser(userID=update.effective_user.id)
             if user.updateActivityTimestamp():
                 saveUserToDB = True
+            couponFilter = view.getFilter()
+            # Everything the list of coupons depends on apart from the sort mode
+            filterKey = (view.getViewCode(),)
+            highlightFavorites = view.highlightFavorites
             if view.allowModifyFilter:
                 # Inherit some filters from user settings
-                view = deepcopy(view)
-                couponFilter = view.getFilter()
-                couponTypeStr = urlinfo['cs']
-                if couponTypeStr is not None and len(couponTypeStr) > 0:
-                    couponFilter.allowedCouponTypes = [int(couponTypeStr)]
                 # First we only want to filter coupons. Sort them later according to user preference -> Needs less CPU cycles.
-                if couponFilter.isHidden is None and user.settings.displayHiddenUpsellingAppCouponsWithinGenericCategories is False:
-                    # User does not want to see hidden coupons within generic categories
-                    couponFilter.isHidden = False
-                if couponFilter.isPlantBased is None and user.settings.displayPlantBasedCouponsWithinGenericCategories is False:
-                    # User does not want to see plant based coupons within generic categories
-                    couponFilter.isPlantBased = False
-                if view.highlightFavorites is None:
+                hideHidden = user.settings.displayHiddenUpsellingAppCouponsWithinGenericCategories is False
+                hidePlantBased = user.settings.displayPlantBasedCouponsWithinGenericCategories is False
+                couponFilter = view.getDerivedFilter(couponType=callback.couponType, hideHidden=hideHidden, hidePlantBased=hidePlantBased)
+                filterKey = (view.getViewCode(), callback.couponType, hideHidden, hidePlantBased)
+                if highlightFavorites is None:
                     # User setting overrides unser param in view
-                    view.highlightFavorites = user.settings.highlightFavoriteCouponsInButtonTexts
-            if view == CouponViews.FAVORITES:
-                userFavorites, menuText = self.getUserFavoritesAndUserSpecificMenuText(user=user, sortCoupons=False)
-                coupons = userFavorites.couponsAvailable
-                couponCategory = CouponCategory(coupons)
-            else:
-                coupons = self.getFilteredCouponsAsList(view.getFilter(), sortIfSortCodeIsGivenInCouponFilter=False)
-                couponCategory = CouponCategory(coupons, title=view.title)
-                menuText = couponCategory.getCategoryInfoText()
-            if len(coupons) == 0:
-                # This should never happen
-                raise BetterBotException(SYMBOLS.DENY + ' <b>Ausnahmefehler: Es gibt derzeit keine Coupons!</b>',
-                                         InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=urlquery.url)]]))
-            if action == 'dcss':
+                    highlightFavorites = user.settings.highlightFavoriteCouponsInButtonTexts
+            # Evaluate validity, "new" state and sorting of all coupons of this menu against the same point in time
+            now = getCurrentTimestamp()
+            if callback.action == CallbackActions.DISPLAY_COUPONS_CHANGE_SORT:
                 # Change sort of coupons
                 saveUserToDB = True
-                nextSortMode = user.getNextSortModeForCouponView(couponView=view)
-                # Sort coupons
-                coupons = sortCouponsAsList(coupons, nextSortMode)
-                user.setCustomSortModeForCouponView(couponView=view, sortMode=nextSortMode)
-            else:
-                # Sort coupons
-                coupons = sortCouponsAsList(coupons, user.getSortModeForCouponView(couponView=view))
-            # Answer query
-            query = update.callback_query
-            if query is not None:
-                await query.answer()
-            # Build bot menu
-            urlquery_callbackBack = furl(urlquery.args["cb"])
-            buttons = []
-            maxCouponsPerPage = 20
-            paginationMax = math.ceil(len(coupons) / maxCouponsPerPage)
-            desiredPage = int(urlquery.args.get("p", 1))
-            if desiredPage > paginationMax:
-                # Fallback - can happen if user leaves menu open for a long time, DB changes, user presses "next/previous page" button but max page number has changed in the meanwhile.
-                currentPage = paginationMax
+                sortMode = user.getNextSortModeForCouponView(couponView=view)
+                user.setCustomSortModeForCouponView(couponView=view, sortMode=sortMode)
             else:
-                currentPage = desiredPage
-            # Grab all items in desired range (= on desired page)
-            index = (currentPage * maxCouponsPerPage - maxCouponsPerPage)
-            # Whenever the user has at least one favorite coupon on page > 1 we'll replace the dummy button in the middle and add Easter Egg functionality :)
-            currentPageContainsAtLeastOneFavoriteCoupon = False
+                sortMode = user.getSortModeForCouponView(couponView=view)
             includeVeggieSymbol = user.settings.highlightVeggieCouponsInCouponButtonTexts
             if view.includeVeggieSymbol is not None:
                 # Override user setting
                 includeVeggieSymbol = view.includeVeggieSymbol
-            while len(buttons) < maxCouponsPerPage and index < len(coupons):
-                coupon = coupons[index]
-                buttonText = coupon.generateCouponShortText(highlightIfNew=user.settings.highlightNewCouponsInCouponButtonTexts, includeVeggieSymbol=includeVeggieSymbol)
-                if user.isFavoriteCoupon(coupon):
-                    currentPageContainsAtLeastOneFavoriteCoupon = True
-                    if view.highlightFavorites:
-                        # Highlight item in list so user can see favourites easier
-                        buttonText = SYMBOLS.STAR + buttonText
-                buttons.append([InlineKeyboardButton(buttonText, callback_data="?a=dc&plu=" + coupon.id + "&cb=" + urllib.parse.quote(urlquery_callbackBack.url))])
-                index += 1
-            numberofCouponsOnCurrentPage = len(buttons)
-            if paginationMax > 1:
-                # Add pagination navigation buttons if needed
-                menuText += "\nSeite " + str(currentPage) + "/" + str(paginationMax)
-                navigationButtons = []
-                urlquery_callbackBack.args['a'] = 'dcs'
-                if currentPage > 1:
-                    # Add button to go to previous page
-                    previousPage = currentPage - 1
-                    urlquery_callbackBack.args['p'] = previousPage
-                    navigationButtons.append(InlineKeyboardButton(SYMBOLS.ARROW_LEFT, callback_data=urlquery_callbackBack.url))
-                else:
-                    # Add dummy button for a consistent button layout
-                    navigationButtons.append(InlineKeyboardButton(SYMBOLS.GHOST, callback_data="DummyButtonPrevPage"))
-                navigationButtons.append(InlineKeyboardButton("Seite " + str(currentPage) + "/" + str(paginationMax), callback_data="DummyButtonMiddle"))
-                if currentPage < paginationMax:
-                    # Add button to go to next page
-                    nextPage = currentPage + 1
-                    urlquery_callbackBack.args['p'] = nextPage
-                    navigationButtons.append(InlineKeyboardButton(SYMBOLS.ARROW_RIGHT, callback_data=urlquery_callbackBack.url))
-                else:
-                    # Add dummy button for a consistent button layout
-                    # Easter egg: Trigger it if there are at least two pages available AND user is currently on the last page AND that page contains at least one user-favorited coupon.
-                    if currentPageContainsAtLeastOneFavoriteCoupon and currentPage > 1:
-                        navigationButtons.append(InlineKeyboardButton(SYMBOLS.GHOST, callback_data=CallbackVars.EASTER_EGG))
-                    else:
-                        navigationButtons.append(InlineKeyboardButton(SYMBOLS.GHOST, callback_data="DummyButtonNextPage"))
-                buttons.append(navigationButtons)
-            # Display sort button if it makes sense
-            possibleSortModes = couponCategory.getSortModes()
-            if user.settings.displayCouponSortButton and len(possibleSortModes) > 1 and numberofCouponsOnCurrentPage > 1:
-                currentSortMode = user.getSortModeForCouponView(couponView=view)
-                nextSortMode = user.getNextSortModeForCouponView(couponView=view)
-                urlquery_callbackBack.args['a'] = 'dcss'
-                urlquery_callbackBack.args['p'] = currentPage
-                buttons.append(
-                    [InlineKeyboardButton(currentSortMode.text + ' | 🔃 | ' + nextSortMode.text, callback_data=urlquery_callbackBack.url)])
-
-            buttons.append([InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.MENU_MAIN)])
+            highlightNew = user.settings.highlightNewCouponsInCouponButtonTexts
+            if view == CouponViews.FAVORITES:
+                # User specific list -> Nothing to cache here
+                userFavorites, menuText = self.getUserFavoritesAndUserSpecificMenuText(user=user, sortCoupons=False, now=now)
+                coupons = sortCouponsAsList(userFavorites.couponsAvailable, sortMode, now=now)
+                page = self.renderCouponListPage(callback, menuText, coupons, CouponCategory(coupons, now=now), sortMode, highlightNew, includeVeggieSymbol, now)
+            else:
+                couponsVersion = self.crawler.couponsVersion
+                resultKey = filterKey + (sortMode.getSortCode(),)
+                # callback_data of the buttons contain the couponType so it is always part of the key
+                pageKey = resultKey + (callback.couponType, callback.page, highlightNew, includeVeggieSymbol)
+                page = self.couponListCache.get(couponsVersion, pageKey, now)
+                if page is None:
+                    result = self.couponListCache.get(couponsVersion, resultKey, now)
+                    if result is None:
+                        coupons = self.getFilteredCouponsAsList(couponFilter, sortIfSortCodeIsGivenInCouponFilter=False, now=now)
+                        couponCategory = CouponCategory(coupons, title=view.title, now=now)
+                        result = (sortCouponsAsList(coupons, sortMode, now=now), couponCategory)
+                        self.couponListCache.put(couponsVersion, resultKey, now, result)
+                    coupons, couponCategory = result
+                    page = self.renderCouponListPage(callback, couponCategory.getCategoryInfoText(), coupons, couponCategory, sortMode, highlightNew, includeVeggieSymbol, now)
+                    self.couponListCache.put(couponsVersion, pageKey, now, page)
+            # Answer query
+            query = update.callback_query
+            if query is not None:
+                await query.answer()
+            buttons = page.getButtonRows(favoriteCouponIDs=user.favoriteCoupons, highlightFavorites=highlightFavorites, displaySortButton=user.settings.displayCouponSortButton)
+            menuText = page.menuText
             reply_markup = InlineKeyboardMarkup(buttons)
             await self.editOrSendMessage(update, text=menuText, reply_markup=reply_markup, parse_mode='HTML')
             if saveUserToDB:
@@ -615,13 +597,66 @@ class BKBot:
         except BetterBotException as botError:
             await self.handleBotErrorGently(update, context, botError)
 
-    def getUserFavoritesAndUserSpecificMenuText(self, user: User, coupons: Union[dict, None] = None, sortCoupons: bool = False) -> Tuple[UserFavoritesInfo, str]:
+    def renderCouponListPage(self, callback: CouponCallback, menuText: str, coupons: list, couponCategory: CouponCategory, sortMode: CouponSortMode, highlightNew: bool,
+                             includeVeggieSymbol: bool, now: float) -> CouponListPage:
+        """ Builds page of given sorted coupons as requested by callback. Result does not contain any user specific information so it can be cached. """
+        if len(coupons) == 0:
+            # This should never happen
+            raise BetterBotException(SYMBOLS.DENY + ' <b>Ausnahmefehler: Es gibt derzeit keine Coupons!</b>',
+                                     InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=callback.getCouponListCallback().encode())]]))
+        maxCouponsPerPage = 20
+        paginationMax = math.ceil(len(coupons) / maxCouponsPerPage)
+        desiredPage = callback.page
+        if desiredPage > paginationMax:
+            # Fallback - can happen if user leaves menu open for a long time, DB changes, user presses "next/previous page" button but max page number has changed in the meanwhile.
+            currentPage = paginationMax
+        else:
+            currentPage = desiredPage
+        # Grab all items in desired range (= on desired page)
+        couponsOnCurrentPage = coupons[currentPage * maxCouponsPerPage - maxCouponsPerPage:currentPage * maxCouponsPerPage]
+        # All coupons lead back to the current page
+        callbackCurrentPage = callback.getCouponListCallback(page=currentPage)
+        couponButtons = []
+        for coupon in couponsOnCurrentPage:
+            buttonText = coupon.generateCouponShortText(highlightIfNew=highlightNew, includeVeggieSymbol=includeVeggieSymbol, now=now)
+            couponButtons.append(InlineKeyboardButton(buttonText, callback_data=callbackCurrentPage.getCouponCallback(coupon.id).encode()))
+        navigationButtons = None
+        if paginationMax > 1:
+            # Add pagination navigation buttons if needed
+            menuText += "\nSeite " + str(currentPage) + "/" + str(paginationMax)
+            navigationButtons = []
+            if currentPage > 1:
+                # Add button to go to previous page
+                previousPage = currentPage - 1
+                navigationButtons.append(InlineKeyboardButton(SYMBOLS.ARROW_LEFT, callback_data=callback.getCouponListCallback(page=previousPage).encode()))
+            else:
+                # Add dummy button for a consistent button layout
+                navigationButtons.append(InlineKeyboardButton(SYMBOLS.GHOST, callback_data="DummyButtonPrevPage"))
+            navigationButtons.append(InlineKeyboardButton("Seite " + str(currentPage) + "/" + str(paginationMax), callback_data="DummyButtonMiddle"))
+            if currentPage < paginationMax:
+                # Add button to go to next page
+                nextPage = currentPage + 1
+                navigationButtons.append(InlineKeyboardButton(SYMBOLS.ARROW_RIGHT, callback_data=callback.getCouponListCallback(page=nextPage).encode()))
+            else:
+                # Add dummy button for a consistent button layout. Can be replaced by easter egg button, see CouponListPage.getButtonRows
+                navigationButtons.append(InlineKeyboardButton(SYMBOLS.GHOST, callback_data="DummyButtonNextPage"))
+        # Display sort button if it makes sense
+        sortButton = None
+        if len(couponCategory.getSortModes()) > 1 and len(couponsOnCurrentPage) > 1:
+            nextSortMode = getNextSortMode(sortMode)
+            callbackChangeSort = callback.getCouponListCallback(action=CallbackActions.DISPLAY_COUPONS_CHANGE_SORT, page=currentPage)
+            sortButton = InlineKeyboardButton(sortMode.text + ' | 🔃 | ' + nextSortMode.text, callback_data=callbackChangeSort.encode())
+        return CouponListPage(menuText=menuText, couponIDs=[coupon.id for coupon in couponsOnCurrentPage], couponButtons=couponButtons, navigationButtons=navigationButtons,
+                              isLastPageOfMultiplePages=paginationMax > 1 and currentPage == paginationMax, sortButton=sortButton)
+
+    def getUserFavoritesAndUserSpecificMenuText(self, user: User, coupons: Union[dict, None] = None, sortCoupons: bool = False, now: Union[float, None] = None) -> Tuple[UserFavoritesInfo, str]:
         if len(user.favoriteCoupons) == 0:
             raise BetterBotException('<b>Du hast noch keine Favoriten!</b>', InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.MENU_MAIN)]]))
         if coupons is None:
             # Perform DB request only if not already done before
-            coupons = self.crawler.getFilteredCouponsAsDict(couponfilter=CouponViews.FAVORITES.getFilter())
-        userFavoritesInfo = user.getUserFavoritesInfo(couponsFromDB=coupons, returnSortedCoupons=sortCoupons)
+            coupons = self.crawler.getFilteredCouponsAsDict(couponfilter=CouponViews.FAVORITES.getFilter(), now=now)
+        userFavoritesInfo = user.getUserFavoritesInfo(couponsFromDB=coupons, returnSortedCoupons=sortCoupons, now=now,
+                                                      archivedCoupons=self.crawler.getArchivedCoupons(user.favoriteCoupons.keys()), duplicateIndex=self.crawler.cachedDuplicateIndex)
         if len(userFavoritesInfo.couponsAvailable) == 0:
             errorMessage = '<b>' + SYMBOLS.WARNING + 'Derzeit ist keiner deiner ' + str(len(user.favoriteCoupons)) + ' Favoriten verfügbar:</b>'
             errorMessage += '\n' + userFavoritesInfo.getUnavailableFavoritesText()
@@ -634,7 +669,7 @@ class BKBot:
             menuText += str(len(userFavoritesInfo.couponsAvailable)) + ' Favoriten verfügbar' + SYMBOLS.STAR
         else:
             menuText += str(len(userFavoritesInfo.couponsAvailable)) + '/' + str(len(user.favoriteCoupons)) + ' Favoriten verfügbar' + SYMBOLS.STAR
-        couponCategoryDummy = CouponCategory(coupons=userFavoritesInfo.couponsAvailable)
+        couponCategoryDummy = CouponCategory(coupons=userFavoritesInfo.couponsAvailable, now=now)
         menuText += '\n' + couponCategoryDummy.getExpireDateInfoText()
         priceInfo = couponCategoryDummy.getPriceInfoText()
         if priceInfo is not None:
@@ -733,7 +768,7 @@ class BKBot:
         menuText = '<b>Nix dabei?</b>'
         reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.MENU_MAIN),
                                               InlineKeyboardButton(SYMBOLS.ARROW_RIGHT + " Zu den Gutscheinen",
-                                                                   callback_data="?a=dcs&m=" + CouponViews.ALL.getViewCode() + "&cs=")], []])
+                                                                   callback_data=CouponCallbackVars.ALL_COUPONS)], []])
         await self.sendMessage(chat_id=update.effective_chat.id, text=menuText, parse_mode='HTML', reply_markup=reply_markup, disable_web_page_preview=True)
         return CallbackVars.MENU_OFFERS
 
@@ -827,6 +862,7 @@ class BKBot:
                 user.pendingNotifications = joinedlist
                 usersToNotify.append(user)
         self.userdb.update(usersToNotify)
+        await self.enqueuePendingNotifications([user.id for user in usersToNotify])
         await self.editOrSendMessage(update, text=f"{SYMBOLS.CONFIRM}Alle {len(usersToNotify)} User mit aktivierten Benachrichtigungen werden demnächst benachrichtigt.", parse_mode='HTML')
         return ConversationHandler.END
 
@@ -882,7 +918,9 @@ class BKBot:
             keyboard.append([InlineKeyboardButton(SYMBOLS.DENY + 'Payback Karte löschen', callback_data=CallbackVars.MENU_SETTINGS_DELETE_PAYBACK_CARD)])
         if len(user.favoriteCoupons) > 0:
             # Additional DB request required so let's only jump into this handling if the user has at least one favorite coupon.
-            userFavoritesInfo = user.getUserFavoritesInfo(self.crawler.getFilteredCouponsAsDict(CouponViews.FAVORITES.getFilter()), returnSortedCoupons=True)
+            userFavoritesInfo = user.getUserFavoritesInfo(self.crawler.getFilteredCouponsAsDict(CouponViews.FAVORITES.getFilter()), returnSortedCoupons=True,
+                                                          archivedCoupons=self.crawler.getArchivedCoupons(user.favoriteCoupons.keys()),
+                                                          duplicateIndex=self.crawler.cachedDuplicateIndex)
             if len(userFavoritesInfo.couponsUnavailable) > 0:
                 keyboard.append([InlineKeyboardButton(SYMBOLS.DENY + "Abgelaufene Favoriten löschen (" + str(len(userFavoritesInfo.couponsUnavailable)) + ")?*²",
                                                       callback_data=CallbackVars.MENU_SETTINGS_DELETE_UNAVAILABLE_FAVORITE_COUPONS)])
@@ -897,9 +935,9 @@ class BKBot:
     async def botDisplaySingleCoupon(self, update: Update, context: CallbackContext):
         query = update.callback_query
         await query.answer()
-        callbackArgs = furl(query.data).args
-        uniqueCouponID = callbackArgs['plu']
-        callbackBack = callbackArgs['cb']
+        callback = decodeCallbackData(query.data)
+        uniqueCouponID = callback.couponID
+        callbackBack = callback.getCouponListCallback().encode()
         coupon = Coupon.load(self.coupondb, uniqueCouponID)
         user = await self.getUser(update.effective_user.id)
         # Send coupon image in chat
@@ -939,7 +977,10 @@ class BKBot:
         userInput = None if update.message is None else update.message.text
         if userInput is not None and userInput == userIDStr:
             # Delete user from DB
+            paybackCardNumber = User.load(self.userdb, userIDStr).getPaybackCardNumber()
             del self.userdb[userIDStr]
+            if paybackCardNumber is not None:
+                self.deletePaybackCardImageCache(paybackCardNumber)
             menuText = SYMBOLS.CONFIRM + 'Dein BetterKing Account wurde vernichtet!'
             menuText += '\nDu kannst diesen Chat nun löschen.'
             menuText += '\n<b>Viel Erfolg beim Abnehmen!</b>'
@@ -1035,9 +1076,9 @@ class BKBot:
             text += " | " + priceFormatted
         return text
 
-    def getFilteredCouponsAsList(self, couponFilter: CouponFilter, sortIfSortCodeIsGivenInCouponFilter: bool = True) -> list:
+    def getFilteredCouponsAsList(self, couponFilter: CouponFilter, sortIfSortCodeIsGivenInCouponFilter: bool = True, now: Union[float, None] = None) -> list:
         """  Wrapper for crawler.filterCouponsList with errorhandling when no coupons are available. """
-        coupons = self.crawler.getFilteredCouponsAsList(couponFilter, sortIfSortCodeIsGivenInCouponFilter=sortIfSortCodeIsGivenInCouponFilter)
+        coupons = self.crawler.getFilteredCouponsAsList(couponFilter, sortIfSortCodeIsGivenInCouponFilter=sortIfSortCodeIsGivenInCouponFilter, now=now)
         self.checkForNoCoupons(coupons)
         return coupons
 
@@ -1192,6 +1233,7 @@ class BKBot:
         elif userInput == paybackCardNumber:
             user.deletePaybackCard()
             user.store(userDB)
+            self.deletePaybackCardImageCache(paybackCardNumber)
             text = SYMBOLS.CONFIRM + 'Payback Karte ' + userInput + ' wurde gelöscht.'
             await self.editOrSendMessage(update, text=text,
                                          parse_mode='HTML',
@@ -1221,10 +1263,26 @@ class BKBot:
             text += '\n<b>Tipp:</b> Pinne diese Nachricht an, um im Bot Chat noch einfacher auf deine Payback Karte zugreifen zu können.'
             replyMarkup = InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.GENERIC_BACK),
                                                  InlineKeyboardButton(SYMBOLS.DENY + 'Karte löschen', callback_data=CallbackVars.MENU_SETTINGS_DELETE_PAYBACK_CARD)]])
-            await self.sendPhoto(chat_id=update.effective_chat.id, photo=user.getPaybackCardImage(), caption=text, parse_mode='html', disable_notification=True,
-                                 reply_markup=replyMarkup)
+            msg = await self.sendPhoto(chat_id=update.effective_chat.id, photo=await self.getPaybackCardImage(user), caption=text, parse_mode='html',
+                                       disable_notification=True, reply_markup=replyMarkup)
+            # Use largest size as barcode needs to be scannable
+            self.paybackCardImageCache.setdefault(user.getPaybackCardNumber(), ImageCache(fileID=msg.photo[-1].file_id))
         return CallbackVars.MENU_DISPLAY_PAYBACK_CARD
 
+    async def getPaybackCardImage(self, user: User):
+        """ Returns either Telegram file_id or image of the barcode of the users' Payback card. """
+        cachedImageData = self.paybackCardImageCache.get(user.getPaybackCardNumber())
+        if cachedImageData is not None:
+            cachedImageData.updateLastUsedDate()
+            return cachedImageData.imageFileID
+        # Rendering can take a moment -> Do not block other updates
+        return await asyncio.get_running_loop().run_in_executor(None, user.getPaybackCardImage)
+
+    def deletePaybackCardImageCache(self, paybackCardNumber: str):
+        """ Forgets cached barcode of given Payback card e.g. after the user has deleted it. """
+        self.paybackCardImageCache.pop(paybackCardNumber, None)
+        deletePaybackCardImage(paybackCardNumber)
+
     async def botConfused(self, update: Update, context: CallbackContext):
         """ Execute this whenever user sends message to bot which the bot cannot process. """
         botChannelName = self.getPublicChannelName()
@@ -1237,8 +1295,19 @@ class BKBot:
     async def botAdminToggleMaintenanceMode(self, update: Update, context: CallbackContext):
         user = await self.getUser(userID=update.effective_user.id)
         self.adminOrException(user)
-        chat_id = update.effective_chat.id
+        self.setMaintenanceMode(not self.maintenanceMode)
+        # Other bot processes need to know about this too
+        await self.publishClusterEvent(ClusterEvents.MAINTENANCE_MODE, {'enabled': self.maintenanceMode})
         if self.maintenanceMode:
+            await self.sendMessage(chat_id=update.effective_chat.id, text=SYMBOLS.CONFIRM + 'Wartungsmodus aktiviert.')
+        else:
+            await self.sendMessage(chat_id=update.effective_chat.id, text=SYMBOLS.CONFIRM + 'Wartungsmodus deaktiviert.')
+        return None
+
+    def setMaintenanceMode(self, enabled: bool):
+        if enabled == self.maintenanceMode:
+            return
+        if not enabled:
             # Maintenance mode is active -> Deactivate it
             # Remove all handlers
             for handlerList in self.application.handlers.values():
@@ -1247,7 +1316,6 @@ class BKBot:
             # RE-init handlers so bot behaves normal again
             self.initHandlers()
             self.maintenanceMode = False
-            await self.sendMessage(chat_id=chat_id, text=SYMBOLS.CONFIRM + 'Wartungsmodus deaktiviert.')
         else:
             # Maintenance mode is not active -> Activate it -> Change callback of all handlers to point to maintenance function
             for handlerList in self.application.handlers.values():
@@ -1267,8 +1335,6 @@ class BKBot:
                             continue
                         thishandler.callback = self.botDisplayMaintenanceMode
             self.maintenanceMode = True
-            await self.sendMessage(chat_id=chat_id, text=SYMBOLS.CONFIRM + 'Wartungsmodus aktiviert.')
-        return None
 
     async def batchProcessAutoDeleteUsersUnavailableFavorites(self):
         """ Deletes expired favorite coupons of all users who enabled auto deletion of those.
@@ -1364,16 +1430,29 @@ class BKBot:
         if len(usersToDelete) > 0:
             logging.info(f'Deleting {len(usersToDelete)} inactive users from DB')
             self.userdb.purge(docs=usersToDelete)
+            for user in usersToDelete:
+                paybackCardNumber = user.getPaybackCardNumber()
+                if paybackCardNumber is not None:
+                    self.deletePaybackCardImageCache(paybackCardNumber)
         # End of function
 
     async def batchProcess(self):
         """ Runs all processes which should only run once per day. """
         logging.info('Running batch process...')
-        self.crawl()
+        await self.crawl()
+        await self.batchProcessAfterCrawl()
+
+    async def batchProcessAfterCrawl(self):
+        """ Runs all daily processes which depend on freshly crawled coupons. """
         # infoDB = self.crawler.getInfoDB()
         # infoDBDoc = InfoEntry.load(infoDB, DATABASES.INFO_DB)
         # lastSuccessfulChannelupdate = infoDBDoc.dateLastSuccessfulChannelUpdate
-        if not await self.renewPublicChannel():
+        if self.scheduler is not None and self.scheduler.isResumingInterruptedRun(Jobs.DAILY_BATCH):
+            # Last run has been interrupted by a restart -> Do not re-send coupons which have already been sent
+            channelUpdateSuccessful = await self.resumePublicChannelUpdate()
+        else:
+            channelUpdateSuccessful = await self.renewPublicChannel()
+        if not channelUpdateSuccessful:
             """ The channel update is especially important so here we got some retries implemented.
              """
             attempts = 0
@@ -1397,14 +1476,101 @@ class BKBot:
         await self.cleanupCaches()
         logging.info('Batch process done.')
 
-    def crawl(self) -> bool:
+    def createJobScheduler(self) -> JobScheduler:
+        """ Creates scheduler for all recurring background work. Only one bot process may run it. """
+        scheduler = JobScheduler(self.crawler.getInfoDB())
+        # 2024-02-13: They're one hour behind serverside so crawling at 01:01 should get us all current coupons assuming they get added at midnight serverside time.
+        # Jitter: Bots running on multiple servers or restarted at the same time don't all hit the BK API/DB at exactly the same time
+        scheduler.addJob(Job(name=Jobs.CRAWL, callback=self.runJobCrawl, dailyAt=(1, 1), catchUp=True, jitterSeconds=5 * 60))
+        scheduler.addJob(Job(name=Jobs.DAILY_BATCH, callback=self.batchProcessAfterCrawl, triggers=[SchedulerEvents.CRAWL_FINISHED]))
+        # Notifications are sent right after they have been created, see enqueuePendingNotifications
+        # The interval only retries users whose notifications could not be sent e.g. because Telegram or DB were not reachable
+        scheduler.addJob(Job(name=Jobs.SEND_NOTIFICATIONS, callback=self.sendPendingNotifications, intervalSeconds=60 * 60, catchUp=False,
+                             jitterSeconds=5 * 60, triggers=[SchedulerEvents.NOTIFICATIONS_PENDING]))
+        # Send notifications which have been collected before the last restart
+        scheduler.trigger(SchedulerEvents.NOTIFICATIONS_PENDING)
+        self.scheduler = scheduler
+        return scheduler
+
+    async def runJobCrawl(self):
+        await self.crawl()
+        # Continue even if crawler failed as DB may have been changed partially
+        await self.triggerJobs(SchedulerEvents.CRAWL_FINISHED)
+
+    async def triggerJobs(self, eventName: str):
+        """ Runs jobs waiting for given event. In multi process mode, the scheduler is running in another bot process. """
+        if self.scheduler is not None:
+            self.scheduler.trigger(eventName)
+        else:
+            await self.publishClusterEvent(ClusterEvents.SCHEDULER_EVENT, {'event': eventName})
+
+    async def enqueuePendingNotifications(self, userIDs: List[str]):
+        """ Call this after pending notifications have been added to users in DB so they get sent right away. """
+        if len(userIDs) == 0:
+            return
+        if self.scheduler is None:
+            # Multi process mode: Notifications are sent by the bot process which runs the scheduler
+            await self.publishClusterEvent(ClusterEvents.NOTIFICATIONS_PENDING, {'userIDs': userIDs})
+            return
+        if self.pendingNotificationUserIDs is not None:
+            self.pendingNotificationUserIDs.update(userIDs)
+        self.scheduler.trigger(SchedulerEvents.NOTIFICATIONS_PENDING)
+
+    async def onClusterEventNotificationsPending(self, data: dict):
+        if self.scheduler is not None:
+            await self.enqueuePendingNotifications(data['userIDs'])
+
+    async def onClusterEventSchedulerEvent(self, data: dict):
+        if self.scheduler is not None:
+            self.scheduler.trigger(data['event'])
+
+    async def crawl(self) -> bool:
+        """ Runs crawler in a worker thread so the bot keeps serving users meanwhile.
+         Caches get replaced on the event loop once the crawl is done so handlers never see partially updated caches. """
+        if self.crawlProgress is not None:
+            logging.info(f'Crawler is already running: {self.crawlProgress}')
+            return False
+        loop = asyncio.get_running_loop()
+
+        def onCrawlProgress(progress: str):
+            # Gets called from worker thread
+            loop.call_soon_threadsafe(self.setCrawlProgress, progress)
+
+        self.setCrawlProgress('Starting')
         try:
-            self.crawler.crawlAndProcessData()
-            return True
+            success, cacheUpdate = await loop.run_in_executor(None, self.crawlBlocking, onCrawlProgress)
+            if cacheUpdate is not None:
+                self.crawler.applyCacheUpdate(cacheUpdate)
+                if cacheUpdate.couponRecords is not None:
+                    await self.publishClusterEvent(ClusterEvents.COUPONS_CHANGED,
+                                                   {'couponIDs': None if cacheUpdate.changedCouponIDs is None else list(cacheUpdate.changedCouponIDs)})
+            return success
+        finally:
+            self.crawlProgress = None
+
+    def crawlBlocking(self, progressCallback: Callable[[str], None]) -> Tuple[bool, Union[CacheUpdate, None]]:
+        """ Runs crawler and loads data for cache update without touching the caches. Do not call this from the event loop! """
+        try:
+            self.crawler.crawlAndProcessData(updateCaches=False, progressCallback=progressCallback)
+            success = True
         except:
             traceback.print_exc()
             logging.warning("Crawler failed")
-            return False
+            success = False
+        # Update caches even if crawler failed as DB may have been changed partially
+        progressCallback('Loading changed coupons')
+        try:
+            cacheUpdate = self.crawler.prepareCacheUpdate(couponDB=self.crawler.getCouponDB(), offerDB=self.crawler.getOfferDB(),
+                                                          changedCouponIDs=self.crawler.popChangedCouponIDs())
+        except:
+            traceback.print_exc()
+            logging.warning("Failed to load data for cache update")
+            return False, None
+        return success, cacheUpdate
+
+    def setCrawlProgress(self, progress: str):
+        logging.info(f'Crawler progress: {progress}')
+        self.crawlProgress = progress
 
     async def renewPublicChannel(self) -> Union[None, bool]:
         """ Deletes all channel messages and re-sends them / updates channel with current content. """
@@ -1458,16 +1624,157 @@ class BKBot:
             return False
 
     def startBot(self):
-        self.application.run_polling(timeout=300, read_timeout=300, write_timeout=300, connect_timeout=300)
+        # Initialize here already so this is included in startup profile. Polling/webhook will skip the already done initialization.
+        timestampStart = time.perf_counter()
+        asyncio.get_event_loop().run_until_complete(self.application.initialize())
+        self.startupDurations['Application init'] = time.perf_counter() - timestampStart
+        if self.args.profilestartup:
+            self.logStartupProfile()
+        if self.args.clusterworker is not None:
+            try:
+                asyncio.get_event_loop().run_until_complete(self.runClusterWorker(self.args.clusterworker))
+            except KeyboardInterrupt:
+                logging.info('Stopping bot')
+        elif self.cfg.webhook_url is not None:
+            try:
+                asyncio.get_event_loop().run_until_complete(self.runWebhook())
+            except KeyboardInterrupt:
+                logging.info('Stopping bot')
+        else:
+            self.application.run_polling(timeout=300, read_timeout=300, write_timeout=300, connect_timeout=300)
+
+    def logStartupProfile(self):
+        text = 'Startup profile:'
+        for step, duration in self.startupDurations.items():
+            text += f'\n{step}: {duration:0.3f} seconds'
+        text += f'\nTotal until ready: {time.perf_counter() - timestampImportStart:0.3f} seconds'
+        logging.info(text)
+
+    async def runWebhook(self):
+        """ Receives updates via webhook instead of long polling, see BotWebhook. Runs until SIGINT/SIGTERM. """
+        dispatcher = UpdateDispatcher(self.application.process_update, numberofWorkers=self.cfg.webhook_workers)
+        webhookServer = WebhookServer(self.application.bot, dispatcher, path=urlparse(self.cfg.webhook_url).path or '/', secretToken=self.cfg.webhook_secret_token,
+                                      host=self.cfg.webhook_listen_host, port=self.cfg.webhook_listen_port)
+        await self.application.initialize()
+        await self.application.start()
+        await webhookServer.start()
+        try:
+            await self.application.bot.set_webhook(url=self.cfg.webhook_url, secret_token=self.cfg.webhook_secret_token, max_connections=100)
+            await waitForStopSignal()
+        finally:
+            await webhookServer.stop(timeoutSeconds=SHUTDOWN_TIMEOUT_SECONDS)
+            await self.application.stop()
+            await self.shutdown()
+            await self.application.shutdown()
+
+    async def runClusterWorker(self, workerIndex: int):
+        """ Runs this bot as worker process in multi process mode, see BotCluster. Runs until SIGINT/SIGTERM. """
+        dispatcher = UpdateDispatcher(self.application.process_update, numberofWorkers=self.cfg.webhook_workers)
+        workerServer = ClusterWorkerServer(self.application.bot, dispatcher, getWorkerSocketPath(self.cfg.cluster_socket_dir, workerIndex))
+        self.clusterEvents = ClusterEventClient(getEventsSocketPath(self.cfg.cluster_socket_dir))
+        self.clusterEvents.subscribe(ClusterEvents.COUPONS_CHANGED, self.onClusterEventCouponsChanged)
+        self.clusterEvents.subscribe(ClusterEvents.MAINTENANCE_MODE, self.onClusterEventMaintenanceMode)
+        self.clusterEvents.subscribe(ClusterEvents.SCHEDULER_EVENT, self.onClusterEventSchedulerEvent)
+        self.clusterEvents.subscribe(ClusterEvents.NOTIFICATIONS_PENDING, self.onClusterEventNotificationsPending)
+        await self.application.initialize()
+        await self.application.start()
+        await self.clusterEvents.start()
+        await workerServer.start()
+        try:
+            await waitForStopSignal()
+        finally:
+            await workerServer.stop(timeoutSeconds=SHUTDOWN_TIMEOUT_SECONDS)
+            await self.application.stop()
+            await self.shutdown()
+            await self.clusterEvents.stop()
+            await self.application.shutdown()
+
+    async def publishClusterEvent(self, eventName: str, data: dict):
+        """ Tells all other bot processes about changed state. Does nothing if bot is running in a single process. """
+        if self.clusterEvents is not None:
+            await self.clusterEvents.publish(eventName, data)
+
+    async def onClusterEventCouponsChanged(self, data: dict):
+        couponIDs = data['couponIDs']
+        loop = asyncio.get_running_loop()
+        cacheUpdate = await loop.run_in_executor(None, lambda: self.crawler.prepareCacheUpdate(couponDB=self.coupondb, offerDB=self.crawler.getOfferDB(),
+                                                                                               changedCouponIDs=None if couponIDs is None else set(couponIDs)))
+        self.crawler.applyCacheUpdate(cacheUpdate)
+
+    async def onClusterEventMaintenanceMode(self, data: dict):
+        self.setMaintenanceMode(data['enabled'])
 
     def stopBot(self):
         self.application.stop()
 
+    async def onPollingStopped(self, application: Application):
+        """ Gets called by run_polling after no more updates are received and all pending updates have been processed. """
+        await self.shutdown()
+
+    async def shutdown(self):
+        """ Stops background work and stores everything which would otherwise be lost or redone after a restart.
+         Call this after the bot has stopped receiving updates. """
+        logging.info('Shutting down...')
+        self.isShuttingDown = True
+        loop = asyncio.get_running_loop()
+        if self.scheduler is not None:
+            await self.scheduler.stop(timeoutSeconds=SHUTDOWN_TIMEOUT_SECONDS)
+        try:
+            await loop.run_in_executor(None, self.userWriteBuffer.flush)
+        except Exception:
+            logging.exception('Failed to store buffered users')
+        try:
+            await loop.run_in_executor(None, self.storeImageCaches)
+        except Exception:
+            logging.exception('Failed to store image caches')
+        logging.info('Shutdown done')
+
+    def getImageCaches(self) -> Dict[str, dict]:
+        """ Returns all image caches which are worth keeping after a restart.
+         Payback card images are not included as they are cheap to re-upload and contain personal data. """
+        return {'coupon': self.couponImageCache, 'couponQR': self.couponImageQRCache, 'offer': self.offerImageCache}
+
+    def loadImageCaches(self):
+        """ Loads file_ids stored on last shutdown so images do not have to be uploaded again. """
+        doc = self.crawler.getInfoDB().get(IMAGE_CACHES_DOC_ID)
+        if doc is None:
+            return
+        now = datetime.now()
+        numberofLoadedItems = 0
+        for cacheName, cacheDict in self.getImageCaches().items():
+            for cacheID, cacheData in doc.get(cacheName, {}).items():
+                imageCache = ImageCache.fromDict(cacheData)
+                if (now - imageCache.dateLastUsed).total_seconds() <= MAX_CACHE_AGE_SECONDS:
+                    cacheDict.setdefault(cacheID, imageCache)
+                    numberofLoadedItems += 1
+        logging.info(f'Loaded {numberofLoadedItems} image cache items')
+
+    def storeImageCaches(self):
+        infoDB = self.crawler.getInfoDB()
+        for attempt in range(2):
+            # Other bot processes store their caches in the same doc -> Keep their items
+            doc = infoDB.get(IMAGE_CACHES_DOC_ID)
+            if doc is None:
+                doc = {'_id': IMAGE_CACHES_DOC_ID}
+            minTimestampLastUsed = datetime.now().timestamp() - MAX_CACHE_AGE_SECONDS
+            for cacheName, cacheDict in self.getImageCaches().items():
+                storedItems = {cacheID: cacheData for cacheID, cacheData in doc.get(cacheName, {}).items() if cacheData['dateLastUsed'] >= minTimestampLastUsed}
+                for cacheID, cacheData in cacheDict.items():
+                    storedItems[cacheID] = cacheData.toDict()
+                doc[cacheName] = storedItems
+            try:
+                infoDB.save(doc)
+                logging.info('Stored image caches')
+                return
+            except ResourceConflict:
+                logging.info('Image caches have been stored by another bot process meanwhile -> Retrying')
+
     async def cleanupCaches(self):
         logging.info('Cleanup caches...')
         await cleanupCache(self.couponImageCache)
         await cleanupCache(self.couponImageQRCache)
         await cleanupCache(self.offerImageCache)
+        await cleanupCache(self.paybackCardImageCache)
         logging.info('Cleanup caches done.')
 
     async def sendCouponOverviewWithChannelLinks(self, chat_id: Union[int, str], coupons: dict, useLongCouponTitles: bool, channelDB: Database, infoDB: Union[None, Database],
@@ -1700,37 +2007,69 @@ class BKBot:
 
     async def sendPendingNotifications(self) -> None:
         userDB = self.userdb
-        usersWithPendingNotifications = []
-        for userIDStr in userDB:
-            user = User.load(userDB, userIDStr)
-            if len(user.pendingNotifications) > 0:
-                usersWithPendingNotifications.append(user)
-        if len(usersWithPendingNotifications) == 0:
-            logging.debug('User notify: Nothing to do')
-            return
-        timeStart = datetime.now()
-        index = 0
-        dbDocumentUpdates = []
-        for user in usersWithPendingNotifications:
-            isLastItem = index == len(usersWithPendingNotifications) - 1
-            logging.info(f"Notifying user {index + 1}/{len(usersWithPendingNotifications)} | {user.id} | Pending notifications: {len(user.pendingNotifications)}")
-            # Send all pending notifications to user
-            try:
-                for notificationText in user.pendingNotifications:
-                    await self.sendMessageWithUserBlockedHandling(user=user, userDB=userDB, text=notificationText, parse_mode='HTML', disable_web_page_preview=True,
-                                                                  allowUpdateDB=False)
-            except Exception as e:
-                # TODO: Find a better way than try catch all
-                logging.exception(e)
-                pass
-            user.pendingNotifications = []
-            dbDocumentUpdates.append(user)
-            if len(dbDocumentUpdates) == 10 or isLastItem:
-                # Update DB
-                userDB.update(dbDocumentUpdates)
-                dbDocumentUpdates.clear()
-            index += 1
-        logging.info(f"Notify users done | Duration: {(datetime.now() - timeStart)}")
+        userIDsToCheck = self.pendingNotificationUserIDs
+        # IDs enqueued from now on will be handled in the next run
+        self.pendingNotificationUserIDs = set()
+        usersWithPendingNotifications = None
+        # IDs of users whose notifications have been sent and who have been written to DB
+        handledUserIDs = set()
+        try:
+            # Users of a previous run which failed while writing them
+            self.userWriteBuffer.flush()
+            if userIDsToCheck is None:
+                # First run after startup: Check all users
+                rows = userDB.view('_all_docs', include_docs=True)
+            elif len(userIDsToCheck) > 0:
+                # Only load users who got new notifications
+                rows = userDB.view('_all_docs', keys=list(userIDsToCheck), include_docs=True)
+            else:
+                rows = []
+            usersWithPendingNotifications = []
+            for row in rows:
+                if row.doc is None or row.id.startswith('_design/'):
+                    continue
+                user = User.wrap(row.doc)
+                if len(user.pendingNotifications) > 0:
+                    usersWithPendingNotifications.append(user)
+            if len(usersWithPendingNotifications) == 0:
+                logging.debug('User notify: Nothing to do')
+                return
+            timeStart = datetime.now()
+            index = 0
+            for user in usersWithPendingNotifications:
+                if self.isShuttingDown:
+                    # Remaining users will be notified after restart as their notifications are still in DB
+                    logging.info(f'Stopping user notify because of shutdown | Users left: {len(usersWithPendingNotifications) - index}')
+                    break
+                logging.info(f"Notifying user {index + 1}/{len(usersWithPendingNotifications)} | {user.id} | Pending notifications: {len(user.pendingNotifications)}")
+                # Send all pending notifications to user
+                try:
+                    for notificationText in user.pendingNotifications:
+                        await self.sendMessageWithUserBlockedHandling(user=user, userDB=userDB, text=notificationText, parse_mode='HTML', disable_web_page_preview=True,
+                                                                      allowUpdateDB=False)
+                except Exception as e:
+                    # TODO: Find a better way than try catch all
+                    logging.exception(e)
+                    pass
+                user.pendingNotifications = []
+                # Gets flushed on shutdown too so nobody gets the same notifications again after a restart
+                self.userWriteBuffer.add(user)
+                handledUserIDs.add(user.id)
+                index += 1
+            self.userWriteBuffer.flush()
+            logging.info(f"Notify users done | Duration: {(datetime.now() - timeStart)}")
+        finally:
+            if usersWithPendingNotifications is None:
+                # Failed before users were loaded -> Check the same users again next time
+                if userIDsToCheck is None:
+                    self.pendingNotificationUserIDs = None
+                else:
+                    self.pendingNotificationUserIDs.update(userIDsToCheck)
+            else:
+                unhandledUserIDs = [user.id for user in usersWithPendingNotifications if user.id not in handledUserIDs or user.id in self.userWriteBuffer.docs]
+                if len(unhandledUserIDs) > 0:
+                    logging.info(f'User notify: {len(unhandledUserIDs)} users will be retried in the next run')
+                    self.pendingNotificationUserIDs.update(unhandledUserIDs)
 
     async def getUser(self, userID: Union[str, int], addIfNew: bool = True, updateUsageTimestamp: bool = True, unblockUser: bool = True) -> Union[User, None]:
         """ Returns user from given DB. Adds it to DB if wished and it doesn't exist. """
@@ -1757,50 +2096,27 @@ class BKBot:
         return user
 
 
-async def dailyRoutine(bkbot):
-    """ Runs task daily at specific time.
-     Does not catch up run if desired time has already passed on the day this is executed first time.
-     """
-    """ 2024-02-13: They're one hour behind serverside so crawling at 01:01 should get us all current coupons assuming
-     they get added at midnight serverside time.
-    """
-    hour = 1
-    minute = 1
+async def couponTransitionRoutine(bkbot):
+    """ Refreshes cached coupon information whenever coupons become active or expire.
+     Sleeps at most one hour as the next transition may change with every crawl. """
     while True:
-        now = datetime.now()
-        todayAtTargetTime = datetime(now.year, now.month, now.day, hour, minute)
-        timediffToday = todayAtTargetTime - now
-        if timediffToday.total_seconds() >= 0:
-            print(f"Daily batch execution will happen at {hour}:{minute} TODAY in {timediffToday}")
-            waitSeconds = timediffToday.total_seconds()
-        else:
-            # Target time was already today -> Wait for same time next day
-            tomorrowAtTargetTime = todayAtTargetTime + timedelta(days=1)
-            timediffTomorrow = tomorrowAtTargetTime - now
-            print(f"Daily batch execution will happen at {hour}:{minute} TOMORROW in {timediffTomorrow}")
-            waitSeconds = timediffTomorrow.total_seconds()
+        waitSeconds = 3600
+        timestampNextCouponTransition = bkbot.crawler.timestampNextCouponTransition
+        if timestampNextCouponTransition is not None:
+            waitSeconds = min(waitSeconds, max(1, timestampNextCouponTransition - getCurrentTimestamp() + 1))
         await asyncio.sleep(waitSeconds)
-        await bkbot.batchProcess()
-
-
-async def notificationRoutine(bkbot):
-    """ Sends pending notifications to user every X seconds. """
-    while True:
-        await asyncio.sleep(300)
         try:
-            await bkbot.sendPendingNotifications()
+            bkbot.crawler.refreshCachesIfCouponTransitionIsDue()
         except Exception as e:
-            logging.info("Exception happened during sending notifications:")
+            logging.info("Exception happened during coupon cache refresh:")
             logging.info(e)
 
 
-def main():
-    bkbot: BKBot = BKBot()
-    # Check for start-args to be executed immediately
+async def runStartArgTasks(bkbot):
+    """ Runs tasks requested via start args. Crawler runs first as all other tasks need up-to-date caches. """
     if bkbot.args.crawl:
-        bkbot.crawl()
-    loop = asyncio.get_event_loop()
-    # Check for start args for stuff that can be executed in async way
+        await bkbot.crawl()
+    loop = asyncio.get_running_loop()
     if bkbot.args.forcechannelupdatewithresend:
         loop.create_task(bkbot.renewPublicChannel())
         loop.create_task(bkbot.cleanupPublicChannel())
@@ -1816,10 +2132,30 @@ def main():
     elif bkbot.args.migrate:
         bkbot.crawler.migrateDBs()
     if bkbot.args.usernotify:
+        # Collected notifications will be sent by the scheduler
         loop.create_task(bkbot.collectUserNotificationsAndNotifyAdminsAboutProblems())
-        loop.create_task(bkbot.sendPendingNotifications())
-    loop.create_task(dailyRoutine(bkbot))
-    loop.create_task(notificationRoutine(bkbot))
+
+
+def main():
+    if BKBot.args.clusterworker is None:
+        cfg = loadConfig()
+        if cfg.cluster_workers > 0:
+            # Multi process mode: This is the front process which does nothing but forwarding updates to the workers
+            firstWorkerArgs = sys.argv[1:]
+            # Persistent flags only: Used for all other workers and for restarts of crashed workers
+            otherWorkerArgs = ['--maintenancemode', '1'] if BKBot.args.maintenancemode else []
+            try:
+                asyncio.get_event_loop().run_until_complete(runClusterFront(cfg, firstWorkerArgs, otherWorkerArgs))
+            except KeyboardInterrupt:
+                logging.info('Stopping bot')
+            return
+    bkbot: BKBot = BKBot()
+    loop = asyncio.get_event_loop()
+    # In multi process mode only the first worker does the background work e.g. crawling, channel updates and notifications
+    if bkbot.args.clusterworker is None or bkbot.args.clusterworker == 0:
+        loop.create_task(runStartArgTasks(bkbot))
+        loop.create_task(bkbot.createJobScheduler().run())
+    loop.create_task(couponTransitionRoutine(bkbot))
     bkbot.startBot()
 
 
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+from typing import List, Union, Callable, Awaitable, Dict
+from urllib.parse import urlparse
+
+from telegram import Update, Bot
+
+from BotUtils import Config
+from BotWebhook import UpdateDispatcher, WebhookServer, getUpdateShardKey, waitForStopSignal
+
+""" Multi process mode: One front process receives updates via webhook and forwards them to N worker processes each running a complete bot.
+ Updates are distributed by user so the in-memory state of a user (e.g. conversation states) always lives in the same worker.
+ Workers tell each other about changes of shared state (e.g. coupon caches, maintenance mode) via ClusterEventHub.
+ All communication runs over Unix sockets using one JSON object per line. """
+
+CLUSTER_EVENTS_SOCKET_NAME = 'events.sock'
+# Max time to wait for a worker to (re-)start before updates for it get dropped
+CLUSTER_CONNECT_RETRY_SECONDS = 60
+CLUSTER_WORKER_RESTART_DELAY_SECONDS = 5
+# Max. wait time between attempts to reconnect to the event hub
+CLUSTER_EVENTS_RECONNECT_MAX_DELAY_SECONDS = 30
+# Workers get this much time to shut down gracefully before they get killed
+CLUSTER_WORKER_STOP_TIMEOUT_SECONDS = 90
+# Updates are small but allow big lines anyway
+CLUSTER_MAX_LINE_BYTES = 1024 * 1024
+
+
+class ClusterEvents:
+    # Coupons in DB have changed -> Reload them. Data: {'couponIDs': List of changed IDs or None if everything shall be reloaded}
+    COUPONS_CHANGED = 'couponsChanged'
+    # Data: {'enabled': bool}
+    MAINTENANCE_MODE = 'maintenanceMode'
+    # Event for the JobScheduler which only runs in one worker. Data: {'event': Name of event, see SchedulerEvents}
+    SCHEDULER_EVENT = 'schedulerEvent'
+    # Pending notifications have been added to users. Data: {'userIDs': List of user IDs}
+    NOTIFICATIONS_PENDING = 'notificationsPending'
+
+
+def getWorkerSocketPath(socketDir: str, workerIndex: int) -> str:
+    return os.path.join(socketDir, f'worker-{workerIndex}.sock')
+
+
+def getEventsSocketPath(socketDir: str) -> str:
+    return os.path.join(socketDir, CLUSTER_EVENTS_SOCKET_NAME)
+
+
+async def startUnixServer(clientConnectedCallback, path: str) -> asyncio.AbstractServer:
+    """ Starts server on given socket path. Removes socket file left over from previous run. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    return await asyncio.start_unix_server(clientConnectedCallback, path=path, limit=CLUSTER_MAX_LINE_BYTES)
+
+
+def encodeLine(obj: dict) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class ClusterEventHub:
+    """ Runs in the front process: Sends every event published by one worker to all other workers. """
+
+    def __init__(self, socketPath: str):
+        self.socketPath = socketPath
+        self.clients: List[asyncio.StreamWriter] = []
+        self.server: Union[asyncio.AbstractServer, None] = None
+
+    async def start(self):
+        self.server = await startUnixServer(self.handleClient, self.socketPath)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in self.clients:
+            # Handlers of the clients remove them from the list
+            writer.close()
+
+    async def handleClient(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients.append(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                for client in self.clients:
+                    if client is writer:
+                        continue
+                    try:
+                        client.write(line)
+                        await client.drain()
+                    except ConnectionError:
+                        # Client is gone -> Will be removed by its own handler
+                        pass
+        except (ConnectionError, ValueError):
+            logging.warning('Lost connection to cluster event client')
+        finally:
+            if writer in self.clients:
+                self.clients.remove(writer)
+            writer.close()
+
+
+class ClusterEventClient:
+    """ Runs in the worker processes: Publishes events and calls subscribed callbacks for events published by other workers. """
+
+    def __init__(self, socketPath: str):
+        self.socketPath = socketPath
+        self.subscribers: Dict[str, List[Callable[[dict], Awaitable]]] = {}
+        self.writer: Union[asyncio.StreamWriter, None] = None
+        self.readTask: Union[asyncio.Task, None] = None
+
+    def subscribe(self, eventName: str, callback: Callable[[dict], Awaitable]):
+        self.subscribers.setdefault(eventName, []).append(callback)
+
+    async def start(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.socketPath, limit=CLUSTER_MAX_LINE_BYTES)
+        self.readTask = asyncio.create_task(self.readEventsForever(reader))
+
+    async def stop(self):
+        if self.readTask is not None:
+            self.readTask.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def publish(self, eventName: str, data: dict):
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(encodeLine({'event': eventName, 'data': data}))
+            await self.writer.drain()
+        except ConnectionError:
+            logging.warning(f'Failed to publish cluster event {eventName}')
+
+    async def readEventsForever(self, reader: asyncio.StreamReader):
+        """ Reads events and reconnects with increasing delay whenever the connection to the event hub gets lost. """
+        reconnectDelaySeconds = 1
+        while True:
+            if reader is not None:
+                try:
+                    await self.readEvents(reader)
+                except (ConnectionError, ValueError):
+                    # ValueError: Line exceeds CLUSTER_MAX_LINE_BYTES -> Stream can't be read any further
+                    logging.exception('Failed to read from cluster event hub')
+                logging.warning(f'Lost connection to cluster event hub -> Reconnecting in {reconnectDelaySeconds} seconds')
+                self.writer.close()
+                self.writer = None
+                reader = None
+            await asyncio.sleep(reconnectDelaySeconds)
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.socketPath, limit=CLUSTER_MAX_LINE_BYTES)
+                logging.info('Reconnected to cluster event hub')
+                reconnectDelaySeconds = 1
+            except (ConnectionError, FileNotFoundError):
+                reconnectDelaySeconds = min(reconnectDelaySeconds * 2, CLUSTER_EVENTS_RECONNECT_MAX_DELAY_SECONDS)
+                logging.warning(f'Failed to reconnect to cluster event hub -> Retrying in {reconnectDelaySeconds} seconds')
+
+    async def readEvents(self, reader: asyncio.StreamReader):
+        """ Calls subscribers for all events until the connection gets closed. """
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                return
+            try:
+                event = json.loads(line)
+                eventName = event['event']
+                eventData = event['data']
+            except (ValueError, KeyError, TypeError):
+                logging.warning(f'Ignoring invalid cluster event: {line[:200]}')
+                continue
+            for callback in self.subscribers.get(eventName, []):
+                try:
+                    await callback(eventData)
+                except Exception:
+                    logging.exception(f'Failed to handle cluster event {eventName}')
+
+
+class UpdateForwarder:
+    """ Runs in the front process: Sends updates to the worker responsible for the user. """
+
+    def __init__(self, socketDir: str, numberofWorkers: int):
+        self.socketDir = socketDir
+        self.writers: List[Union[asyncio.StreamWriter, None]] = [None] * numberofWorkers
+
+    async def forwardUpdate(self, update: Update):
+        workerIndex = getUpdateShardKey(update) % len(self.writers)
+        data = encodeLine(update.to_dict())
+        timestampGiveUp = asyncio.get_running_loop().time() + CLUSTER_CONNECT_RETRY_SECONDS
+        while True:
+            try:
+                writer = self.writers[workerIndex]
+                if writer is None:
+                    _, writer = await asyncio.open_unix_connection(getWorkerSocketPath(self.socketDir, workerIndex))
+                    self.writers[workerIndex] = writer
+                writer.write(data)
+                # Waits if the worker is busy -> Queue in front process fills up -> Telegram gets told to retry later
+                await writer.drain()
+                return
+            except (ConnectionError, FileNotFoundError):
+                self.writers[workerIndex] = None
+                if asyncio.get_running_loop().time() > timestampGiveUp:
+                    raise
+                # Worker is (re-)starting
+                await asyncio.sleep(1)
+
+    def close(self):
+        for writer in self.writers:
+            if writer is not None:
+                writer.close()
+
+
+class ClusterWorkerServer:
+    """ Runs in the worker processes: Receives updates from the front process. """
+
+    def __init__(self, bot: Bot, dispatcher: UpdateDispatcher, socketPath: str):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.socketPath = socketPath
+        self.server: Union[asyncio.AbstractServer, None] = None
+
+    async def start(self):
+        self.dispatcher.start()
+        self.server = await startUnixServer(self.handleConnection, self.socketPath)
+
+    async def stop(self, timeoutSeconds: Union[float, None] = None):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.dispatcher.stop(timeoutSeconds=timeoutSeconds)
+
+    async def handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                update = Update.de_json(json.loads(line), self.bot)
+                if update is not None:
+                    # Do not read further updates while the queue is full
+                    await self.dispatcher.putUpdate(update)
+        except (ConnectionError, ValueError):
+            logging.warning('Lost connection to cluster front process')
+        finally:
+            writer.close()
+
+
+async def superviseWorker(workerIndex: int, args: List[str], restartArgs: List[str]):
+    """ Runs worker process and restarts it whenever it exits.
+     Restarted workers only get restartArgs so one-shot tasks like crawling or channel updates don't run again on every restart. """
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, sys.argv[0], *args, '--clusterworker', str(workerIndex))
+        logging.info(f'Started cluster worker {workerIndex} | PID {process.pid}')
+        try:
+            returnCode = await process.wait()
+        except asyncio.CancelledError:
+            # Let worker shut down gracefully, see BKBot.shutdown
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), timeout=CLUSTER_WORKER_STOP_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                logging.warning(f'Cluster worker {workerIndex} did not stop within {CLUSTER_WORKER_STOP_TIMEOUT_SECONDS} seconds -> Killing it')
+                process.kill()
+                await process.wait()
+            raise
+        logging.warning(f'Cluster worker {workerIndex} exited with code {returnCode} -> Restarting it in {CLUSTER_WORKER_RESTART_DELAY_SECONDS} seconds')
+        args = restartArgs
+        await asyncio.sleep(CLUSTER_WORKER_RESTART_DELAY_SECONDS)
+
+
+async def runClusterFront(cfg: Config, firstWorkerArgs: List[str], otherWorkerArgs: List[str]):
+    """ Runs front process: Starts workers and forwards all updates received via webhook to them. Runs until SIGINT/SIGTERM.
+     Only the first start of the first worker gets firstWorkerArgs so tasks like crawling or channel updates are not done multiple times. """
+    eventHub = ClusterEventHub(getEventsSocketPath(cfg.cluster_socket_dir))
+    await eventHub.start()
+    workerTasks = [asyncio.create_task(superviseWorker(workerIndex, firstWorkerArgs if workerIndex == 0 else otherWorkerArgs, otherWorkerArgs))
+                   for workerIndex in range(cfg.cluster_workers)]
+    forwarder = UpdateForwarder(cfg.cluster_socket_dir, cfg.cluster_workers)
+    # One queue per worker process so updates of one user are forwarded in order
+    dispatcher = UpdateDispatcher(forwarder.forwardUpdate, numberofWorkers=cfg.cluster_workers)
+    webhookServer = WebhookServer(None, dispatcher, path=urlparse(cfg.webhook_url).path or '/', secretToken=cfg.webhook_secret_token, host=cfg.webhook_listen_host,
+                                  port=cfg.webhook_listen_port)
+    await webhookServer.start()
+    try:
+        async with Bot(cfg.bot_token) as bot:
+            await bot.set_webhook(url=cfg.webhook_url, secret_token=cfg.webhook_secret_token, max_connections=100)
+        await waitForStopSignal()
+    finally:
+        # Forward updates which have already been received before stopping the workers
+        await webhookServer.stop(timeoutSeconds=CLUSTER_WORKER_STOP_TIMEOUT_SECONDS)
+        forwarder.close()
+        for workerTask in workerTasks:
+            workerTask.cancel()
+        await asyncio.gather(*workerTasks, return_exceptions=True)
+        await eventHub.stop()
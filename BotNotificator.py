@@ -6,6 +6,7 @@ from enum import Enum
 from couchdb import Database
 from telegram import InputMediaPhoto
 
+from BotPersistence import DocumentWriteBuffer
 from BotUtils import getBotImpressum, Commands, ImageCache
 from Helper import DATABASES, getCurrentDate, SYMBOLS, getFormattedPassedTime, URLs, BotAllowedCouponTypes, formatSeconds, formatDateGermanHuman, TEXT_NOTIFICATION_DISABLE
 
@@ -60,7 +61,7 @@ async def collectNewCouponsNotifications(bkbot) -> None:
         updateUserDoc = False
         if user.isAllowSendFavoritesNotification():
             # Collect users favorite coupons that are currently new --> Those ones are 'Favorites that are back'
-            userFavoritesInfo = user.getUserFavoritesInfo(newCoupons, returnSortedCoupons=True)
+            userFavoritesInfo = user.getUserFavoritesInfo(newCoupons, returnSortedCoupons=True, duplicateIndex=bkbot.crawler.cachedDuplicateIndex)
             for coupon in userFavoritesInfo.couponsAvailable:
                 userNewFavoriteCoupons[coupon.id] = coupon
             """ Smart-update users favorites: Try to look for new coupons with the same product this was we can update users' favorite
@@ -124,12 +125,14 @@ async def collectNewCouponsNotifications(bkbot) -> None:
         return
     logging.info(f"Pushing DB update of {len(dbUserUpdateList)} user documents")
     userDB.update(list(dbUserUpdateList))
+    await bkbot.enqueuePendingNotifications([user.id for user in dbUserUpdateList if len(user.pendingNotifications) > 0])
     logging.info(f"New coupons notifications collector done | Duration: {(datetime.now() - timeStart)}")
 
 
 async def collectUserDeleteNotifications(bkbot) -> None:
     userDB = bkbot.userdb
     numberOfCollectedNotifications = 0
+    userIDsWithPendingNotifications = []
     for userID in userDB:
         user = User.load(db=userDB, id=userID)
         if not user.hasEverUsedBot():
@@ -162,9 +165,11 @@ async def collectUserDeleteNotifications(bkbot) -> None:
             if text not in user.pendingNotifications:
                 notificationlist = user.pendingNotifications + [text]
                 user.pendingNotifications = notificationlist
+                userIDsWithPendingNotifications.append(user.id)
             user.store(db=userDB)
             numberOfCollectedNotifications += 1
     logging.info('Number of users who will soon be informed about account deletion: ' + str(numberOfCollectedNotifications))
+    await bkbot.enqueuePendingNotifications(userIDsWithPendingNotifications)
 
 
 async def notifyAdminsAboutProblems(bkbot) -> None:
@@ -200,12 +205,27 @@ async def notifyAdminsAboutProblems(bkbot) -> None:
 class ChannelUpdateMode(Enum):
     """ Different modes that can be used to perform a channel update """
     RESEND_ALL = 1
-    # This will only re-send all items older than X hours - can be used to resume channel update if it was e.g. interrupted due to a connection loss
+    # Continues the last channel update exactly where it has stopped e.g. due to a connection loss or a restart.
+    # If the last channel update has been completed, this only sends coupons which are missing in the channel or have changed.
     RESUME_CHANNEL_UPDATE = 2
 
 
+class ChannelUpdateActions:
+    """ Actions a channel update plan consists of, see updatePublicChannel """
+    COUPON_IMAGES = 'couponImages'
+    COUPON_TEXT = 'couponText'
+    COUPON_OVERVIEW = 'couponOverview'
+    INFORMATION_MESSAGE = 'informationMessage'
+
+
+# Posted coupons get written to channel DB in bulk after this many steps and whenever the update stops.
+# Until then, their messageIDs are kept in the plan which gets stored after every step.
+CHANNEL_UPDATE_CHECKPOINT_STEPS = 10
+
+
 async def updatePublicChannel(bkbot, updateMode: ChannelUpdateMode):
     """ Updates public channel if one is defined.
+    Every channel update follows a plan of steps which is stored in InfoEntry together with the number of steps done so it can be resumed without re-sending anything.
     Make sure to run cleanupChannel soon after excecuting this! """
     if bkbot.getPublicChannelName() is None:
         """ While it is not necessary to provide a name of a public channel for the bot to manage, this should not be called if not needed ... """
@@ -221,6 +241,28 @@ async def updatePublicChannel(bkbot, updateMode: ChannelUpdateMode):
     activeCoupons = bkbot.crawler.getFilteredCouponsAsDict(
         CouponFilter(activeOnly=True, allowedCouponTypes=BotAllowedCouponTypes, sortCode=CouponSortModes.TYPE_MENU_PRICE.getSortCode()))
     channelDB = bkbot.couchdb[DATABASES.TELEGRAM_CHANNEL]
+    if updateMode == ChannelUpdateMode.RESUME_CHANNEL_UPDATE and infoDBDoc.hasUnfinishedChannelUpdatePlan():
+        plan = dict(infoDBDoc.channelUpdatePlan)
+        logging.info(f"Resuming channel update planned {formatDateGermanHuman(plan['timestampCreated'])} at step {plan['numberofDoneSteps'] + 1}/{len(plan['steps'])}")
+    else:
+        plan = createChannelUpdatePlan(updateMode, infoDB, infoDBDoc, activeCoupons, channelDB)
+    await runChannelUpdatePlan(bkbot, plan, infoDB, infoDBDoc, activeCoupons, channelDB)
+    logging.info(f"Channel update done | Total time needed: {datetime.now() - dateStart}")
+
+
+def loadChannelCoupons(channelDB: Database) -> dict:
+    """ Returns all coupons posted in channel loaded with one request. """
+    channelCoupons = {}
+    for row in channelDB.view('_all_docs', include_docs=True):
+        if not row.id.startswith('_design/'):
+            channelCoupons[row.id] = ChannelCoupon.wrap(row.doc)
+    return channelCoupons
+
+
+def createChannelUpdatePlan(updateMode: ChannelUpdateMode, infoDB: Database, infoDBDoc: InfoEntry, activeCoupons: dict, channelDB: Database) -> dict:
+    """ Collects what needs to be sent and marks all messages which will be replaced for deletion.
+     Returns plan which gets stored in InfoEntry.channelUpdatePlan. """
+    channelCoupons = loadChannelCoupons(channelDB)
     # All coupons we want to send out this run
     couponsToSendOut = {}
     # All new coupons
@@ -229,117 +271,173 @@ async def updatePublicChannel(bkbot, updateMode: ChannelUpdateMode):
     updatedCoupons = {}
     # Collect new and updated items
     for coupon in activeCoupons.values():
-        if coupon.id not in channelDB:
+        channelCoupon = channelCoupons.get(coupon.id)
+        if channelCoupon is None:
             # New coupon - save information into both dicts
             couponsToSendOut[coupon.id] = coupon
             if coupon.isNewCoupon():
                 newCoupons[coupon.id] = coupon
             numberOfCouponsNewToThisChannel += 1
-        elif ChannelCoupon.load(channelDB, coupon.id).uniqueIdentifier != coupon.getUniqueIdentifier():
+        elif channelCoupon.uniqueIdentifier != coupon.getUniqueIdentifier():
             # Current/new coupon data differs from coupon we've posted in channel (same unique ID but coupon data has changed)
             updatedCoupons[coupon.id] = coupon
+            couponsToSendOut[coupon.id] = coupon
+        elif channelCoupon.channelMessageID_image is None or channelCoupon.channelMessageID_text is None:
+            # Coupon has not been posted completely e.g. because the last channel update failed before plans were introduced
+            couponsToSendOut[coupon.id] = coupon
     if len(infoDBDoc.messageIDsToDelete) > 0:
         # This can happen but should only be a rare occurance!
         logging.warning(f"Found {len(infoDBDoc.messageIDsToDelete)} leftover messageIDs to delete")
     # Collect deleted coupons from channel
     deletedChannelCoupons = []
-    for uniqueCouponID in channelDB:
+    for uniqueCouponID, channelCoupon in channelCoupons.items():
         if uniqueCouponID not in activeCoupons:
-            channelCoupon = ChannelCoupon.load(channelDB, uniqueCouponID)
             infoDBDoc.addMessageIDsToDelete(channelCoupon.getMessageIDs())
             # Collect it here so we can delete it with only one DB request later.
             deletedChannelCoupons.append(channelCoupon)
-    # Update DB if needed
-    if len(deletedChannelCoupons) > 0:
-        channelDB.purge(deletedChannelCoupons)
-        # Save this so we always remember which messageIDs we need to delete later.
-        infoDBDoc.store(infoDB)
-    # Collect coupons to send out in this run.
     if updateMode == ChannelUpdateMode.RESEND_ALL:
         couponsToSendOut = activeCoupons
-    else:
-        # ChannelUpdateMode.RESUME_CHANNEL_UPDATE
-        # Collect all coupons that haven't been sent into the channel at all or were sent into the channel more than X seconds ago (= "old" entries)
-        allFromNowOn = False
-        for coupon in activeCoupons.values():
-            channelCoupon = ChannelCoupon.load(channelDB, coupon.id)
-            if allFromNowOn or channelCoupon is None or channelCoupon.channelMessageID_image_and_qr_date_posted is None or (
-                    datetime.now() - channelCoupon.channelMessageID_image_and_qr_date_posted).total_seconds() > 16 * 60 * 60 or channelCoupon.channelMessageID_text_date_posted is None or (
-                    datetime.now() - channelCoupon.channelMessageID_text_date_posted).total_seconds() > 16 * 60 * 60:
-                # Coupon has not been posted into channel yet or has been posted in there too long ago -> Add to list of coupons to re-send later
-                couponsToSendOut[coupon.id] = coupon
-                # One coupon was missing/incomplete? Re-send all after this one.
-                allFromNowOn = True
-
     if numberOfCouponsNewToThisChannel != len(newCoupons):
         # During normal usage this should never happen
         logging.warning(
             "Developer mistake or DB has been updated without sending channel update in between for at least 2 days: Number of 'new' coupons to send into channel is: " + str(
                 numberOfCouponsNewToThisChannel) + " but should be: " + str(len(newCoupons)))
-    if len(couponsToSendOut) > 0:
-        # Send relevant coupons into chat
-        logging.info(f"Sending out {len(couponsToSendOut)}/{len(activeCoupons)} coupons...")
-        # Collect all old messageIDs which need to be deleted by checking which of the ones we want to send out are already in our channel at this moment
-        channelCouponDBUpdates = []
-        for coupon in couponsToSendOut.values():
-            channelCoupon = ChannelCoupon.load(channelDB, coupon.id)
-            if channelCoupon is not None and len(channelCoupon.getMessageIDs()) > 0:
-                infoDBDoc.addMessageIDsToDelete(channelCoupon.getMessageIDs())
-                channelCoupon.deleteMessageIDs()
-                channelCouponDBUpdates.append(channelCoupon)
-        # Update DB
-        if len(channelCouponDBUpdates) > 0:
-            channelDB.update(channelCouponDBUpdates)
-            infoDBDoc.store(infoDB)
-
-        index = -1
-        for coupon in couponsToSendOut.values():
-            if DEBUGNOTIFICATOR:
-                break
-            index += 1
-            logging.info("Working on coupon " + str(index + 1) + "/" + str(len(couponsToSendOut)) + " | " + coupon.id)
-            couponText = coupon.generateCouponLongTextFormattedWithDescription(highlightIfNew=True)
-            photoAlbum = [InputMediaPhoto(media=bkbot.getCouponImage(coupon), caption=couponText, parse_mode='HTML'),
-                          InputMediaPhoto(media=bkbot.getCouponImageQR(coupon), caption=couponText, parse_mode='HTML')
-                          ]
-            logging.debug("Sending new coupon messages 1/2: Coupon photos")
-            chatMessages = await asyncio.create_task(bkbot.sendMediaGroup(chat_id=bkbot.getPublicChannelChatID(), media=photoAlbum, disable_notification=True))
-
-            msgImage = chatMessages[0]
-            msgImageQR = chatMessages[1]
-            # Update bot cache
-            bkbot.couponImageCache[coupon.id] = ImageCache(fileID=msgImage.photo[0].file_id)
-            bkbot.couponImageQRCache[coupon.id] = ImageCache(fileID=msgImageQR.photo[0].file_id)
-            # Update DB
-            if coupon.id not in channelDB:
-                channelDB[coupon.id] = {}
-            channelCoupon = ChannelCoupon.load(channelDB, coupon.id)
-            channelCoupon.uniqueIdentifier = coupon.getUniqueIdentifier()
-            channelCoupon.channelMessageID_image = msgImage.message_id
-            channelCoupon.channelMessageID_qr = msgImageQR.message_id
-            channelCoupon.channelMessageID_image_and_qr_date_posted = datetime.now()
-            # Update DB
-            channelCoupon.store(channelDB)
-            # Send coupon information as text (= last message for this coupon)
-            logging.debug("Sending new coupon messages 2/2: Coupon text")
-            couponTextMsg = await asyncio.create_task(bkbot.sendMessage(chat_id=bkbot.getPublicChannelChatID(), text=couponText, parse_mode='HTML', disable_notification=True,
-                                                                        disable_web_page_preview=True))
-            channelCoupon.channelMessageID_text = couponTextMsg.message_id
-            channelCoupon.channelMessageID_text_date_posted = datetime.now()
-            # Update DB
-            channelCoupon.store(channelDB)
-
-    await bkbot.sendCouponOverviewWithChannelLinks(chat_id=bkbot.getPublicChannelChatID(), coupons=activeCoupons, useLongCouponTitles=False, channelDB=channelDB, infoDB=infoDB,
-                                                   infoDBDoc=infoDBDoc)
+    # Collect all old messageIDs which need to be deleted by checking which of the ones we want to send out are already in our channel at this moment
+    channelCouponDBUpdates = []
+    for coupon in couponsToSendOut.values():
+        channelCoupon = channelCoupons.get(coupon.id)
+        if channelCoupon is not None and len(channelCoupon.getMessageIDs()) > 0:
+            infoDBDoc.addMessageIDsToDelete(channelCoupon.getMessageIDs())
+            channelCoupon.deleteMessageIDs()
+            channelCouponDBUpdates.append(channelCoupon)
+    steps = []
+    for coupon in couponsToSendOut.values():
+        steps.append([ChannelUpdateActions.COUPON_IMAGES, coupon.id])
+        steps.append([ChannelUpdateActions.COUPON_TEXT, coupon.id])
+    steps.append([ChannelUpdateActions.COUPON_OVERVIEW, None])
+    steps.append([ChannelUpdateActions.INFORMATION_MESSAGE, None])
+    plan = {'timestampCreated': datetime.now().timestamp(), 'updateMode': updateMode.name, 'steps': steps, 'numberofDoneSteps': 0,
+            'newCouponIDs': list(newCoupons.keys()), 'numberofUpdatedCoupons': len(updatedCoupons), 'numberofDeletedCoupons': len(deletedChannelCoupons)}
+    # Store plan and messageIDs to delete first: If anything fails afterwards, we will still know which messages need to be deleted.
+    infoDBDoc.channelUpdatePlan = plan
+    infoDBDoc.store(infoDB)
+    if len(deletedChannelCoupons) > 0:
+        channelDB.purge(deletedChannelCoupons)
+    if len(channelCouponDBUpdates) > 0:
+        channelDB.update(channelCouponDBUpdates)
+    logging.info(f"Planned channel update: Sending out {len(couponsToSendOut)}/{len(activeCoupons)} coupons | Deleted: {len(deletedChannelCoupons)} | Steps: {len(steps)}")
+    return plan
+
+
+def storeChannelUpdateProgress(infoDB: Database, infoDBDoc: InfoEntry, plan: dict, channelCouponBuffer: DocumentWriteBuffer):
+    """ Stores all sent coupons with one request, then the progress of the plan without the now stored coupons. """
+    channelCouponBuffer.flush()
+    plan['unstoredChannelCoupons'] = {}
+    storeChannelUpdatePlan(infoDB, infoDBDoc, plan)
+
+
+def storeChannelUpdatePlan(infoDB: Database, infoDBDoc: InfoEntry, plan: dict):
+    infoDBDoc.channelUpdatePlan = plan
+    infoDBDoc.store(infoDB)
+
+
+def addUnstoredChannelCoupon(plan: dict, channelCoupon: ChannelCoupon, channelCouponBuffer: DocumentWriteBuffer):
+    """ Remembers posted coupon in plan so its messageIDs can't get lost if the process dies before the next bulk write to channel DB. """
+    plan.setdefault('unstoredChannelCoupons', {})[channelCoupon.id] = {key: value for key, value in channelCoupon._data.items() if key not in ('_id', '_rev')}
+    channelCouponBuffer.add(channelCoupon)
 
+
+def restoreUnstoredChannelCoupons(plan: dict, channelCoupons: dict, channelCouponBuffer: DocumentWriteBuffer) -> int:
+    """ Applies posted coupons which have been stored in the plan but not in channel DB e.g. because the last run has been killed.
+     Returns number of restored coupons. """
+    unstoredChannelCoupons = plan.get('unstoredChannelCoupons', {})
+    for couponID, channelCouponData in unstoredChannelCoupons.items():
+        channelCoupon = channelCoupons.setdefault(couponID, ChannelCoupon(id=couponID))
+        for key, value in channelCouponData.items():
+            channelCoupon[key] = value
+        channelCouponBuffer.add(channelCoupon)
+    return len(unstoredChannelCoupons)
+
+
+async def runChannelUpdatePlan(bkbot, plan: dict, infoDB: Database, infoDBDoc: InfoEntry, activeCoupons: dict, channelDB: Database):
+    """ Runs all steps of given plan which have not been done yet. """
+    steps = plan['steps']
+    channelCoupons = loadChannelCoupons(channelDB)
+    channelCouponBuffer = DocumentWriteBuffer(channelDB, maxDocs=CHANNEL_UPDATE_CHECKPOINT_STEPS)
+    numberofRestoredChannelCoupons = restoreUnstoredChannelCoupons(plan, channelCoupons, channelCouponBuffer)
+    if numberofRestoredChannelCoupons > 0:
+        logging.info(f'Restoring {numberofRestoredChannelCoupons} posted coupons which have not been stored in channel DB during last run')
+        storeChannelUpdateProgress(infoDB, infoDBDoc, plan, channelCouponBuffer)
+    try:
+        while plan['numberofDoneSteps'] < len(steps):
+            stepIndex = plan['numberofDoneSteps']
+            action, couponID = steps[stepIndex]
+            if bkbot.isShuttingDown:
+                # Progress gets stored below -> ChannelUpdateMode.RESUME_CHANNEL_UPDATE will continue with this step
+                logging.info(f'Interrupting channel update because of shutdown | Steps left: {len(steps) - stepIndex}')
+                raise asyncio.CancelledError()
+            logging.info(f"Working on step {stepIndex + 1}/{len(steps)} | {action} | {couponID}")
+            if action in (ChannelUpdateActions.COUPON_IMAGES, ChannelUpdateActions.COUPON_TEXT):
+                coupon = activeCoupons.get(couponID)
+                if DEBUGNOTIFICATOR:
+                    logging.info("Debug mode: Not sending coupon")
+                elif coupon is None:
+                    # Coupon has expired since this plan was made
+                    logging.info(f"Skipping step for coupon which is not active anymore: {couponID}")
+                elif action == ChannelUpdateActions.COUPON_IMAGES:
+                    couponText = coupon.generateCouponLongTextFormattedWithDescription(highlightIfNew=True)
+                    photoAlbum = [InputMediaPhoto(media=bkbot.getCouponImage(coupon), caption=couponText, parse_mode='HTML'),
+                                  InputMediaPhoto(media=bkbot.getCouponImageQR(coupon), caption=couponText, parse_mode='HTML')
+                                  ]
+                    chatMessages = await asyncio.create_task(bkbot.sendMediaGroup(chat_id=bkbot.getPublicChannelChatID(), media=photoAlbum, disable_notification=True))
+                    msgImage = chatMessages[0]
+                    msgImageQR = chatMessages[1]
+                    # Update bot cache
+                    bkbot.couponImageCache[coupon.id] = ImageCache(fileID=msgImage.photo[0].file_id)
+                    bkbot.couponImageQRCache[coupon.id] = ImageCache(fileID=msgImageQR.photo[0].file_id)
+                    channelCoupon = channelCoupons.setdefault(coupon.id, ChannelCoupon(id=coupon.id))
+                    channelCoupon.uniqueIdentifier = coupon.getUniqueIdentifier()
+                    channelCoupon.channelMessageID_image = msgImage.message_id
+                    channelCoupon.channelMessageID_qr = msgImageQR.message_id
+                    channelCoupon.channelMessageID_image_and_qr_date_posted = datetime.now()
+                    addUnstoredChannelCoupon(plan, channelCoupon, channelCouponBuffer)
+                else:
+                    # Send coupon information as text (= last message for this coupon)
+                    couponText = coupon.generateCouponLongTextFormattedWithDescription(highlightIfNew=True)
+                    couponTextMsg = await asyncio.create_task(bkbot.sendMessage(chat_id=bkbot.getPublicChannelChatID(), text=couponText, parse_mode='HTML',
+                                                                                disable_notification=True, disable_web_page_preview=True))
+                    channelCoupon = channelCoupons.setdefault(coupon.id, ChannelCoupon(id=coupon.id))
+                    channelCoupon.channelMessageID_text = couponTextMsg.message_id
+                    channelCoupon.channelMessageID_text_date_posted = datetime.now()
+                    addUnstoredChannelCoupon(plan, channelCoupon, channelCouponBuffer)
+            elif action == ChannelUpdateActions.COUPON_OVERVIEW:
+                # Overview links to the coupons -> They need to be in DB
+                storeChannelUpdateProgress(infoDB, infoDBDoc, plan, channelCouponBuffer)
+                await bkbot.sendCouponOverviewWithChannelLinks(chat_id=bkbot.getPublicChannelChatID(), coupons=activeCoupons, useLongCouponTitles=False, channelDB=channelDB,
+                                                               infoDB=infoDB, infoDBDoc=infoDBDoc)
+            elif action == ChannelUpdateActions.INFORMATION_MESSAGE:
+                await sendChannelUpdateInformationMessage(bkbot, plan, infoDBDoc, activeCoupons)
+            plan['numberofDoneSteps'] += 1
+            if plan['numberofDoneSteps'] % CHANNEL_UPDATE_CHECKPOINT_STEPS == 0 or action not in (ChannelUpdateActions.COUPON_IMAGES, ChannelUpdateActions.COUPON_TEXT):
+                storeChannelUpdateProgress(infoDB, infoDBDoc, plan, channelCouponBuffer)
+            else:
+                # Sent messages must never get lost: Store them right away, only channel DB writes are done in bulk
+                storeChannelUpdatePlan(infoDB, infoDBDoc, plan)
+    finally:
+        # Also store progress if anything went wrong so a resume continues exactly here
+        storeChannelUpdateProgress(infoDB, infoDBDoc, plan, channelCouponBuffer)
+
+
+async def sendChannelUpdateInformationMessage(bkbot, plan: dict, infoDBDoc: InfoEntry, activeCoupons: dict):
     notYetAvailableCouponsText = bkbot.crawler.cachedFutureCouponsText
+    newCoupons = {couponID: activeCoupons[couponID] for couponID in plan['newCouponIDs'] if couponID in activeCoupons}
 
     """ Generate new information message text. """
     infoText = '<b>Heutiges Update:</b>'
-    if len(deletedChannelCoupons) > 0:
-        infoText += '\n' + SYMBOLS.DENY + ' ' + str(len(deletedChannelCoupons)) + ' Coupons gelöscht'
-    if len(updatedCoupons) > 0:
-        infoText += '\n' + SYMBOLS.ARROW_UP_RIGHT + ' ' + str(len(updatedCoupons)) + ' Coupons aktualisiert'
+    if plan['numberofDeletedCoupons'] > 0:
+        infoText += '\n' + SYMBOLS.DENY + ' ' + str(plan['numberofDeletedCoupons']) + ' Coupons gelöscht'
+    if plan['numberofUpdatedCoupons'] > 0:
+        infoText += '\n' + SYMBOLS.ARROW_UP_RIGHT + ' ' + str(plan['numberofUpdatedCoupons']) + ' Coupons aktualisiert'
     if len(newCoupons) > 0:
         # Add detailed information about added coupons. Limit the max. number of that so our information message doesn't get too big.
         infoText += '\n<b>' + SYMBOLS.NEW + ' ' + str(len(newCoupons)) + ' Coupons hinzugefügt:</b>'
@@ -386,8 +484,6 @@ async def updatePublicChannel(bkbot, updateMode: ChannelUpdateMode):
     # Store messageID of channel update overview message
     infoDBDoc.informationMessageID = newMsg.message_id
     infoDBDoc.dateLastSuccessfulChannelUpdate = datetime.now()
-    infoDBDoc.store(infoDB)
-    logging.info(f"Channel update done | Total time needed: {datetime.now() - dateStart}")
 
 
 async def cleanupChannel(bkbot):
@@ -410,6 +506,12 @@ async def deleteLeftoverMessageIDsToDelete(bkbot, infoDB: Database, infoDoc) ->
         return 0
     index = 0
     for messageID in infoDoc.messageIDsToDelete:
+        if bkbot.isShuttingDown:
+            # Remember only the ones which are left so they won't be deleted again after restart
+            logging.info(f'Interrupting deletion of old messages because of shutdown | Messages left: {initialNumberofMsgsToDelete - index}')
+            infoDoc.messageIDsToDelete = list(infoDoc.messageIDsToDelete)[index:]
+            infoDoc.store(infoDB)
+            raise asyncio.CancelledError()
         logging.info(f"Deleting messageID {index + 1}/{initialNumberofMsgsToDelete} | {messageID}")
         await asyncio.create_task(bkbot.deleteMessage(chat_id=bkbot.getPublicChannelChatID(), messageID=messageID))
         index += 1
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Tuple, Union, Optional
+
+from couchdb import Database
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._utils.types import ConversationDict, ConversationKey, CDCData
+
+""" Persists the states of the ConversationHandlers so open menus keep working after a restart of the bot.
+ Also contains helpers to write other bot state in bulk. """
+
+# Conversation states which have not been changed for longer than this are dropped on startup
+CONVERSATION_STATE_MAX_AGE_DAYS = 30
+# Changes collected within this time are written with one request
+CONVERSATION_FLUSH_DELAY_SECONDS = 1
+
+
+class DocumentWriteBuffer:
+    """ Collects changed docs and writes them with one request once maxDocs docs have been collected or flush gets called.
+     Make sure to call flush when done and before shutdown or the last changes will be lost. """
+
+    def __init__(self, db: Database, maxDocs: int = 10):
+        self.db = db
+        self.maxDocs = maxDocs
+        # docID -> doc: Only the latest version of every doc gets written
+        self.docs: Dict[str, dict] = {}
+
+    def add(self, doc: dict):
+        self.docs[doc['_id']] = doc
+        if len(self.docs) >= self.maxDocs:
+            self.flush()
+
+    def flush(self):
+        if len(self.docs) == 0:
+            return
+        docs = list(self.docs.values())
+        self.docs = {}
+        try:
+            results = self.db.update(docs)
+        except Exception:
+            # Keep docs so they get written on the next flush. Newer versions added meanwhile win.
+            for doc in docs:
+                self.docs.setdefault(doc['_id'], doc)
+            raise
+        for doc, (success, docID, revOrException) in zip(docs, results):
+            if success:
+                # Database.update only does this for dicts -> Also do it for Documents so they can be stored again later
+                doc['_rev'] = revOrException
+            else:
+                logging.warning(f'Failed to store doc {docID} in DB {self.db.name}: {revOrException}')
+
+
+class CouchDBConversationPersistence(BasePersistence):
+    """ Stores only conversation states: One doc per conversation. Changed states are buffered and written in bulk.
+     PTB itself only hands over the last state of every changed conversation every update_interval seconds so clicking through menus does not cause one write per click. """
+
+    def __init__(self, db: Database, update_interval: float = 60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False), update_interval=update_interval)
+        self.db = db
+        # name -> key -> state
+        self.conversations: Union[Dict[str, ConversationDict], None] = None
+        # docID -> _rev of all docs in DB
+        self.revisions: Dict[str, str] = {}
+        # docID -> (name, key, state): Changes which have not yet been written to DB. state None = delete
+        self.pendingChanges: Dict[str, Tuple[str, ConversationKey, Optional[object]]] = {}
+        self.flushTask: Union[asyncio.Task, None] = None
+        self.flushLock = asyncio.Lock()
+
+    @staticmethod
+    def getDocID(name: str, key: ConversationKey) -> str:
+        return name + ':' + ':'.join(str(keyPart) for keyPart in key)
+
+    def loadConversations(self) -> Dict[str, ConversationDict]:
+        """ Loads all conversation states with one request and deletes outdated ones. """
+        timestampStart = datetime.now().timestamp()
+        conversations = {}
+        outdatedDocs = []
+        minTimestamp = timestampStart - CONVERSATION_STATE_MAX_AGE_DAYS * 24 * 60 * 60
+        for row in self.db.view('_all_docs', include_docs=True):
+            doc = row.doc
+            if doc['_id'].startswith('_design/'):
+                continue
+            if doc.get('timestamp', 0) < minTimestamp:
+                outdatedDocs.append({'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True})
+                continue
+            conversations.setdefault(doc['name'], {})[tuple(doc['key'])] = doc['state']
+            self.revisions[doc['_id']] = doc['_rev']
+        if len(outdatedDocs) > 0:
+            self.db.update(outdatedDocs)
+        logging.info(f'Loaded {sum(len(states) for states in conversations.values())} conversation states | Deleted outdated: {len(outdatedDocs)} | Duration: {datetime.now().timestamp() - timestampStart:0.2f} seconds')
+        return conversations
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        if self.conversations is None:
+            self.conversations = await asyncio.get_running_loop().run_in_executor(None, self.loadConversations)
+        return dict(self.conversations.get(name, {}))
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        states = self.conversations.setdefault(name, {})
+        if new_state is None:
+            states.pop(key, None)
+        else:
+            states[key] = new_state
+        self.pendingChanges[self.getDocID(name, key)] = (name, key, new_state)
+        if self.flushTask is None:
+            # All changes of one persistence update run end up in one request
+            self.flushTask = asyncio.create_task(self.flushDelayed())
+
+    async def flushDelayed(self):
+        await asyncio.sleep(CONVERSATION_FLUSH_DELAY_SECONDS)
+        self.flushTask = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self.flushLock:
+            if len(self.pendingChanges) == 0:
+                return
+            pendingChanges = self.pendingChanges
+            self.pendingChanges = {}
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.writeChanges, pendingChanges)
+            except Exception:
+                logging.exception('Failed to store conversation states -> Retrying on next flush')
+                for docID, change in pendingChanges.items():
+                    self.pendingChanges.setdefault(docID, change)
+
+    def writeChanges(self, changes: Dict[str, Tuple[str, ConversationKey, Optional[object]]]):
+        timestamp = datetime.now().timestamp()
+        docs = []
+        for docID, (name, key, state) in changes.items():
+            rev = self.revisions.get(docID)
+            if state is None:
+                if rev is not None:
+                    docs.append({'_id': docID, '_rev': rev, '_deleted': True})
+                continue
+            doc = {'_id': docID, 'name': name, 'key': list(key), 'state': state, 'timestamp': timestamp}
+            if rev is not None:
+                doc['_rev'] = rev
+            docs.append(doc)
+        for attempt in range(2):
+            if len(docs) == 0:
+                return
+            conflictedDocs = []
+            for doc, (success, docID, revOrException) in zip(docs, self.db.update(docs)):
+                if success:
+                    if doc.get('_deleted'):
+                        self.revisions.pop(docID, None)
+                    else:
+                        self.revisions[docID] = revOrException
+                elif attempt == 0:
+                    # e.g. doc has been modified by another bot process -> Retry with current revision
+                    currentDoc = self.db.get(docID)
+                    if currentDoc is None:
+                        doc.pop('_rev', None)
+                        if doc.get('_deleted'):
+                            continue
+                    else:
+                        doc['_rev'] = currentDoc['_rev']
+                    conflictedDocs.append(doc)
+                else:
+                    logging.warning(f'Failed to store conversation state {docID}: {revOrException}')
+            docs = conflictedDocs
+        logging.info(f'Stored {len(changes)} conversation states')
+
+    # Everything else is not persisted
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self) -> Optional[CDCData]:
+        return None
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: CDCData) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
@@ -1,4 +1,5 @@
 import json
+import re
 from datetime import datetime
 from typing import Optional, List
 
@@ -54,6 +55,18 @@ class Commands:
     MAINTENANCE = 'maintenance'
 
 
+class Jobs:
+    """ Names of the background jobs of the bot, see JobScheduler. """
+    CRAWL = 'crawl'
+    DAILY_BATCH = 'dailyBatch'
+    SEND_NOTIFICATIONS = 'sendNotifications'
+
+
+class SchedulerEvents:
+    CRAWL_FINISHED = 'crawlFinished'
+    NOTIFICATIONS_PENDING = 'notificationsPending'
+
+
 class PATTERN:
     PLU = r'^plu,(\d{2,})$'
     PLU_TOGGLE_FAV = r'^plu,(\d{2,}),togglefav,([^,]+)$'
@@ -83,6 +96,15 @@ class Config(pydantic.BaseModel):
     admin_ids: Optional[List]
     public_channel_name: Optional[str]
     public_channel_post_id_faq: Optional[int]
+    # Optional: Receive updates via webhook instead of long polling
+    webhook_url: Optional[str]
+    webhook_secret_token: Optional[str]
+    webhook_listen_host: str = '127.0.0.1'
+    webhook_listen_port: int = 8443
+    webhook_workers: int = 8
+    # Optional: Number of bot worker processes. Requires webhook mode. 0 = Run everything in one process.
+    cluster_workers: int = 0
+    cluster_socket_dir: str = '/tmp/bkbot-cluster'
 
     @root_validator
     def check_config_values(cls, values):
@@ -91,6 +113,11 @@ class Config(pydantic.BaseModel):
 
         if public_channel_name is not None and public_channel_post_id_faq is None:
             raise ValueError(f'Bad config: public channel name is given: {public_channel_name=} and at the same time {public_channel_post_id_faq=} | Your public channel is expected to have a permanent postID stickied as a FAQ!')
+        webhook_url, webhook_secret_token = values.get('webhook_url'), values.get('webhook_secret_token')
+        if webhook_url is not None and (webhook_secret_token is None or re.fullmatch(r'[A-Za-z0-9_-]{1,256}', webhook_secret_token) is None):
+            raise ValueError(f'Bad config: {webhook_url=} is given but webhook_secret_token is missing or invalid | Allowed: 1-256 characters A-Z, a-z, 0-9, _ and -')
+        if values.get('cluster_workers', 0) > 0 and webhook_url is None:
+            raise ValueError('Bad config: cluster_workers is given but webhook_url is missing | Multi process mode only works with webhook')
         return values
 
 
@@ -107,6 +134,16 @@ class ImageCache:
         self.dateLastUsed = datetime.now()
         # self.timesUsed = 0
 
+    def toDict(self) -> dict:
+        return {'fileID': self.imageFileID, 'dateCreated': self.dateCreated.timestamp(), 'dateLastUsed': self.dateLastUsed.timestamp()}
+
+    @staticmethod
+    def fromDict(data: dict) -> 'ImageCache':
+        imageCache = ImageCache(fileID=data['fileID'])
+        imageCache.dateCreated = datetime.fromtimestamp(data['dateCreated'])
+        imageCache.dateLastUsed = datetime.fromtimestamp(data['dateLastUsed'])
+        return imageCache
+
     def updateLastUsedDate(self):
         """ Updates last used timestamp to current timestamp. """
         self.dateLastUsed = datetime.now()
@@ -0,0 +1,223 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from typing import List, Union, Callable, Awaitable
+
+from telegram import Update, Bot
+
+""" Receives Telegram updates via webhook as alternative to long polling.
+ Updates get distributed to a fixed number of workers by user so updates of one user are always processed in order while different users are served concurrently. """
+
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+# Updates are small. Anything bigger than this is not from Telegram.
+WEBHOOK_MAX_BODY_BYTES = 256 * 1024
+WEBHOOK_MAX_HEADER_LINES = 100
+WEBHOOK_READ_TIMEOUT_SECONDS = 10
+
+
+async def waitForStopSignal():
+    """ Waits until this process gets told to stop via SIGINT (Ctrl+C) or SIGTERM. """
+    stopEvent = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    stopSignals = (signal.SIGINT, signal.SIGTERM)
+    for stopSignal in stopSignals:
+        loop.add_signal_handler(stopSignal, stopEvent.set)
+    try:
+        await stopEvent.wait()
+        logging.info('Received stop signal')
+    finally:
+        for stopSignal in stopSignals:
+            loop.remove_signal_handler(stopSignal)
+
+
+def getUpdateShardKey(update: Update) -> int:
+    """ Returns key used to distribute updates: All updates of one user have the same key. """
+    if update.effective_user is not None:
+        return update.effective_user.id
+    elif update.effective_chat is not None:
+        return update.effective_chat.id
+    else:
+        return update.update_id
+
+
+async def readChunkedBody(reader: asyncio.StreamReader) -> Union[bytes, None]:
+    """ Reads HTTP body sent with "Transfer-Encoding: chunked". Returns None if the body exceeds WEBHOOK_MAX_BODY_BYTES. """
+    body = bytearray()
+    while True:
+        # Chunk extensions after ';' are allowed but not used by anyone
+        chunkSize = int((await reader.readline()).split(b';')[0].strip(), 16)
+        if chunkSize == 0:
+            break
+        if len(body) + chunkSize > WEBHOOK_MAX_BODY_BYTES:
+            return None
+        body += await reader.readexactly(chunkSize)
+        await reader.readexactly(2)
+    # Skip trailers
+    for _ in range(WEBHOOK_MAX_HEADER_LINES):
+        if len((await reader.readline()).strip()) == 0:
+            break
+    return bytes(body)
+
+
+class UpdateDispatcher:
+    """ Processes updates with a fixed number of workers. Updates of one user always go to the same worker so they will be processed in the order they have been received. """
+
+    def __init__(self, handleUpdate: Callable[[Update], Awaitable], numberofWorkers: int = 8, maxQueuedUpdatesPerWorker: int = 100):
+        self.handleUpdate = handleUpdate
+        # One bounded queue per worker: If the queue of a worker is full, Telegram gets told to retry later.
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=maxQueuedUpdatesPerWorker) for _ in range(numberofWorkers)]
+        self.workers: List[asyncio.Task] = []
+        self.numberofUpdatesReceived = 0
+        self.numberofUpdatesRejected = 0
+        self.numberofUpdatesProcessed = 0
+
+    def start(self):
+        for queue in self.queues:
+            self.workers.append(asyncio.create_task(self.processUpdates(queue)))
+
+    async def stop(self, timeoutSeconds: Union[float, None] = None):
+        """ Waits until all queued updates have been processed but at most timeoutSeconds. """
+        try:
+            await asyncio.wait_for(asyncio.gather(*[queue.join() for queue in self.queues]), timeout=timeoutSeconds)
+        except asyncio.TimeoutError:
+            logging.warning(f'Dropping {self.getNumberofQueuedUpdates()} updates which could not be processed within {timeoutSeconds} seconds')
+        for worker in self.workers:
+            worker.cancel()
+        self.workers.clear()
+
+    def getNumberofQueuedUpdates(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def getStats(self) -> dict:
+        return {'queued': self.getNumberofQueuedUpdates(), 'received': self.numberofUpdatesReceived, 'rejected': self.numberofUpdatesRejected,
+                'processed': self.numberofUpdatesProcessed}
+
+    def getQueueForUpdate(self, update: Update) -> asyncio.Queue:
+        return self.queues[getUpdateShardKey(update) % len(self.queues)]
+
+    def putUpdateNowait(self, update: Update) -> bool:
+        """ Returns False if the update has been rejected because the queue is full. """
+        self.numberofUpdatesReceived += 1
+        try:
+            self.getQueueForUpdate(update).put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            self.numberofUpdatesRejected += 1
+            logging.warning(f'Update queue is full -> Rejecting update {update.update_id}')
+            return False
+
+    async def putUpdate(self, update: Update):
+        """ Waits until there is space in the queue. """
+        self.numberofUpdatesReceived += 1
+        await self.getQueueForUpdate(update).put(update)
+
+    async def processUpdates(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.handleUpdate(update)
+                self.numberofUpdatesProcessed += 1
+            except Exception:
+                # Errors inside handlers are handled by the error handlers of the application already
+                logging.exception(f'Failed to process update {update.update_id}')
+            finally:
+                queue.task_done()
+
+
+class WebhookServer:
+
+    def __init__(self, bot: Union[Bot, None], dispatcher: UpdateDispatcher, path: str, secretToken: str, host: str = '127.0.0.1', port: int = 8443):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secretToken = secretToken
+        self.host = host
+        self.port = port
+        self.server: Union[asyncio.AbstractServer, None] = None
+
+    async def start(self):
+        self.dispatcher.start()
+        self.server = await asyncio.start_server(self.handleConnection, host=self.host, port=self.port)
+        logging.info(f'Webhook server listening on {self.host}:{self.port}{self.path}')
+
+    async def stop(self, timeoutSeconds: Union[float, None] = None):
+        """ Stops accepting updates and waits until all queued updates have been processed, see UpdateDispatcher.stop """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.dispatcher.stop(timeoutSeconds=timeoutSeconds)
+
+    async def handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                status, body = await asyncio.wait_for(self.handleRequest(reader), timeout=WEBHOOK_READ_TIMEOUT_SECONDS)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError, TypeError):
+                status, body = 400, {'error': 'Bad request'}
+            except Exception:
+                logging.exception('Failed to handle webhook request')
+                status, body = 500, {'error': 'Internal server error'}
+            try:
+                await self.sendResponse(writer, status, body)
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def handleRequest(self, reader: asyncio.StreamReader) -> tuple:
+        """ Returns HTTP status code and JSON response body for the request read from given reader. """
+        requestLine = (await reader.readline()).decode('latin-1').strip()
+        parts = requestLine.split(' ')
+        if len(parts) != 3:
+            return 400, {'error': 'Bad request'}
+        method, path, _ = parts
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if len(line) == 0:
+                break
+            if len(headers) >= WEBHOOK_MAX_HEADER_LINES:
+                return 431, {'error': 'Too many headers'}
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if path == '/health' and method == 'GET':
+            return 200, {'status': 'ok', **self.dispatcher.getStats()}
+        if path != self.path:
+            return 404, {'error': 'Not found'}
+        if method != 'POST':
+            return 405, {'error': 'Method not allowed'}
+        if not hmac.compare_digest(headers.get(SECRET_TOKEN_HEADER, ''), self.secretToken):
+            return 403, {'error': 'Forbidden'}
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            requestBody = await readChunkedBody(reader)
+            if requestBody is None:
+                return 413, {'error': 'Payload too large'}
+        else:
+            contentLength = int(headers.get('content-length', '-1'))
+            if contentLength < 0:
+                return 411, {'error': 'Length required'}
+            if contentLength > WEBHOOK_MAX_BODY_BYTES:
+                return 413, {'error': 'Payload too large'}
+            requestBody = await reader.readexactly(contentLength)
+        updateJson = json.loads(requestBody)
+        if not isinstance(updateJson, dict):
+            return 400, {'error': 'Bad request'}
+        update = Update.de_json(updateJson, self.bot)
+        if update is None:
+            return 400, {'error': 'Bad request'}
+        if not self.dispatcher.putUpdateNowait(update):
+            # Backpressure: Telegram will re-send this update later
+            return 503, {'error': 'Too many updates'}
+        return 200, {}
+
+    @staticmethod
+    async def sendResponse(writer: asyncio.StreamWriter, status: int, body: dict):
+        reasons = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large',
+                   431: 'Request Header Fields Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+        bodyBytes = json.dumps(body).encode('utf-8')
+        head = f'HTTP/1.1 {status} {reasons.get(status, "Error")}\r\nContent-Type: application/json\r\nContent-Length: {len(bodyBytes)}\r\nConnection: close\r\n'
+        if status == 503:
+            head += 'Retry-After: 1\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + bodyBytes)
+        await writer.drain()
@@ -1,35 +1,26 @@
 from typing import Union, List
 
-from Helper import SYMBOLS, formatDateGerman, CouponType, formatPrice
-from UtilsCouponsDB import Coupon, CouponSortMode, CouponSortModes
+from Helper import SYMBOLS, formatDateGerman, CouponType, formatPrice, getCurrentTimestamp
+from UtilsCouponsDB import CouponBase, CouponSortMode, CouponSortModes, CouponStats
 
 
 class CouponCategory:
     """ Takes a list/dict of given coupons and creates a 'category' container of it containing easily accessible fields with useful information about it. """
 
-    def __init__(self, coupons: Union[CouponType, int, dict, List], title: Union[str, None] = None):
+    def __init__(self, coupons: Union[CouponType, int, dict, List], title: Union[str, None] = None, now: Union[float, None] = None):
         self.titleOverride = title
         self.coupons = None
         self.mainCouponType = None
-        self.couponTypes = set()
         self.displayDescription = False  # Display description for this category in bot menu?
-        self.expireDatetimeLowest = None
-        self.expireDatetimeHighest = None
-        self.numberofCouponsTotal = 0
-        self.numberofCouponsHidden = 0
-        self.numberofCouponsEatable = 0
-        self.numberofCouponsEatableWithPrice = 0
+        # Time independent information, merged from the stats of all coupons
+        self.stats = CouponStats()
         self.numberofCouponsNew = 0
-        self.numberofCouponsWithFriesAndDrink = 0
-        self.numberofVeggieCoupons = 0
-        self.totalPrice = 0
         if isinstance(coupons, dict):
             self.coupons = list(coupons.values())
         elif isinstance(coupons, list):
             self.coupons = coupons
         if self.coupons is not None:
-            for coupon in self.coupons:
-                self.updateWithCouponInfo(coupon)
+            self.updateWithCouponInfo(self.coupons, now=now)
             if len(self.couponTypes) == 1:
                 for first_item in self.couponTypes:
                     self.mainCouponType = first_item
@@ -83,6 +74,46 @@ class CouponCategory:
             self.namePlural = "Unbekannt"
             self.namePluralWithoutSymbol = "Unbekannt"
 
+    @property
+    def couponTypes(self) -> set:
+        return self.stats.couponTypes
+
+    @property
+    def expireTimestampLowest(self) -> Union[float, None]:
+        return self.stats.expireTimestampLowest
+
+    @property
+    def expireTimestampHighest(self) -> Union[float, None]:
+        return self.stats.expireTimestampHighest
+
+    @property
+    def numberofCouponsTotal(self) -> int:
+        return self.stats.numberofCouponsTotal
+
+    @property
+    def numberofCouponsHidden(self) -> int:
+        return self.stats.numberofCouponsHidden
+
+    @property
+    def numberofCouponsEatable(self) -> int:
+        return self.stats.numberofCouponsEatable
+
+    @property
+    def numberofCouponsEatableWithPrice(self) -> int:
+        return self.stats.numberofCouponsEatableWithPrice
+
+    @property
+    def numberofCouponsWithFriesAndDrink(self) -> int:
+        return self.stats.numberofCouponsWithFriesAndDrink
+
+    @property
+    def numberofVeggieCoupons(self) -> int:
+        return self.stats.numberofVeggieCoupons
+
+    @property
+    def totalPrice(self) -> float:
+        return self.stats.totalPrice
+
     def getTotalPrice(self) -> float:
         return self.totalPrice
 
@@ -92,12 +123,6 @@ class CouponCategory:
     def getNumberofCouponsEatableWithoutPrice(self) -> int:
         return self.numberofCouponsEatable - self.numberofCouponsEatableWithPrice
 
-    def setNumberofCouponsEatableWithPrice(self, newNumber: int):
-        self.numberofCouponsEatableWithPrice = newNumber
-
-    def setTotalPrice(self, newPrice: float):
-        self.totalPrice = newPrice
-
     def isEatable(self) -> bool:
         """ Typically all coupon categories except Payback coupons will return True here as they do contain at least one item that is considered 'eatable'. """
         if self.numberofCouponsEatable > 0:
@@ -187,12 +212,12 @@ class CouponCategory:
         return text
 
     def getExpireDateInfoText(self) -> str:
-        if self.expireDatetimeLowest is None or self.expireDatetimeHighest is None:
+        if self.expireTimestampLowest is None or self.expireTimestampHighest is None:
             return "Gültig bis ??"
-        elif self.expireDatetimeLowest == self.expireDatetimeHighest:
-            return "Gültig bis " + formatDateGerman(self.expireDatetimeLowest)
+        elif self.expireTimestampLowest == self.expireTimestampHighest:
+            return "Gültig bis " + formatDateGerman(self.expireTimestampLowest)
         else:
-            return "Gültig bis min " + formatDateGerman(self.expireDatetimeLowest) + " max " + formatDateGerman(self.expireDatetimeHighest)
+            return "Gültig bis min " + formatDateGerman(self.expireTimestampLowest) + " max " + formatDateGerman(self.expireTimestampHighest)
 
     def getPriceInfoText(self) -> Union[str, None]:
         if self.getNumberofCouponsEatableWithPrice() == 0:
@@ -203,38 +228,18 @@ class CouponCategory:
                 self.getNumberofCouponsEatableWithoutPrice()) + " Coupons, deren Preis nicht bekannt ist."
         return text
 
-    def updateWithCouponInfo(self, couponOrCouponList: Union[Coupon, List[Coupon]]):
-        """ Updates category with information of given Coupon(s). """
-        if isinstance(couponOrCouponList, Coupon):
+    def updateWithCouponInfo(self, couponOrCouponList: Union[CouponBase, List[CouponBase]], now: Union[float, None] = None):
+        """ Updates category with information of given Coupon(s)/CouponRecord(s). """
+        if isinstance(couponOrCouponList, CouponBase):
             couponList = [couponOrCouponList]
         else:
             couponList = couponOrCouponList
+        if now is None:
+            now = getCurrentTimestamp()
         for coupon in couponList:
-            self.couponTypes.add(coupon.type)
-            self.numberofCouponsTotal += 1
-            if coupon.isHidden:
-                self.numberofCouponsHidden += 1
-            if coupon.isEatable():
-                self.numberofCouponsEatable += 1
-            if coupon.isNewCoupon():
+            # CouponRecords cache their stats so classifiers only run once per coupon
+            self.stats.merge(coupon.getCouponStats())
+            if coupon.isNewCoupon(now):
                 self.numberofCouponsNew += 1
-            if coupon.isContainsFriesAndDrink():
-                self.numberofCouponsWithFriesAndDrink += 1
-            if coupon.isVeggie():
-                self.numberofVeggieCoupons += 1
-            # Update expire-date info
-            date = coupon.getExpireDatetime()
-            if self.expireDatetimeLowest is None and self.expireDatetimeHighest is None:
-                self.expireDatetimeLowest = date
-                self.expireDatetimeHighest = date
-            else:
-                if date < self.expireDatetimeLowest:
-                    self.expireDatetimeLowest = date
-                elif date > self.expireDatetimeHighest:
-                    self.expireDatetimeHighest = date
-            if coupon.getPrice() is not None:
-                self.setTotalPrice(self.getTotalPrice() + coupon.getPrice())
-                self.setNumberofCouponsEatableWithPrice(self.getNumberofCouponsEatableWithPrice() + 1)
         # End of function
         return
-
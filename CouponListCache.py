@@ -0,0 +1,93 @@
+from typing import List, Union, Tuple, Any
+
+from telegram import InlineKeyboardButton
+
+from BotUtils import CallbackVars
+from Helper import SYMBOLS
+
+""" Max age of cached coupon lists: Validity and 'is new' state of coupons depend on the current time so cached lists must not be used forever. """
+COUPON_LIST_CACHE_MAX_AGE_SECONDS = 60
+""" Max number of cached items per cache. Cache gets cleared completely when this is exceeded. """
+COUPON_LIST_CACHE_MAX_ITEMS = 500
+
+
+class CouponListPage:
+    """ Pre-rendered page of a coupon list. Does not contain any user specific information: Favorite stars and user specific buttons are added in getButtonRows. """
+
+    def __init__(self, menuText: str, couponIDs: List[str], couponButtons: List[InlineKeyboardButton], navigationButtons: Union[List[InlineKeyboardButton], None],
+                 isLastPageOfMultiplePages: bool, sortButton: Union[InlineKeyboardButton, None]):
+        self.menuText = menuText
+        self.couponIDs = couponIDs
+        self.couponButtons = couponButtons
+        self.navigationButtons = navigationButtons
+        self.isLastPageOfMultiplePages = isLastPageOfMultiplePages
+        self.sortButton = sortButton
+        # Created on demand
+        self.couponButtonsFavorite: List[Union[InlineKeyboardButton, None]] = [None] * len(couponButtons)
+        self.navigationButtonsEasterEgg = None
+
+    def getCouponButtonFavorite(self, index: int) -> InlineKeyboardButton:
+        """ Returns button of coupon at given index with favorite star. """
+        button = self.couponButtonsFavorite[index]
+        if button is None:
+            couponButton = self.couponButtons[index]
+            button = InlineKeyboardButton(SYMBOLS.STAR + couponButton.text, callback_data=couponButton.callback_data)
+            self.couponButtonsFavorite[index] = button
+        return button
+
+    def getNavigationButtonsEasterEgg(self) -> List[InlineKeyboardButton]:
+        if self.navigationButtonsEasterEgg is None:
+            self.navigationButtonsEasterEgg = self.navigationButtons[:-1] + [InlineKeyboardButton(SYMBOLS.GHOST, callback_data=CallbackVars.EASTER_EGG)]
+        return self.navigationButtonsEasterEgg
+
+    def getButtonRows(self, favoriteCouponIDs, highlightFavorites: bool, displaySortButton: bool) -> List[List[InlineKeyboardButton]]:
+        buttons = []
+        # Whenever the user has at least one favorite coupon on page > 1 we'll replace the dummy button in the middle and add Easter Egg functionality :)
+        currentPageContainsAtLeastOneFavoriteCoupon = False
+        for index, couponID in enumerate(self.couponIDs):
+            if couponID in favoriteCouponIDs:
+                currentPageContainsAtLeastOneFavoriteCoupon = True
+                if highlightFavorites:
+                    # Highlight item in list so user can see favourites easier
+                    buttons.append([self.getCouponButtonFavorite(index)])
+                    continue
+            buttons.append([self.couponButtons[index]])
+        if self.navigationButtons is not None:
+            # Easter egg: Trigger it if there are at least two pages available AND user is currently on the last page AND that page contains at least one user-favorited coupon.
+            if currentPageContainsAtLeastOneFavoriteCoupon and self.isLastPageOfMultiplePages:
+                buttons.append(self.getNavigationButtonsEasterEgg())
+            else:
+                buttons.append(self.navigationButtons)
+        if displaySortButton and self.sortButton is not None:
+            buttons.append([self.sortButton])
+        buttons.append([InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.MENU_MAIN)])
+        return buttons
+
+
+class CouponListCache:
+    """ Caches results of coupon list views and pre-rendered pages of them.
+     Everything gets dropped whenever the version of the coupons the cached items are based on changes. """
+
+    def __init__(self):
+        self.couponsVersion = None
+        self.items = {}
+
+    def get(self, couponsVersion: int, key: Tuple, now: float) -> Union[Any, None]:
+        if couponsVersion != self.couponsVersion:
+            self.couponsVersion = couponsVersion
+            self.items.clear()
+            return None
+        item = self.items.get(key)
+        if item is None:
+            return None
+        timestampCreated, value = item
+        if now - timestampCreated > COUPON_LIST_CACHE_MAX_AGE_SECONDS:
+            del self.items[key]
+            return None
+        return value
+
+    def put(self, couponsVersion: int, key: Tuple, now: float, value):
+        if couponsVersion != self.couponsVersion or len(self.items) >= COUPON_LIST_CACHE_MAX_ITEMS:
+            self.couponsVersion = couponsVersion
+            self.items.clear()
+        self.items[key] = (now, value)
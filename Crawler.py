@@ -1,24 +1,37 @@
+import copy
 import csv
 import logging
+import time
 import traceback
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Iterable, Set, Callable
 
 import httpx
-import qrcode
-import requests
 from couchdb import Database
 
 import couchdb
 
+try:
+    import ijson
+except ImportError:
+    # Optional: Without it, the coupon API response will be loaded all at once
+    ijson = None
+
 import PaperCouponHelper
 from BotUtils import getImageBasePath, loadConfig
 from Helper import *
 from Helper import getPathImagesOffers, getPathImagesProducts, \
     isValidImageFile, CouponType, Paths
 from UtilsOffers import offerGetImagePath, offerIsValid
-from UtilsCouponsDB import Coupon, InfoEntry, CouponFilter, getCouponTitleMapping, User, removeDuplicatedCoupons, sortCoupons
+from UtilsCouponsDB import Coupon, CouponRecord, CouponDuplicateIndex, InfoEntry, CouponFilter, getCouponTitleMapping, User, removeDuplicatedCoupons, sortCoupons, \
+    isLegacyFavorite, getCouponFromFavorite
 from CouponCategory import CouponCategory
+from CrawlerPipeline import getAppCouponParsePipeline, iterateAppCouponsBK
 
+# All DBs the crawler and bot need
+REQUIRED_DATABASES = (DATABASES.INFO_DB, DATABASES.TELEGRAM_USERS, DATABASES.COUPONS, DATABASES.OFFERS, DATABASES.COUPONS_ARCHIVE, DATABASES.COUPONS_HISTORY,
+                      DATABASES.COUPONS_HISTORY_SIMPLE, DATABASES.PRODUCTS, DATABASES.PRODUCTS_HISTORY, DATABASES.PRODUCTS2_HISTORY, DATABASES.TELEGRAM_CHANNEL,
+                      DATABASES.TELEGRAM_CONVERSATIONS)
 HEADERS_OLD = {"User-Agent": "BurgerKing/6.7.0 (de.burgerking.kingfinder; build:432; Android 8.0.0) okhttp/3.12.3"}
 HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36",
            "Origin": "https://www.burgerking.de",
@@ -33,6 +46,7 @@ HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/
            "x-ui-platform": "web",
            "x-ui-region": "DE"}
 # x-user-datetime: 2022-03-16T20:59:45+01:00
+URL_COUPONS_API = 'https://czqk28jt.apicdn.sanity.io/v1/graphql/prod_bk_de/default?operationName=featureSortedLoyaltyOffers&variables=%7B%22id%22%3A%22feature-loyalty-offers-ui-singleton%22%7D&query=query+featureSortedLoyaltyOffers%28%24id%3AID%21%29%7BLoyaltyOffersUI%28id%3A%24id%29%7B_id+sortedSystemwideOffers%7B...SystemwideOffersFragment+__typename%7D__typename%7D%7Dfragment+SystemwideOffersFragment+on+SystemwideOffer%7B_id+_type+loyaltyEngineId+name%7BlocaleRaw%3AdeRaw+__typename%7Ddescription%7BlocaleRaw%3AdeRaw+__typename%7DmoreInfo%7BlocaleRaw%3AdeRaw+__typename%7DhowToRedeem%7BenRaw+__typename%7DbackgroundImage%7B...MenuImageFragment+__typename%7DshortCode+mobileOrderOnly+redemptionMethod+daypart+redemptionType+upsellOptions%7B_id+loyaltyEngineId+description%7BlocaleRaw%3AdeRaw+__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7Dname%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DofferPrice+marketPrice%7B...on+Item%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D...on+Combo%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7DuiPattern+lockedOffersPanel%7BcompletedChallengeHeader%7BlocaleRaw%3AdeRaw+__typename%7DcompletedChallengeDescription%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DpromoCodePanel%7BpromoCodeDescription%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLabel%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLink+__typename%7Dincentives%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DisOfferBenefit+__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D...on+Picker%7B_id+_type+options%7Boption%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D%7D__typename%7DisOfferBenefit+__typename%7D...on+OfferDiscount%7B_id+_type+discountValue+discountType+__typename%7D...on+OfferActivation%7B_id+_type+__typename%7D...on+SwapMapping%7B_type+__typename%7D%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7Drules%7B...on+RequiresAuthentication%7BrequiresAuthentication+__typename%7D...on+LoyaltyBetweenDates%7BstartDate+endDate+__typename%7D__typename%7D__typename%7Dfragment+MenuImageFragment+on+Image%7Bhotspot%7Bx+y+height+width+__typename%7Dcrop%7Btop+bottom+left+right+__typename%7Dasset%7Bmetadata%7Blqip+palette%7Bdominant%7Bbackground+foreground+__typename%7D__typename%7D__typename%7D_id+__typename%7D__typename%7Dfragment+MenuImagesFragment+on+Images%7Bapp%7B...MenuImageFragment+__typename%7Dkiosk%7B...MenuImageFragment+__typename%7DimageDescription+__typename%7Dfragment+VendorConfigsFragment+on+VendorConfigs%7Bcarrols%7B...VendorConfigFragment+__typename%7DcarrolsDelivery%7B...VendorConfigFragment+__typename%7Dncr%7B...VendorConfigFragment+__typename%7DncrDelivery%7B...VendorConfigFragment+__typename%7Doheics%7B...VendorConfigFragment+__typename%7DoheicsDelivery%7B...VendorConfigFragment+__typename%7Dpartner%7B...VendorConfigFragment+__typename%7DpartnerDelivery%7B...VendorConfigFragment+__typename%7DproductNumber%7B...VendorConfigFragment+__typename%7DproductNumberDelivery%7B...VendorConfigFragment+__typename%7Dsicom%7B...VendorConfigFragment+__typename%7DsicomDelivery%7B...VendorConfigFragment+__typename%7Dqdi%7B...VendorConfigFragment+__typename%7DqdiDelivery%7B...VendorConfigFragment+__typename%7Dqst%7B...VendorConfigFragment+__typename%7DqstDelivery%7B...VendorConfigFragment+__typename%7Drpos%7B...VendorConfigFragment+__typename%7DrposDelivery%7B...VendorConfigFragment+__typename%7DsimplyDelivery%7B...VendorConfigFragment+__typename%7DsimplyDeliveryDelivery%7B...VendorConfigFragment+__typename%7Dtablet%7B...VendorConfigFragment+__typename%7DtabletDelivery%7B...VendorConfigFragment+__typename%7D__typename%7Dfragment+VendorConfigFragment+on+VendorConfig%7BpluType+parentSanityId+pullUpLevels+constantPlu+discountPlu+quantityBasedPlu%7Bquantity+plu+qualifier+__typename%7DmultiConstantPlus%7Bquantity+plu+qualifier+__typename%7DparentChildPlu%7Bplu+childPlu+__typename%7DsizeBasedPlu%7BcomboPlu+comboSize+__typename%7D__typename%7D'
 """ Enable this to crawl from localhost instead of API. Useful if there is a lot of testing to do! """
 DEBUGCRAWLER = False
 
@@ -88,43 +102,32 @@ class BKCrawler:
         self.cachedMissingPaperCouponsText = None
         self.cachedFutureCouponsText = None
         self.cachedFutureCoupons = []
+        # All coupons in DB as compact in-memory objects so filtering doesn't need any DB requests
+        self.cachedCouponRecords = {}
+        # Increased whenever cachedCouponRecords gets replaced -> Lets consumers invalidate data derived from it
+        self.couponsVersion = 0
+        # Duplicate groups of all cached coupons, rebuilt together with cachedCouponRecords
+        self.cachedDuplicateIndex = CouponDuplicateIndex([])
+        # IDs of coupons which have been added/modified/deleted in DB since the last cache update
+        self.changedCouponIDs = set()
+        # Next point in time at which a cached coupon becomes active or expires -> Time dependent caches need to be refreshed then
+        self.timestampNextCouponTransition = None
+        # Coupons from archive DB which have been requested before e.g. to display expired favorites
+        self.cachedArchivedCoupons = {}
+        # IDs of coupons which could not be found in archive DB -> Only valid as long as couponsVersion doesn't change
+        self.cachedArchiveMisses = set()
+        self.cachedArchiveMissesCouponsVersion = 0
+        # Name of startup step -> Duration in seconds, see --profile-startup of the bot
+        self.startupDurations = {}
         # Create required DBs
-        if DATABASES.INFO_DB not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.INFO_DB)
-            infoDB = self.couchdb.create(DATABASES.INFO_DB)
-        else:
-            infoDB = self.couchdb[DATABASES.INFO_DB]
+        timestampStart = time.perf_counter()
+        self.createMissingDBs()
+        infoDB = self.couchdb[DATABASES.INFO_DB]
         # Special case: Not only do we need to make sure that this DB exists but also need to add this special doc
         if DATABASES.INFO_DB not in infoDB:
             infoDoc = InfoEntry(id=DATABASES.INFO_DB)
-            infoDoc.store(self.couchdb[DATABASES.INFO_DB])
-        if DATABASES.TELEGRAM_USERS not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.TELEGRAM_USERS)
-            self.couchdb.create(DATABASES.TELEGRAM_USERS)
-        if DATABASES.COUPONS not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.COUPONS)
-            self.couchdb.create(DATABASES.COUPONS)
-        if DATABASES.OFFERS not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.OFFERS)
-            self.couchdb.create(DATABASES.OFFERS)
-        if DATABASES.COUPONS_HISTORY not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.COUPONS_HISTORY)
-            self.couchdb.create(DATABASES.COUPONS_HISTORY)
-        if DATABASES.COUPONS_HISTORY_SIMPLE not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.COUPONS_HISTORY_SIMPLE)
-            self.couchdb.create(DATABASES.COUPONS_HISTORY_SIMPLE)
-        if DATABASES.PRODUCTS not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.PRODUCTS)
-            self.couchdb.create(DATABASES.PRODUCTS)
-        if DATABASES.PRODUCTS_HISTORY not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.PRODUCTS_HISTORY)
-            self.couchdb.create(DATABASES.PRODUCTS_HISTORY)
-        if DATABASES.PRODUCTS2_HISTORY not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.PRODUCTS2_HISTORY)
-            self.couchdb.create(DATABASES.PRODUCTS2_HISTORY)
-        if DATABASES.TELEGRAM_CHANNEL not in self.couchdb:
-            logging.info("Creating missing DB: " + DATABASES.TELEGRAM_CHANNEL)
-            self.couchdb.create(DATABASES.TELEGRAM_CHANNEL)
+            infoDoc.store(infoDB)
+        self.startupDurations['DB bootstrap'] = time.perf_counter() - timestampStart
         # Test 2022-06-05 to find invalid datasets
         # userDB = self.couchdb[DATABASES.TELEGRAM_USERS]
         # if os.path.exists('telegram_users.json'):
@@ -157,12 +160,27 @@ class BKCrawler:
             logging.info("Creating missing filepath: " + getPathImagesProducts())
             os.makedirs(getPathImagesProducts())
         # Do this here so manually added coupons will get added on application start without extra crawl process
+        timestampStart = time.perf_counter()
         self.migrateDBs()
+        self.startupDurations['DB migrations'] = time.perf_counter() - timestampStart
+        timestampStart = time.perf_counter()
         self.addExtraCoupons(crawledCouponsDict={}, immediatelyAddToDB=True)
+        self.startupDurations['Extra coupons'] = time.perf_counter() - timestampStart
         # Make sure that our cache gets filled on init
-        couponDB = self.getCouponDB()
-        self.updateCaches(couponDB)
-        self.updateCachedMissingPaperCouponsInfo(couponDB)
+        timestampStart = time.perf_counter()
+        self.updateCaches(self.getCouponDB())
+        self.startupDurations['Load caches'] = time.perf_counter() - timestampStart
+
+    def createMissingDBs(self):
+        """ Checks which DBs exist with one request and creates missing ones in parallel. """
+        existingDBs = set(self.couchdb)
+        missingDBs = [dbName for dbName in REQUIRED_DATABASES if dbName not in existingDBs]
+        if len(missingDBs) == 0:
+            return
+        logging.info(f'Creating missing DBs: {missingDBs}')
+        with ThreadPoolExecutor(max_workers=len(missingDBs)) as executor:
+            # list() to raise exceptions of failed creates
+            list(executor.map(self.couchdb.create, missingDBs))
 
     def setKeepHistoryDB(self, keepHistory: bool):
         """ Enable this if you want the crawler to maintain a history of past coupons/offers and update it on every crawl process. """
@@ -209,8 +227,15 @@ class BKCrawler:
 
     def migrateDBs(self):
         """ Migrate DBs from old to new version - leave this function empty if there is nothing to migrate. """
-        # logging.info("Migrating DBs...")
-        # logging.info("Migrate DBs done")
+        infoDB = self.getInfoDB()
+        infoDoc = InfoEntry.load(infoDB, DATABASES.INFO_DB)
+        if infoDoc.databaseVersion < 1:
+            # 2026-10-19: Move coupon copies out of user documents into coupon archive DB
+            logging.info("Migrating DBs to version 1...")
+            self.migrateUserFavoritesToCouponArchive()
+            infoDoc.databaseVersion = 1
+            infoDoc.store(infoDB)
+            logging.info("Migrate DBs done")
         migrationActionRequired = False
         if not migrationActionRequired:
             return
@@ -232,178 +257,76 @@ class BKCrawler:
         # timestamp migration/introduction 2022-07-20
         return
 
-    def crawlAndProcessData(self):
-        """ One function that does it all! Execute this every time you run the crawler. """
+    def migrateUserFavoritesToCouponArchive(self):
+        """ Replaces full coupon copies stored as favorites in user documents with references to coupons in the archive DB. """
+        archiveDB = self.getCouponArchiveDB()
+        couponDB = self.getCouponDB()
+        archivedCoupons = {}
+        for couponID in couponDB:
+            archivedCoupons[couponID] = Coupon.load(couponDB, couponID)
+        userDB = self.getUserDB()
+        userUpdates = []
+        for userID in userDB:
+            user = User.load(userDB, userID)
+            needsUpdate = False
+            for couponID, favorite in list(user.favoriteCoupons.items()):
+                if not isLegacyFavorite(favorite):
+                    continue
+                coupon = getCouponFromFavorite(couponID, favorite)
+                if couponID not in archivedCoupons:
+                    archivedCoupons[couponID] = coupon
+                user.addFavoriteCoupon(coupon)
+                needsUpdate = True
+            if needsUpdate:
+                userUpdates.append(user)
+        self.updateCouponArchive(list(archivedCoupons.values()))
+        logging.info(f'Migrated favorites of {len(userUpdates)} users | Coupons in archive: {len(archiveDB)}')
+        if len(userUpdates) > 0:
+            userDB.update(userUpdates)
+
+    def crawlAndProcessData(self, updateCaches: bool = True, progressCallback: Union[Callable[[str], None], None] = None):
+        """ One function that does it all! Execute this every time you run the crawler.
+        :param updateCaches: Set this to False if caches shall be updated by the caller e.g. because crawler is running in a worker thread. See prepareCacheUpdate.
+        :param progressCallback: Gets called with a short description of the current step.
+        """
         try:
             timestampStart = datetime.now().timestamp()
+            if progressCallback is not None:
+                progressCallback('Crawling coupons')
             self.crawl()
             if self.exportCSVs:
                 self.couponCsvExport()
                 self.couponCsvExport2()
+            if progressCallback is not None:
+                progressCallback('Downloading images and creating QR codes')
             self.downloadProductiveCouponDBImagesAndCreateQRCodes()
             # self.checkProductiveCouponsDBImagesIntegrity()
             # self.checkProductiveOffersDBImagesIntegrity()
             logging.info("Total crawl duration: " + getFormattedPassedTime(timestampStart))
         finally:
-            self.updateCaches(couponDB=self.getCouponDB(), offerDB=self.getOfferDB())
+            if updateCaches:
+                self.updateCaches(couponDB=self.getCouponDB(), offerDB=self.getOfferDB(), changedCouponIDs=self.popChangedCouponIDs())
+
+    def popChangedCouponIDs(self) -> Set[str]:
+        """ Returns IDs of all coupons which have been changed in DB since the last call of this. """
+        changedCouponIDs = self.changedCouponIDs
+        self.changedCouponIDs = set()
+        return changedCouponIDs
 
     def crawlCoupons(self, crawledCouponsDict: dict):
         """ Crawls coupons from App API.
          """
         timestampCrawlStart = datetime.now().timestamp()
-        # Docs: https://czqk28jt.apicdn.sanity.io/v1/graphql/prod_bk_de/default
-        # Official live instance: https://www.burgerking.de/rewards/offers
-        # Old one: https://euc1-prod-bk.rbictg.com/graphql
-        req = httpx.get(
-            url='https://czqk28jt.apicdn.sanity.io/v1/graphql/prod_bk_de/default?operationName=featureSortedLoyaltyOffers&variables=%7B%22id%22%3A%22feature-loyalty-offers-ui-singleton%22%7D&query=query+featureSortedLoyaltyOffers%28%24id%3AID%21%29%7BLoyaltyOffersUI%28id%3A%24id%29%7B_id+sortedSystemwideOffers%7B...SystemwideOffersFragment+__typename%7D__typename%7D%7Dfragment+SystemwideOffersFragment+on+SystemwideOffer%7B_id+_type+loyaltyEngineId+name%7BlocaleRaw%3AdeRaw+__typename%7Ddescription%7BlocaleRaw%3AdeRaw+__typename%7DmoreInfo%7BlocaleRaw%3AdeRaw+__typename%7DhowToRedeem%7BenRaw+__typename%7DbackgroundImage%7B...MenuImageFragment+__typename%7DshortCode+mobileOrderOnly+redemptionMethod+daypart+redemptionType+upsellOptions%7B_id+loyaltyEngineId+description%7BlocaleRaw%3AdeRaw+__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7Dname%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DofferPrice+marketPrice%7B...on+Item%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D...on+Combo%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7DuiPattern+lockedOffersPanel%7BcompletedChallengeHeader%7BlocaleRaw%3AdeRaw+__typename%7DcompletedChallengeDescription%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DpromoCodePanel%7BpromoCodeDescription%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLabel%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLink+__typename%7Dincentives%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DisOfferBenefit+__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D...on+Picker%7B_id+_type+options%7Boption%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7D__typename%7D%7D__typename%7DisOfferBenefit+__typename%7D...on+OfferDiscount%7B_id+_type+discountValue+discountType+__typename%7D...on+OfferActivation%7B_id+_type+__typename%7D...on+SwapMapping%7B_type+__typename%7D%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7Drules%7B...on+RequiresAuthentication%7BrequiresAuthentication+__typename%7D...on+LoyaltyBetweenDates%7BstartDate+endDate+__typename%7D__typename%7D__typename%7Dfragment+MenuImageFragment+on+Image%7Bhotspot%7Bx+y+height+width+__typename%7Dcrop%7Btop+bottom+left+right+__typename%7Dasset%7Bmetadata%7Blqip+palette%7Bdominant%7Bbackground+foreground+__typename%7D__typename%7D__typename%7D_id+__typename%7D__typename%7Dfragment+MenuImagesFragment+on+Images%7Bapp%7B...MenuImageFragment+__typename%7Dkiosk%7B...MenuImageFragment+__typename%7DimageDescription+__typename%7Dfragment+VendorConfigsFragment+on+VendorConfigs%7Bcarrols%7B...VendorConfigFragment+__typename%7DcarrolsDelivery%7B...VendorConfigFragment+__typename%7Dncr%7B...VendorConfigFragment+__typename%7DncrDelivery%7B...VendorConfigFragment+__typename%7Doheics%7B...VendorConfigFragment+__typename%7DoheicsDelivery%7B...VendorConfigFragment+__typename%7Dpartner%7B...VendorConfigFragment+__typename%7DpartnerDelivery%7B...VendorConfigFragment+__typename%7DproductNumber%7B...VendorConfigFragment+__typename%7DproductNumberDelivery%7B...VendorConfigFragment+__typename%7Dsicom%7B...VendorConfigFragment+__typename%7DsicomDelivery%7B...VendorConfigFragment+__typename%7Dqdi%7B...VendorConfigFragment+__typename%7DqdiDelivery%7B...VendorConfigFragment+__typename%7Dqst%7B...VendorConfigFragment+__typename%7DqstDelivery%7B...VendorConfigFragment+__typename%7Drpos%7B...VendorConfigFragment+__typename%7DrposDelivery%7B...VendorConfigFragment+__typename%7DsimplyDelivery%7B...VendorConfigFragment+__typename%7DsimplyDeliveryDelivery%7B...VendorConfigFragment+__typename%7Dtablet%7B...VendorConfigFragment+__typename%7DtabletDelivery%7B...VendorConfigFragment+__typename%7D__typename%7Dfragment+VendorConfigFragment+on+VendorConfig%7BpluType+parentSanityId+pullUpLevels+constantPlu+discountPlu+quantityBasedPlu%7Bquantity+plu+qualifier+__typename%7DmultiConstantPlus%7Bquantity+plu+qualifier+__typename%7DparentChildPlu%7Bplu+childPlu+__typename%7DsizeBasedPlu%7BcomboPlu+comboSize+__typename%7D__typename%7D',
-            headers=HEADERS, timeout=120)
-        print(req.text)
-        apiResponse = req.json()
-        if self.storeCouponAPIDataAsJson:
-            # Save API response so we can easily use this data for local testing later on.
-            saveJson('crawler/coupons1.json', apiResponse)
-        couponArrayBK = apiResponse['data']['LoyaltyOffersUI']['sortedSystemwideOffers']
         appCoupons = []
         appCouponsNotYetActive = []
-        for couponBKTmp in couponArrayBK:
-            bkCoupons = [couponBKTmp]
-            # Collect hidden coupons
-            upsellOptions = couponBKTmp.get('upsellOptions')
-            if upsellOptions is not None:
-                for upsellOption in upsellOptions:
-                    upsellID = upsellOption.get('_id')
-                    upsellType = upsellOption.get('_type')
-                    upsellShortCode = upsellOption.get('shortCode')
-                    if upsellType != 'offer' or upsellShortCode is None:
-                        # Skip invalid items: This should never happen
-                        logging.info(f"Found invalid/unsupported upsell object: {upsellID=}")
-                        continue
-                    bkCoupons.append(upsellOption)
-            index = 0
-            for couponBK in bkCoupons:
-                uniqueCouponID = couponBK['vendorConfigs']['rpos']['constantPlu']
-                legacyInternalName = couponBK.get('internalName')
-                # Find coupon-title. Prefer to get it from 'internalName' as the other title may contain crap we don't want.
-                # 2022-11-02: Prefer normal titles again because internal ones are sometimes incomplete
-                useInternalNameAsTitle = False
-                legacyInternalNameRegex = None
-                if legacyInternalName is not None:
-                    legacyInternalNameRegex = re.compile(r'[A-Za-z0-9]+_\d+_(?:UPSELL_|CRM_MYBK_|MYBK_|\d{3,}_)?(.+)').search(legacyInternalName)
-                subtitle = None
-                try:
-                    subtitle = couponBK['description']['localeRaw'][0]['children'][0]['text']
-                except:
-                    pass
-                if legacyInternalNameRegex is not None and useInternalNameAsTitle:
-                    titleFull = legacyInternalNameRegex.group(1)
-                    titleFull = titleFull.replace('_', ' ')
-                else:
-                    """ Decide how to use title and subtitle and if it makes sense to put both into one string. """
-                    title = couponBK['name']['localeRaw'][0]['children'][0]['text']
-                    title = title.strip()
-                    if subtitle is None:
-                        titleFull = title
-                    else:
-                        subtitle = subtitle.strip()
-                        titleShortened = shortenProductNames(title)
-                        subtitleShortened = shortenProductNames(subtitle)
-                        if len(subtitleShortened) == 0 or subtitleShortened.isspace():
-                            # Useless subtitle -> Use title only
-                            titleFull = title
-                        elif len(titleShortened) == 0 or titleShortened.isspace():
-                            # Useless title -> Use subtitle only
-                            titleFull = subtitle
-                        elif titleShortened == subtitleShortened:  # Small hack: Shorten titles before comparing them
-                            # Title and subtitle are the same -> Use title only
-                            titleFull = title
-                        else:
-                            # Assume that subtitle is usable and put both together
-                            titleFull = title + ' ' + subtitle
-                            # Log seemingly strange values
-                            if not subtitle.startswith('+'):
-                                logging.info(f'Coupon {uniqueCouponID}: Possible subtitle which should not be included in coupon title: {subtitle=} | {title=} | {titleFull=}')
-
-                titleFull = sanitizeCouponTitle(titleFull)
-                price = couponBK['offerPrice']
-                plu = couponBK['shortCode']
-                coupon = Coupon(id=uniqueCouponID, uniqueID=uniqueCouponID, plu=plu, title=titleFull, subtitle=subtitle, titleShortened=shortenProductNames(titleFull),
-                                type=CouponType.APP)
-                coupon.webviewID = couponBK.get('loyaltyEngineId')
-                # TODO: Check where those tags are located in new API endpoint
-                offerTags = couponBK.get('offerTags')
-                if offerTags is not None and len(offerTags) > 0:
-                    # 2023-01-09: Looks like this field doesn't exist anymore
-                    tagsStringArray = []
-                    for offerTag in offerTags:
-                        tagsStringArray.append(offerTag['value'])
-                    coupon.tags = tagsStringArray
-                if index > 0:
-                    # First item = Real coupon, all others = upsell/"hidden" coupon(s)
-                    coupon.isHidden = True
-                if price == 0:
-                    # Special detection for some 50%/2for1 coupons that are listed with price == 0€
-                    if titleFull.startswith('2'):
-                        # E.g. 2 Crispy Chicken
-                        coupon.staticReducedPercent = 50
-                    else:
-                        # While it is super unlikely let's allow BK to provide coupons for free products :)
-                        coupon.price = 0
-                else:
-                    coupon.price = price
-                # Build URL to coupon product image
-                imageurl = couponBK['localizedImage']['locale']['app']['asset']['_id']
-                imageurl = "https://cdn.sanity.io/images/czqk28jt/prod_bk_de/" + imageurl.replace('image-', '')
-                imageurl = imageurl.replace('-png', '.png')
-                coupon.imageURL = imageurl
-                """ Find and set start- and expire-date.
-                 """
-                datetimeExpire1 = None
-                datetimeExpire2 = None
-                datetimeStart = None
-                try:
-                    footnote = couponBK['moreInfo']['localeRaw'][0]['children'][0]['text']
-                    expiredateRegex = re.compile(r'(?i)Abgabe bis (\d{1,2}\.\d{1,2}\.\d{4})').search(footnote)
-                    if expiredateRegex is not None:
-                        expiredateStr = expiredateRegex.group(1) + ' 23:59:59'
-                        datetimeExpire1 = datetime.strptime(expiredateStr, '%d.%m.%Y %H:%M:%S')
-                except:
-                    # Dontcare
-                    logging.warning('Failed to find BetterExpiredate for coupon: ' + coupon.id)
-                rulesHere = couponBK.get('rules')
-                if rulesHere is not None:
-                    rulesAll = []
-                    for ruleSet in rulesHere:
-                        ruleSetsChilds = ruleSet.get('rules')
-                        if ruleSetsChilds is not None:
-                            for ruleSetsChild in ruleSetsChilds:
-                                rulesAll.append(ruleSetsChild)
-                        else:
-                            rulesAll.append(ruleSet)
-                    dateformatStart = '%Y-%m-%d'
-                    dateformatEnd = '%Y-%m-%d %H:%M:%S'
-                    for rule in rulesAll:
-                        if rule['__typename'] == 'LoyaltyBetweenDates':
-                            datetimeStart = datetime.strptime(rule['startDate'], dateformatStart)
-                            datetimeExpire2 = datetime.strptime(rule['endDate'] + ' 23:59:59', dateformatEnd)
-                            break
-                else:
-                    logging.info(f'Coupon without rules field: {coupon.id}')
-                if datetimeExpire1 is None and datetimeExpire2 is None:
-                    # This should never happen
-                    logging.warning(f'WTF failed to find any expiredate for coupon: {uniqueCouponID}')
-                elif datetimeExpire1 is not None:
-                    # Prefer this expiredate
-                    coupon.timestampExpire = datetimeExpire1.timestamp()
-                else:
-                    coupon.timestampExpire = datetimeExpire2.timestamp()
-                if datetimeStart is not None:
-                    coupon.timestampStart = datetimeStart.timestamp()
-                crawledCouponsDict[uniqueCouponID] = coupon
-                appCoupons.append(coupon)
-                if datetimeStart is not None and datetimeStart > datetime.now():
-                    appCouponsNotYetActive.append(coupon)
-                index += 1
-
+        timestampNow = datetime.now().timestamp()
+        pipeline = getAppCouponParsePipeline()
+        for context in pipeline.runBatch(iterateAppCouponsBK(self.iterateSystemwideOffers())):
+            coupon = context.coupon
+            crawledCouponsDict[coupon.id] = coupon
+            appCoupons.append(coupon)
+            if coupon.timestampStart is not None and coupon.timestampStart > timestampNow:
+                appCouponsNotYetActive.append(coupon)
         logging.info(f'Coupons in app total: {len(appCoupons)}')
         logging.info(f'Coupons in app not yet active: {len(appCouponsNotYetActive)}')
         if len(appCouponsNotYetActive) > 0:
@@ -411,8 +334,44 @@ class BKCrawler:
             for coupon in appCouponsNotYetActive:
                 logging.info(coupon)
             logging.info(getLogSeparatorString())
+        logging.info(f'Coupon parsing stages:\n{pipeline.getStatsLogText()}')
         logging.info(f'Total coupons crawl time: {getFormattedPassedTime(timestampCrawlStart)}')
 
+    def iterateSystemwideOffers(self):
+        """ Yields all 'SystemwideOffer' objects of the app coupon API one by one.
+         If possible, the response is parsed incrementally while it is being downloaded so the complete response never needs to be kept in memory. """
+        # Docs: https://czqk28jt.apicdn.sanity.io/v1/graphql/prod_bk_de/default
+        # Official live instance: https://www.burgerking.de/rewards/offers
+        # Old one: https://euc1-prod-bk.rbictg.com/graphql
+        if ijson is None or self.storeCouponAPIDataAsJson:
+            # Streaming not possible -> Load complete response at once
+            req = httpx.get(url=URL_COUPONS_API, headers=HEADERS, timeout=120)
+            req.raise_for_status()
+            apiResponse = req.json()
+            if self.storeCouponAPIDataAsJson:
+                # Save API response so we can easily use this data for local testing later on.
+                saveJson('crawler/coupons1.json', apiResponse)
+            systemwideOffers = apiResponse['data']['LoyaltyOffersUI']['sortedSystemwideOffers']
+            numberofOffers = len(systemwideOffers)
+            yield from systemwideOffers
+        else:
+            with httpx.stream(method='GET', url=URL_COUPONS_API, headers=HEADERS, timeout=120) as response:
+                response.raise_for_status()
+                systemwideOffers = ijson.sendable_list()
+                parser = ijson.items_coro(systemwideOffers, 'data.LoyaltyOffersUI.sortedSystemwideOffers.item', use_float=True)
+                numberofOffers = 0
+                for chunk in response.iter_bytes():
+                    parser.send(chunk)
+                    numberofOffers += len(systemwideOffers)
+                    yield from systemwideOffers
+                    del systemwideOffers[:]
+                parser.close()
+                numberofOffers += len(systemwideOffers)
+                yield from systemwideOffers
+        if numberofOffers == 0:
+            # e.g. error response or changed API structure: Never continue with zero coupons as this would delete all app coupons from DB
+            raise Exception('Coupon API response does not contain any offers at data.LoyaltyOffersUI.sortedSystemwideOffers')
+
     def addExtraCoupons(self, crawledCouponsDict: dict, immediatelyAddToDB: bool):
         """ Adds extra coupons which have been manually added to config_extra_coupons.json.
          This will only add VALID coupons to DB! """
@@ -432,11 +391,12 @@ class BKCrawler:
 
     def getValidExtraCoupons(self) -> dict:
         PaperCouponHelper.main()
-        extraCouponData = loadJson(Paths.extraCouponConfigPath)
+        extraCouponData = loadJsonCached(Paths.extraCouponConfigPath)
         extraCouponsJson = extraCouponData["extra_coupons"]
         validExtraCoupons = {}
         for extraCouponJson in extraCouponsJson:
-            coupon = Coupon.wrap(extraCouponJson)
+            # Loaded config is shared -> Coupons must not modify it
+            coupon = Coupon.wrap(copy.deepcopy(extraCouponJson))
             coupon.id = coupon.uniqueID  # Set custom uniqueID otherwise couchDB will create one later -> This is not what we want to happen!!
             expiredateStr = extraCouponJson["expire_date"] + " 23:59:59"
             expiredate = datetime.strptime(expiredateStr, '%Y-%m-%d %H:%M:%S').astimezone(getTimezone())
@@ -467,11 +427,12 @@ class BKCrawler:
         # Get rid of invalid coupons so we won't even bother adding them to our DB.
         notYetActiveCoupons = []
         expiredCoupons = []
+        now = getCurrentTimestamp()
         for coupon in crawledCouponsDict.values():
-            if coupon.isExpired():
+            if coupon.isExpired(now):
                 expiredCoupons.append(coupon)
             else:
-                if coupon.isNotYetActive():
+                if coupon.isNotYetActive(now):
                     notYetActiveCoupons.append(coupon)
                 couponsToAddToDB[coupon.id] = coupon
         if len(notYetActiveCoupons) > 0 or len(expiredCoupons) > 0:
@@ -513,11 +474,12 @@ class BKCrawler:
                 #         # Coupon hasn't been in API for at least 3 days -> Delete it
                 #         deleteCouponDocs[uniqueCouponID] = dbCoupon
                 deleteCouponDocs[uniqueCouponID] = dbCoupon
-            elif crawledCoupon.isExpired():
+            elif crawledCoupon.isExpired(now):
                 # Coupon is in DB and in crawled coupons but is expired -> Delete from DB
                 deleteCouponDocs[uniqueCouponID] = dbCoupon
         if len(deleteCouponDocs) > 0:
             couponDB.purge(deleteCouponDocs.values())
+            self.changedCouponIDs.update(deleteCouponDocs.keys())
         # Update timestamp of last complete run in DB
         infoDBDoc.dateLastSuccessfulCrawlRun = datetime.now()
         infoDBDoc.store(infoDatabase)
@@ -656,6 +618,7 @@ class BKCrawler:
                 """ Update coupon in DB with new info. Only do this if we safely found all items AND they haven't been added already. """
                 coupon.productIDs = foundProductIDsMap
                 coupon.store(couponDB)
+                self.changedCouponIDs.add(coupon.id)
         logging.info('ProductID parser done')
 
     def couponCsvExport(self):
@@ -694,38 +657,94 @@ class BKCrawler:
                                  'Ablaufdatum': coupon.getExpireDateFormatted()
                                  })
 
-    def updateCaches(self, couponDB: Database, offerDB: Database = None):
+    def updateCaches(self, couponDB: Database, offerDB: Database = None, changedCouponIDs: Union[Set[str], None] = None):
         """ Updates cache containing all existent coupon sources e.g. used be the Telegram bot to display them inside
-        main menu without having to do any DB requests. """
-        # Nullification
-        self.cachedFutureCouponsText = None
-        self.cachedFutureCoupons.clear()
-        # End of nullification
+        main menu without having to do any DB requests.
+        If changedCouponIDs are given, only those coupons get reloaded from DB. Otherwise, all coupons get reloaded. """
+        self.applyCacheUpdate(self.prepareCacheUpdate(couponDB=couponDB, offerDB=offerDB, changedCouponIDs=changedCouponIDs))
+
+    def prepareCacheUpdate(self, couponDB: Database, offerDB: Database = None, changedCouponIDs: Union[Set[str], None] = None) -> 'CacheUpdate':
+        """ Loads everything needed to update the caches from DB without modifying the caches.
+         This can run in a worker thread while the caches are still in use, see applyCacheUpdate. """
+        couponRecords = None
+        deletedCouponIDs = None
+        if changedCouponIDs is None:
+            couponRecords = {}
+            # Load all coupons with one request
+            for row in couponDB.view('_all_docs', include_docs=True):
+                if row.id.startswith('_design/'):
+                    continue
+                couponRecords[row.id] = CouponRecord.fromCoupon(Coupon.wrap(row.doc))
+        elif len(changedCouponIDs) > 0:
+            # Only load changed coupons: They get merged into the then current cache in applyCacheUpdate
+            couponRecords = {}
+            deletedCouponIDs = set()
+            for row in couponDB.view('_all_docs', keys=list(changedCouponIDs), include_docs=True):
+                if row.doc is None:
+                    # Coupon has been deleted
+                    deletedCouponIDs.add(row.key)
+                else:
+                    couponRecords[row.id] = CouponRecord.fromCoupon(Coupon.wrap(row.doc))
+            logging.info(f'Loaded {len(changedCouponIDs)} changed coupons')
+        numberofAvailableOffers = None
+        if offerDB is not None:
+            numberofAvailableOffers = len(loadValidOffers(offerDB))
+        return CacheUpdate(couponRecords=couponRecords, numberofAvailableOffers=numberofAvailableOffers, changedCouponIDs=changedCouponIDs,
+                           deletedCouponIDs=deletedCouponIDs)
+
+    def applyCacheUpdate(self, cacheUpdate: 'CacheUpdate'):
+        """ Updates caches with the given data. Does not do any DB requests.
+         Call this from the thread which uses the caches (e.g. the event loop of the bot) so nobody sees partially updated caches.
+         Changed coupons get merged into the cache as it is at this moment so cache updates which have been applied in the meantime don't get lost. """
+        if cacheUpdate.couponRecords is not None:
+            if cacheUpdate.changedCouponIDs is None:
+                self.setCachedCouponRecords(cacheUpdate.couponRecords)
+            else:
+                newCachedCouponRecords = dict(self.cachedCouponRecords)
+                newCachedCouponRecords.update(cacheUpdate.couponRecords)
+                for couponID in cacheUpdate.deletedCouponIDs:
+                    newCachedCouponRecords.pop(couponID, None)
+                self.setCachedCouponRecords(newCachedCouponRecords)
+                logging.info(f'Updated {len(cacheUpdate.changedCouponIDs)} cached coupons')
+        if cacheUpdate.numberofAvailableOffers is not None:
+            self.cachedNumberofAvailableOffers = cacheUpdate.numberofAvailableOffers
+
+    def setCachedCouponRecords(self, cachedCouponRecords: Dict[str, CouponRecord]):
+        """ Replaces cached coupons and updates all caches derived from them. """
+        self.cachedCouponRecords = cachedCouponRecords
+        self.cachedDuplicateIndex = CouponDuplicateIndex(cachedCouponRecords)
+        self.updateCouponStateCaches()
+        self.updateCachedMissingPaperCouponsInfo()
+
+    def updateCouponStateCaches(self, now: Union[float, None] = None):
+        """ Updates caches which depend on whether cached coupons are active/expired at the given point in time. """
+        if now is None:
+            now = getCurrentTimestamp()
         newCachedAvailableCouponCategories = {}
         futureCoupons = []
-        for couponID in couponDB:
-            coupon = Coupon.load(couponDB, couponID)
-            if coupon.isValid():
+        timestampNextCouponTransition = None
+        for coupon in self.cachedCouponRecords.values():
+            if coupon.isValid(now):
                 category = newCachedAvailableCouponCategories.setdefault(coupon.type, CouponCategory(
                     coupons=coupon.type))
-                category.updateWithCouponInfo(coupon)
-            elif coupon.isNotYetActive():
+                category.updateWithCouponInfo(coupon, now=now)
+            elif coupon.isNotYetActive(now):
                 futureCoupons.append(coupon)
+            # Collect next point in time at which this coupon becomes active or expires
+            for timestamp in (coupon.timestampStart, coupon.timestampExpire):
+                if timestamp is not None and timestamp > now and (timestampNextCouponTransition is None or timestamp < timestampNextCouponTransition):
+                    timestampNextCouponTransition = timestamp
         # Overwrite old cache
         self.cachedAvailableCouponCategories = newCachedAvailableCouponCategories
         self.cachedFutureCoupons = sorted(futureCoupons,
-                                   key=lambda x: 0 if x.getStartDatetime() is None else x.getStartDatetime().timestamp())
-        if offerDB is not None:
-            validOffers = []
-            for offerID in offerDB:
-                offer = offerDB[offerID]
-                if offerIsValid(offer):
-                    validOffers.append(offer)
-            self.cachedNumberofAvailableOffers = len(validOffers)
-        self.updateCachedMissingPaperCouponsInfo(couponDB=couponDB)
+                                          key=lambda x: 0 if x.getStartDatetime() is None else x.getStartDatetime().timestamp())
+        self.timestampNextCouponTransition = timestampNextCouponTransition
+        # Validity of coupons may have changed -> Everything derived from cached coupons is outdated
+        self.couponsVersion += 1
+        cachedFutureCouponsText = None
         if len(self.cachedFutureCoupons) > 0:
             # Sort coupons by "release date"
-            self.cachedFutureCouponsText = f"<b>{SYMBOLS.WHITE_DOWN_POINTING_BACKHAND}Demnächst verfügbare Coupons{SYMBOLS.WHITE_DOWN_POINTING_BACKHAND}</b>"
+            cachedFutureCouponsText = f"<b>{SYMBOLS.WHITE_DOWN_POINTING_BACKHAND}Demnächst verfügbare Coupons{SYMBOLS.WHITE_DOWN_POINTING_BACKHAND}</b>"
             for futureCoupon in self.cachedFutureCoupons:
                 datetimeCouponAvailable = futureCoupon.getStartDatetime()
                 if datetimeCouponAvailable is not None:
@@ -734,18 +753,30 @@ class BKCrawler:
                     startDateFormatted = "?"
                 couponDescr = futureCoupon.generateCouponShortText(highlightIfNew=False, includeVeggieSymbol=True)
                 thisCouponText = f"<b>{startDateFormatted}</b> | " + couponDescr
-                self.cachedFutureCouponsText += "\n" + thisCouponText
+                cachedFutureCouponsText += "\n" + thisCouponText
+        self.cachedFutureCouponsText = cachedFutureCouponsText
+
+    def refreshCachesIfCouponTransitionIsDue(self, now: Union[float, None] = None) -> bool:
+        """ Updates time dependent caches if at least one cached coupon has become active or expired since the last update.
+         Returns True if caches have been updated. """
+        if now is None:
+            now = getCurrentTimestamp()
+        if self.timestampNextCouponTransition is None or now < self.timestampNextCouponTransition:
+            return False
+        logging.info('Refreshing caches because coupons became active/expired')
+        self.updateCouponStateCaches(now=now)
+        return True
 
-    def updateCachedMissingPaperCouponsInfo(self, couponDB: Database):
+    def updateCachedMissingPaperCouponsInfo(self):
         paperCouponMapping = getCouponMappingForCrawler()
         self.cachedMissingPaperCouponsText = None
         missingPaperPLUs = []
         for mappingCoupon in paperCouponMapping.values():
-            if mappingCoupon.id not in couponDB:
+            if mappingCoupon.id not in self.cachedCouponRecords:
                 missingPaperPLUs.append(mappingCoupon.plu)
         missingPaperPLUs.sort()
+        self.missingPaperCouponPLUs = missingPaperPLUs
         if len(missingPaperPLUs) > 0:
-            self.missingPaperCouponPLUs = missingPaperPLUs
             for missingPLU in missingPaperPLUs:
                 if self.cachedMissingPaperCouponsText is None:
                     self.cachedMissingPaperCouponsText = missingPLU
@@ -804,6 +835,8 @@ class BKCrawler:
         numberofCouponsUpdated = 0
         numberofCouponsFlaggedAsNew = 0
         for crawledCoupon in couponsToAddToDB:
+            # Derived fields are part of the coupon version -> Changes of them will also lead to DB updates
+            crawledCoupon.updateDerivedFields()
             existingCoupon = Coupon.load(couponDB, crawledCoupon.id)
             # Update DB
             if existingCoupon is not None:
@@ -833,6 +866,8 @@ class BKCrawler:
                 newCouponIDs.append(crawledCoupon.id)
         logging.info(f'Pushing {len(dbUpdates)} coupon DB updates')
         couponDB.update(dbUpdates)
+        self.changedCouponIDs.update(coupon.id for coupon in dbUpdates)
+        self.updateCouponArchive(dbUpdates)
         logging.info("Coupons new: " + str(numberofCouponsNew))
         if len(newCouponIDs) > 0:
             logging.info("New IDs: " + str(newCouponIDs))
@@ -857,6 +892,68 @@ class BKCrawler:
             # DB was not updated
             return False
 
+    def updateCouponArchive(self, coupons: List[Coupon]):
+        """ Stores the current version of all given coupons in the coupon archive DB.
+         The latest version of each coupon is stored under its ID, every version additionally under its own immutable version-ID (see getArchiveVersionID).
+         Coupons never get deleted from this DB so e.g. expired favorites of users can still be displayed. """
+        if len(coupons) == 0:
+            return
+        archiveDB = self.getCouponArchiveDB()
+        docIDs = []
+        for coupon in coupons:
+            docIDs.append(coupon.id)
+            docIDs.append(getArchiveVersionID(coupon))
+        # Get revisions of all existing docs with one request
+        existingRevs = {}
+        for row in archiveDB.view('_all_docs', keys=docIDs):
+            if row.get('value') is not None:
+                existingRevs[row.key] = row.value['rev']
+        archiveUpdates = []
+        for coupon in coupons:
+            archivedCoupon = Coupon.wrap(dict(coupon._data))
+            archivedCoupon._data.pop('_rev', None)
+            existingRev = existingRevs.get(coupon.id)
+            if existingRev is not None:
+                # Important: We need the "_rev" value to be able to update/overwrite existing documents!
+                archivedCoupon['_rev'] = existingRev
+            archiveUpdates.append(archivedCoupon)
+            versionID = getArchiveVersionID(coupon)
+            if versionID not in existingRevs:
+                # Versions never change once they're archived
+                archivedVersion = Coupon.wrap(dict(coupon._data))
+                archivedVersion._data.pop('_rev', None)
+                archivedVersion['_id'] = versionID
+                archiveUpdates.append(archivedVersion)
+            self.cachedArchivedCoupons.pop(coupon.id, None)
+            self.cachedArchiveMisses.discard(coupon.id)
+        archiveDB.update(archiveUpdates)
+
+    def getArchivedCoupons(self, couponIDs: Iterable[str]) -> Dict[str, CouponRecord]:
+        """ Returns the latest archived version of all given coupons which can be found in the coupon archive DB. """
+        if self.cachedArchiveMissesCouponsVersion != self.couponsVersion:
+            # Coupons may have been archived in the meantime
+            self.cachedArchiveMisses = set()
+            self.cachedArchiveMissesCouponsVersion = self.couponsVersion
+        archivedCoupons = {}
+        couponIDsToLoad = []
+        for couponID in couponIDs:
+            archivedCoupon = self.cachedArchivedCoupons.get(couponID)
+            if archivedCoupon is not None:
+                archivedCoupons[couponID] = archivedCoupon
+            elif couponID not in self.cachedArchiveMisses:
+                couponIDsToLoad.append(couponID)
+        if len(couponIDsToLoad) == 0:
+            return archivedCoupons
+        # Load all missing coupons with one request
+        for row in self.getCouponArchiveDB().view('_all_docs', include_docs=True, keys=couponIDsToLoad):
+            if row.doc is None:
+                self.cachedArchiveMisses.add(row.key)
+                continue
+            archivedCoupon = CouponRecord.fromCoupon(Coupon.wrap(row.doc))
+            self.cachedArchivedCoupons[row.key] = archivedCoupon
+            archivedCoupons[row.key] = archivedCoupon
+        return archivedCoupons
+
     def updateSimpleHistoryDB(self, couponDB: Database) -> bool:
         dbUpdates = []
         simpleHistoryDB = self.couchdb[DATABASES.COUPONS_HISTORY_SIMPLE]
@@ -880,22 +977,30 @@ class BKCrawler:
     def getCouponDB(self):
         return self.couchdb[DATABASES.COUPONS]
 
+    def getCouponArchiveDB(self):
+        return self.couchdb[DATABASES.COUPONS_ARCHIVE]
+
     def getOfferDB(self):
         return self.couchdb[DATABASES.OFFERS]
 
     def getUserDB(self):
         return self.couchdb[DATABASES.TELEGRAM_USERS]
 
+    def getConversationsDB(self):
+        return self.couchdb[DATABASES.TELEGRAM_CONVERSATIONS]
+
     def getInfoDB(self):
         return self.couchdb[DATABASES.INFO_DB]
 
     def getFilteredCouponsAsDict(
-            self, couponfilter: CouponFilter, sortIfSortCodeIsGivenInCouponFilter: bool = True
+            self, couponfilter: CouponFilter, sortIfSortCodeIsGivenInCouponFilter: bool = True, now: Union[float, None] = None
     ) -> dict:
         """ Use this to only get the coupons you want.
-         Returns all by default."""
+         Returns all by default.
+         :param now: Timestamp all coupons will be evaluated against. Current time if not given."""
         timestampStart = datetime.now().timestamp()
-        couponDB = self.getCouponDB()
+        if now is None:
+            now = getCurrentTimestamp()
         # if True:
         #     allCoupons = {}
         #     for couponID in couponDB:
@@ -909,12 +1014,11 @@ class BKCrawler:
         # Log if developer is trying to use incorrect filters
         if couponfilter.isVeggie is False and couponfilter.isPlantBased is True:
             logging.warning(f'Bad params: {couponfilter.isVeggie=} and {couponfilter.isPlantBased=}')
-        for uniqueCouponID in couponDB:
-            coupon = Coupon.load(couponDB, uniqueCouponID)
-            if couponfilter.activeOnly and not coupon.isValid():
+        for uniqueCouponID, coupon in self.cachedCouponRecords.items():
+            if couponfilter.activeOnly and not coupon.isValid(now):
                 # Skip expired coupons if needed
                 continue
-            elif couponfilter.isNotYetActive is not None and coupon.isNotYetActive() != couponfilter.isNotYetActive:
+            elif couponfilter.isNotYetActive is not None and coupon.isNotYetActive(now) != couponfilter.isNotYetActive:
                 continue
             elif couponfilter.allowedCouponTypes is not None and coupon.type not in couponfilter.allowedCouponTypes:
                 # Skip non-allowed coupon-types
@@ -922,7 +1026,7 @@ class BKCrawler:
             elif couponfilter.containsFriesAndCoke is not None and coupon.isContainsFriesAndDrink() != couponfilter.containsFriesAndCoke:
                 # Skip items if they do not have the expected "containsFriesOrCoke" state
                 continue
-            elif couponfilter.isNew is not None and coupon.isNewCoupon() != couponfilter.isNew:
+            elif couponfilter.isNew is not None and coupon.isNewCoupon(now) != couponfilter.isNew:
                 # Skip item if it does not have the expected "is_new" state
                 continue
             elif couponfilter.isHidden is not None and coupon.isHidden != couponfilter.isHidden:
@@ -937,22 +1041,22 @@ class BKCrawler:
                 desiredCoupons[uniqueCouponID] = coupon
         # Remove duplicates if needed and if it makes sense to attempt that
         if couponfilter.removeDuplicates is True and (couponfilter.allowedCouponTypes is None or (couponfilter.allowedCouponTypes is not None and len(couponfilter.allowedCouponTypes) > 1)):
-            desiredCoupons = removeDuplicatedCoupons(desiredCoupons)
+            desiredCoupons = removeDuplicatedCoupons(desiredCoupons, duplicateIndex=self.cachedDuplicateIndex)
         # Now check if the result shall be sorted
         if couponfilter.sortCode is not None and sortIfSortCodeIsGivenInCouponFilter:
             # Sort coupons: Separate by type and sort each by coupons with/without menu and price.
             # Make dict out of list
-            filteredAndSortedCouponsDict = sortCoupons(desiredCoupons, couponfilter.sortCode)
+            filteredAndSortedCouponsDict = sortCoupons(desiredCoupons, couponfilter.sortCode, now=now)
             logging.debug("Time it took to get- and sort coupons: " + getFormattedPassedTime(timestampStart))
             return filteredAndSortedCouponsDict
         else:
             return desiredCoupons
 
     def getFilteredCouponsAsList(
-            self, filters: CouponFilter, sortIfSortCodeIsGivenInCouponFilter: bool = True
-    ) -> List[Coupon]:
+            self, filters: CouponFilter, sortIfSortCodeIsGivenInCouponFilter: bool = True, now: Union[float, None] = None
+    ) -> List[CouponRecord]:
         """ Wrapper """
-        filteredCouponsDict = self.getFilteredCouponsAsDict(filters, sortIfSortCodeIsGivenInCouponFilter=sortIfSortCodeIsGivenInCouponFilter)
+        filteredCouponsDict = self.getFilteredCouponsAsDict(filters, sortIfSortCodeIsGivenInCouponFilter=sortIfSortCodeIsGivenInCouponFilter, now=now)
         return list(filteredCouponsDict.values())
 
     def getOffersActive(self) -> list:
@@ -960,13 +1064,30 @@ class BKCrawler:
         # 2023-03-18: There are no offers at this moment. What was an offer back then ("King of the month") has been moved into coupons now by BK.
         if True:
             return []
-        offerDB = self.getOfferDB()
-        offers = []
-        for offerID in offerDB:
-            offer = offerDB[offerID]
-            if offerIsValid(offer):
-                offers.append(offer)
-        return offers
+        return loadValidOffers(self.getOfferDB())
+
+
+class CacheUpdate:
+    """ Data loaded from DB to update the caches of the crawler. None = corresponding cache stays as it is. """
+
+    def __init__(self, couponRecords: Union[Dict[str, CouponRecord], None], numberofAvailableOffers: Union[int, None], changedCouponIDs: Union[Set[str], None] = None,
+                 deletedCouponIDs: Union[Set[str], None] = None):
+        # All coupons if changedCouponIDs is None, otherwise only the changed coupons which still exist
+        self.couponRecords = couponRecords
+        self.numberofAvailableOffers = numberofAvailableOffers
+        # IDs of the coupons which have changed. None = All coupons have been reloaded.
+        self.changedCouponIDs = changedCouponIDs
+        # IDs of changed coupons which have been deleted from DB
+        self.deletedCouponIDs = deletedCouponIDs
+
+
+def loadValidOffers(offerDB: Database) -> list:
+    """ Returns all offers that are not expired loaded with one request. """
+    offers = []
+    for row in offerDB.view('_all_docs', include_docs=True):
+        if not row.id.startswith('_design/') and offerIsValid(row.doc):
+            offers.append(row.doc)
+    return offers
 
 
 def getCouponByID(coupons: List[Coupon], couponID: str) -> Union[Coupon, None]:
@@ -977,6 +1098,12 @@ def getCouponByID(coupons: List[Coupon], couponID: str) -> Union[Coupon, None]:
     return None
 
 
+def getArchiveVersionID(coupon: Coupon) -> str:
+    """ Returns ID under which this version of the given coupon is stored in the coupon archive DB. """
+    timestampVersion = coupon.timestampLastModifiedDB or coupon.timestampAddedToDB or 0
+    return f'{coupon.id}:{int(timestampVersion)}'
+
+
 def hasChanged(originalData, newData, ignoreKeys=None) -> bool:
     """ Returns True if a key of newData is not on originalData or a value has changed. """
     if ignoreKeys is None:
@@ -1005,6 +1132,8 @@ def downloadImageIfNonExistant(url: str, path: str) -> bool:
             return False
         else:
             logging.info('Downloading image to: ' + path)
+            # Imported here as it is not needed for the bot to start
+            import requests
             r = requests.get(url, allow_redirects=True)
             open(path, mode='wb').write(r.content)
             # Check for broken image and delete it if broken
@@ -1025,6 +1154,8 @@ def generateQRImageIfNonExistant(qrCodeData: str, path: str) -> bool:
     if os.path.exists(path):
         return False
     else:
+        # Imported here as it is not needed for the bot to start
+        import qrcode
         qr = qrcode.QRCode(
             version=1,
             # 2021-05-02: This makes the image itself bigger but due to the border and the resize of Telegram, these QR codes might be suited better for usage in Telegram
@@ -0,0 +1,236 @@
+import logging
+import sys
+import time
+from datetime import datetime
+from typing import Union, List, Callable, Iterable
+
+from Helper import shortenProductNames, sanitizeCouponTitle, CouponType, formatSeconds
+from UtilsCouponsDB import Coupon
+from UtilsRegex import REGEX_APP_COUPON_INTERNAL_NAME, REGEX_APP_COUPON_FOOTNOTE_EXPIRE_DATE
+
+
+class CouponParseContext:
+    """ Holds all data of one raw coupon object while it is passing through the stages of a CouponParsePipeline. """
+
+    def __init__(self, couponBK: dict, isHidden: bool = False):
+        self.couponBK = couponBK
+        self.isHidden = isHidden
+        self.uniqueCouponID = None
+        self.title = None
+        self.subtitle = None
+        self.titleFull = None
+        self.datetimeStart = None
+        self.datetimeExpireFootnote = None
+        self.datetimeExpireRules = None
+        self.coupon: Union[Coupon, None] = None
+
+
+class PipelineStageStats:
+    """ Statistics of one pipeline stage. """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.numberofCalls = 0
+        self.durationSeconds = 0
+        # Net number of memory blocks allocated by this stage (see sys.getallocatedblocks)
+        self.allocatedBlocks = 0
+
+    def getLogText(self) -> str:
+        return f'{self.name}: calls={self.numberofCalls} | duration={formatSeconds(self.durationSeconds)} | allocatedBlocks={self.allocatedBlocks}'
+
+
+class CouponParsePipeline:
+    """ Runs raw coupon objects through a list of stage functions. Each stage gets the CouponParseContext of the current item.
+     A stage can return False to drop the current item. """
+
+    def __init__(self, stages: List[Callable[[CouponParseContext], Union[bool, None]]]):
+        self.stages = stages
+        self.stageStats = [PipelineStageStats(stage.__name__) for stage in stages]
+
+    def run(self, context: CouponParseContext) -> bool:
+        """ Runs given item through all stages. Returns False if it has been dropped by a stage. """
+        for stage, stats in zip(self.stages, self.stageStats):
+            allocatedBlocksBefore = sys.getallocatedblocks()
+            timestampBefore = time.perf_counter()
+            result = stage(context)
+            stats.durationSeconds += time.perf_counter() - timestampBefore
+            stats.allocatedBlocks += sys.getallocatedblocks() - allocatedBlocksBefore
+            stats.numberofCalls += 1
+            if result is False:
+                return False
+        return True
+
+    def runBatch(self, contexts: Iterable[CouponParseContext]):
+        """ Runs all given items through the pipeline and yields all of them which have not been dropped.
+         Also accepts generators so items can be processed while they are still being crawled. """
+        for context in contexts:
+            if self.run(context):
+                yield context
+
+    def getStatsLogText(self) -> str:
+        return '\n'.join(stats.getLogText() for stats in self.stageStats)
+
+
+def iterateAppCouponsBK(systemwideOffers: Iterable[dict]):
+    """ Yields CouponParseContext objects for all given 'SystemwideOffer' objects and their 'upsellOptions'. """
+    for couponBKTmp in systemwideOffers:
+        # First item = Real coupon, all others = upsell/"hidden" coupon(s)
+        yield CouponParseContext(couponBKTmp)
+        # Collect hidden coupons
+        upsellOptions = couponBKTmp.get('upsellOptions')
+        if upsellOptions is not None:
+            for upsellOption in upsellOptions:
+                upsellID = upsellOption.get('_id')
+                upsellType = upsellOption.get('_type')
+                upsellShortCode = upsellOption.get('shortCode')
+                if upsellType != 'offer' or upsellShortCode is None:
+                    # Skip invalid items: This should never happen
+                    logging.info(f"Found invalid/unsupported upsell object: {upsellID=}")
+                    continue
+                yield CouponParseContext(upsellOption, isHidden=True)
+
+
+def appCouponParseTitle(context: CouponParseContext):
+    """ Decides how to use title and subtitle and if it makes sense to put both into one string. """
+    couponBK = context.couponBK
+    context.uniqueCouponID = couponBK['vendorConfigs']['rpos']['constantPlu']
+    legacyInternalName = couponBK.get('internalName')
+    # Find coupon-title. Prefer to get it from 'internalName' as the other title may contain crap we don't want.
+    # 2022-11-02: Prefer normal titles again because internal ones are sometimes incomplete
+    useInternalNameAsTitle = False
+    legacyInternalNameRegex = None
+    if legacyInternalName is not None:
+        legacyInternalNameRegex = REGEX_APP_COUPON_INTERNAL_NAME.search(legacyInternalName)
+    subtitle = None
+    try:
+        subtitle = couponBK['description']['localeRaw'][0]['children'][0]['text']
+    except:
+        pass
+    if legacyInternalNameRegex is not None and useInternalNameAsTitle:
+        titleFull = legacyInternalNameRegex.group(1)
+        titleFull = titleFull.replace('_', ' ')
+    else:
+        title = couponBK['name']['localeRaw'][0]['children'][0]['text']
+        title = title.strip()
+        context.title = title
+        if subtitle is None:
+            titleFull = title
+        else:
+            subtitle = subtitle.strip()
+            titleShortened = shortenProductNames(title)
+            subtitleShortened = shortenProductNames(subtitle)
+            if len(subtitleShortened) == 0 or subtitleShortened.isspace():
+                # Useless subtitle -> Use title only
+                titleFull = title
+            elif len(titleShortened) == 0 or titleShortened.isspace():
+                # Useless title -> Use subtitle only
+                titleFull = subtitle
+            elif titleShortened == subtitleShortened:  # Small hack: Shorten titles before comparing them
+                # Title and subtitle are the same -> Use title only
+                titleFull = title
+            else:
+                # Assume that subtitle is usable and put both together
+                titleFull = title + ' ' + subtitle
+                # Log seemingly strange values
+                if not subtitle.startswith('+'):
+                    logging.info(f'Coupon {context.uniqueCouponID}: Possible subtitle which should not be included in coupon title: {subtitle=} | {title=} | {titleFull=}')
+    context.subtitle = subtitle
+    context.titleFull = sanitizeCouponTitle(titleFull)
+
+
+def appCouponCreate(context: CouponParseContext):
+    """ Creates Coupon object and sets all basic information. """
+    couponBK = context.couponBK
+    coupon = Coupon(id=context.uniqueCouponID, uniqueID=context.uniqueCouponID, plu=couponBK['shortCode'], title=context.titleFull, subtitle=context.subtitle,
+                    titleShortened=shortenProductNames(context.titleFull), type=CouponType.APP)
+    coupon.webviewID = couponBK.get('loyaltyEngineId')
+    # TODO: Check where those tags are located in new API endpoint
+    offerTags = couponBK.get('offerTags')
+    if offerTags is not None and len(offerTags) > 0:
+        # 2023-01-09: Looks like this field doesn't exist anymore
+        tagsStringArray = []
+        for offerTag in offerTags:
+            tagsStringArray.append(offerTag['value'])
+        coupon.tags = tagsStringArray
+    if context.isHidden:
+        coupon.isHidden = True
+    context.coupon = coupon
+
+
+def appCouponParsePrice(context: CouponParseContext):
+    coupon = context.coupon
+    price = context.couponBK['offerPrice']
+    if price == 0:
+        # Special detection for some 50%/2for1 coupons that are listed with price == 0€
+        if coupon.title.startswith('2'):
+            # E.g. 2 Crispy Chicken
+            coupon.staticReducedPercent = 50
+        else:
+            # While it is super unlikely let's allow BK to provide coupons for free products :)
+            coupon.price = 0
+    else:
+        coupon.price = price
+
+
+def appCouponParseImageURL(context: CouponParseContext):
+    """ Builds URL to coupon product image. """
+    imageurl = context.couponBK['localizedImage']['locale']['app']['asset']['_id']
+    imageurl = "https://cdn.sanity.io/images/czqk28jt/prod_bk_de/" + imageurl.replace('image-', '')
+    imageurl = imageurl.replace('-png', '.png')
+    context.coupon.imageURL = imageurl
+
+
+def appCouponParseFootnoteExpireDate(context: CouponParseContext):
+    """ Expire date from footnote. Preferred over the one from the rules field. """
+    try:
+        footnote = context.couponBK['moreInfo']['localeRaw'][0]['children'][0]['text']
+        expiredateRegex = REGEX_APP_COUPON_FOOTNOTE_EXPIRE_DATE.search(footnote)
+        if expiredateRegex is not None:
+            expiredateStr = expiredateRegex.group(1) + ' 23:59:59'
+            context.datetimeExpireFootnote = datetime.strptime(expiredateStr, '%d.%m.%Y %H:%M:%S')
+    except:
+        # Dontcare
+        logging.warning('Failed to find BetterExpiredate for coupon: ' + context.uniqueCouponID)
+
+
+def appCouponParseRulesDates(context: CouponParseContext):
+    """ Start- and expire-date from 'LoyaltyBetweenDates' rule. """
+    rulesHere = context.couponBK.get('rules')
+    if rulesHere is None:
+        logging.info(f'Coupon without rules field: {context.uniqueCouponID}')
+        return
+    rulesAll = []
+    for ruleSet in rulesHere:
+        ruleSetsChilds = ruleSet.get('rules')
+        if ruleSetsChilds is not None:
+            for ruleSetsChild in ruleSetsChilds:
+                rulesAll.append(ruleSetsChild)
+        else:
+            rulesAll.append(ruleSet)
+    dateformatStart = '%Y-%m-%d'
+    dateformatEnd = '%Y-%m-%d %H:%M:%S'
+    for rule in rulesAll:
+        if rule['__typename'] == 'LoyaltyBetweenDates':
+            context.datetimeStart = datetime.strptime(rule['startDate'], dateformatStart)
+            context.datetimeExpireRules = datetime.strptime(rule['endDate'] + ' 23:59:59', dateformatEnd)
+            break
+
+
+def appCouponApplyDates(context: CouponParseContext):
+    coupon = context.coupon
+    if context.datetimeExpireFootnote is None and context.datetimeExpireRules is None:
+        # This should never happen
+        logging.warning(f'WTF failed to find any expiredate for coupon: {context.uniqueCouponID}')
+    elif context.datetimeExpireFootnote is not None:
+        # Prefer this expiredate
+        coupon.timestampExpire = context.datetimeExpireFootnote.timestamp()
+    else:
+        coupon.timestampExpire = context.datetimeExpireRules.timestamp()
+    if context.datetimeStart is not None:
+        coupon.timestampStart = context.datetimeStart.timestamp()
+
+
+def getAppCouponParsePipeline() -> CouponParsePipeline:
+    """ Returns pipeline which converts 'SystemwideOffer' objects of the app API to Coupon objects. """
+    return CouponParsePipeline(stages=[appCouponParseTitle, appCouponCreate, appCouponParsePrice, appCouponParseImageURL, appCouponParseFootnoteExpireDate, appCouponParseRulesDates,
+                                       appCouponApplyDates])
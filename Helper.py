@@ -1,19 +1,23 @@
+import hashlib
 import os
 import random
 import re
+import time
 from datetime import datetime, timedelta
 from re import Pattern
-from typing import Union
+from typing import Union, Tuple
 
 import pytz
 import simplejson as json
-from PIL import Image
+
+from UtilsRegex import *
 
 
 class DATABASES:
     """ Names of all databases used in this project. """
     INFO_DB = 'info_db'
     COUPONS = 'coupons'
+    COUPONS_ARCHIVE = 'coupons_archive'
     COUPONS_HISTORY = 'coupons_history'
     COUPONS_HISTORY_SIMPLE = 'coupons_history_simple'
     OFFERS = 'offers'
@@ -22,6 +26,7 @@ class DATABASES:
     PRODUCTS2_HISTORY = 'products2_history'
     TELEGRAM_USERS = 'telegram_users'
     TELEGRAM_CHANNEL = 'telegram_channel'
+    TELEGRAM_CONVERSATIONS = 'telegram_conversations'
 
 
 class HISTORYDB:
@@ -48,6 +53,51 @@ def saveJson(path: str, data: Union[list, dict]):
         json.dump(data, f, indent=4, sort_keys=True)
 
 
+def saveJsonIfChanged(path: str, data: Union[list, dict]) -> bool:
+    """ Same as saveJson but only writes the file if its content would change. Returns True if file has been written. """
+    newContent = json.dumps(data, indent=4, sort_keys=True)
+    if os.path.isfile(path):
+        with open(path, encoding='utf-8') as infile:
+            if infile.read() == newContent:
+                return False
+    with open(path, 'w') as f:
+        f.write(newContent)
+    return True
+
+
+""" Full path -> (file signature, content hash, loaded JSON) """
+loadedJsonCache = {}
+
+
+def getFileSignature(path: str) -> Union[Tuple[int, int], None]:
+    """ Returns (modification time in ns, size) of given file or None if it doesn't exist. """
+    try:
+        fileStat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return fileStat.st_mtime_ns, fileStat.st_size
+
+
+def loadJsonCached(path: str):
+    """ Same as loadJson but only parses the file again if its modification time/size and content have changed.
+     Returned data is shared between all callers -> Do not modify it! """
+    fullPath = os.path.join(os.getcwd(), path)
+    signature = getFileSignature(fullPath)
+    cachedItem = loadedJsonCache.get(fullPath)
+    if cachedItem is not None and signature is not None and cachedItem[0] == signature:
+        return cachedItem[2]
+    with open(fullPath, 'rb') as infile:
+        content = infile.read()
+    contentHash = hashlib.sha1(content).hexdigest()
+    if cachedItem is not None and cachedItem[1] == contentHash:
+        # File has been touched but content is the same
+        loadedJson = cachedItem[2]
+    else:
+        loadedJson = json.loads(content.decode('utf-8'), use_decimal=True)
+    loadedJsonCache[fullPath] = (signature, contentHash, loadedJson)
+    return loadedJson
+
+
 def couponOrOfferGetImageURL(data: dict) -> str:
     """ Only for new API objects (coupons and offers)! Chooses lowest resolution to save traffic (Some URLs have a fixed resolution. In this case we cannot change it.) """
     image_url = data['image_url']
@@ -63,7 +113,7 @@ def setImageURLQuality(image_url: str) -> str:
 
 def normalizeString(string: str):
     """ Returns lowercase String with all non-word characters removed. """
-    return re.sub(r'[\W_]+', '', string).lower()
+    return REGEX_NON_WORD_CHARACTERS.sub('', string).lower()
 
 
 def splitStringInPairs(string: str) -> str:
@@ -86,56 +136,33 @@ def shortenProductNames(couponTitle: str) -> str:
     """ Cleans up coupon titles to make them shorter so they hopefully fit in the length of one button.
      E.g. "Long Chicken + Crispy Chicken + mittlere KING Pommes + 0,4 L Coca-Cola" -> "LngChn+CrispyCkn+M🍟+0,4LCola"
      """
-    """ Let's start with fixing the fries -> Using an emoji as replacement really shortens product titles with fries! """
     couponTitle = sanitizeCouponTitle(couponTitle)
-    pommesReplacement = SYMBOLS.FRIES
-    colaReplacement = "🥤"
-    couponTitle = re.sub(r"kleine(\s*KING)?\s*Pommes", r"S" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"mittlere(\s*KING)?\s*Pommes", r"M" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"große(\s*KING)?\s*Pommes", r"L" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    """ Just in case we missed one fries-case... """
-    couponTitle = re.sub(r"KING\s*(Pommes)", pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Coca[\s-]*Cola", colaReplacement, couponTitle, flags=re.IGNORECASE)
+    """ Let's start with fixing the fries -> Using an emoji as replacement really shortens product titles with fries! """
+    couponTitle = SHORTEN_FRIES_AND_DRINKS(couponTitle)
     """ E.g. "Big KING" --> "Big K" """
-    couponTitle = re.sub(r"(Big|Bacon|Fish|Halloumi)\s*KING", r"\1", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_BIG_KING.sub(r"\1", couponTitle)
     """ E.g. "KING Shake" --> "Shake" """
-    couponTitle = re.sub(r"KING\s*(Jr\.?\s*Meal|Jr\.?\s*Menü|Shake|Nuggets?|Wings?)", r"\1", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_KING_PRODUCTS.sub(r"\1", couponTitle)
     """ 'Meta' replaces """
     # Normalize- and fix drink unit e.g. "0,3 L" or "0.3l" to "0.3" (remove unit character to save even more space)
-    couponTitle = re.sub(r"(0[.,]\d{1,2})\s*L", r"\1", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_DRINK_UNIT.sub(r"\1", couponTitle)
     # Normalize 'nugget unit e.g. "6er KING Nuggets" -> "6 KING Nuggets"
-    couponTitle = re.sub(r"(\d{1,2})er\s*", r"\1", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_NUGGET_UNIT.sub(r"\1", couponTitle)
     # E.g. "2x Crispy Chicken" --> 2 Crispy Chicken
-    couponTitle = re.sub(r"((\d+)[Xx] )([A-Za-z]+)", r"\2 \3", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_QUANTITY.sub(r"\2 \3", couponTitle)
     # "Chicken Nuggets" -> "Nuggets"
-    couponTitle = re.sub(r"Chicken\s*(Nuggets)", r"\1", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_CHICKEN_NUGGETS.sub(r"\1", couponTitle)
     # Cheeseburger -> Cheesebrgr
-    couponTitle = re.sub(r"(b)urger", r"\1rgr", couponTitle, flags=re.IGNORECASE)
-
-    # Assume that all users know that "Cheddar" is cheese so let's remove this double entry
-    couponTitle = re.sub(r"Cheddar\s*Cheese", r"Cheddar", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Chicken", r"Ckn", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Chili[\s-]*Cheese", r"CC", couponTitle, flags=re.IGNORECASE)
-    # couponTitle = re.sub(r"Coca[\s-]*Cola", r"Cola", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Deluxe", r"Dlx", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Dips", r"Dip", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Double", r"Dbl", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Long", r"Lng", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Nuggets?", r"Nug", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Plant[\s-]*Based", r"Plnt", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Tripp?le", r"Trple", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Veggie", r"Veg", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Whopper", r"Wppr", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Steakhouse", r"SteakH", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"X[\s-]*tra", r"Xtra", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Onion[\s-]*Rings", r"Rings", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_BURGER.sub(r"\1rgr", couponTitle)
+    # All simple abbreviations in one go e.g. "Chicken" -> "Ckn"
+    couponTitle = SHORTEN_ABBREVIATIONS(couponTitle)
     # Remove 'oder'
-    couponTitle = re.sub(r"\s*oder\s*", r"", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"\s*zum\s*Preis\s*von\s*(1!?|einem|einer)", r"", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_ODER.sub("", couponTitle)
+    couponTitle = REGEX_SHORTEN_ZUM_PREIS_VON.sub("", couponTitle)
     # Remove e.g. "Im KING Menü (+ 50 Cent)"
-    couponTitle = re.sub(r"Im King Menü \(\+[^)]+\)", r"", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r" mit ", r"&", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Jr\s*\.", r"Jr", couponTitle, flags=re.IGNORECASE)
+    couponTitle = REGEX_SHORTEN_MENU_SURCHARGE.sub("", couponTitle)
+    couponTitle = REGEX_SHORTEN_MIT.sub("&", couponTitle)
+    couponTitle = REGEX_SHORTEN_JR.sub("Jr", couponTitle)
     # Do some more basic replacements
     couponTitle = couponTitle.replace(' ', '')
     # E.g. "...Chili-Cheese"
@@ -161,6 +188,11 @@ def getPathImagesProducts() -> str:
     return 'crawler/images/products'
 
 
+def getPathImagesPaybackCards() -> str:
+    """ Returns path to directory containing rendered Payback card barcodes. """
+    return 'crawler/images/paybackcards'
+
+
 def convertCouponAndOfferDateToGermanFormat(date: str) -> str:
     """ 2020-12-22T09:10:13+01:00 --> 22.12.2020 10:13 Uhr """
     return formatDateGerman(getDatetimeFromString(date))
@@ -197,6 +229,11 @@ def getCurrentDate() -> datetime:
     return datetime.now(getTimezone())
 
 
+def getCurrentTimestamp() -> float:
+    """ Returns 'now' as plain timestamp. Cheaper than getCurrentDate: Use this to take one snapshot of 'now' which gets passed through a complete filter/sort pass. """
+    return time.time()
+
+
 def getTimezone() -> pytz:
     return pytz.timezone('Europe/Berlin')
 
@@ -242,8 +279,18 @@ class SYMBOLS:
     # SOON = '🔜'
 
 
+SHORTEN_FRIES_AND_DRINKS = compileReplacementRules([
+    (r"kleine(?:\s*KING)?\s*Pommes", "S" + SYMBOLS.FRIES),
+    (r"mittlere(?:\s*KING)?\s*Pommes", "M" + SYMBOLS.FRIES),
+    (r"große(?:\s*KING)?\s*Pommes", "L" + SYMBOLS.FRIES),
+    # Just in case we missed one fries-case...
+    (r"KING\s*Pommes", SYMBOLS.FRIES),
+    (r"Coca[\s-]*Cola", "🥤"),
+])
+
+
 def getFilenameFromURL(url: str) -> str:
-    filenameRegex = re.compile(r'(?i)^http.*[/=]([\w-]+\.(jpe?g|png))').search(url)
+    filenameRegex = REGEX_FILENAME_FROM_URL.search(url)
     if filenameRegex:
         filenameURL = filenameRegex.group(1)
     else:
@@ -259,9 +306,9 @@ def couponTitleContainsFriesAndDrink(title: str) -> bool:
     titleLower = title.lower()
     if '+' in titleLower and couponTitleContainsFries(titleLower) and couponTitleContainsDrink(titleLower):
         return True
-    elif re.compile(r'.*king\s*jr\s*\.?\s*meal.*').search(titleLower):
+    elif REGEX_KING_JR_MEAL.search(titleLower):
         return True
-    elif re.compile(r'.*king\s*jr\s*\.?\s*menü.*').search(titleLower):
+    elif REGEX_KING_JR_MENU.search(titleLower):
         return True
     else:
         return False
@@ -327,15 +374,12 @@ def couponTitleIsFries(title: str) -> bool:
 
 def couponTitleContainsDrink(title: str) -> bool:
     titleLower = title.lower()
-    if 'cola' in titleLower or re.compile(r'red\s*bull').search(titleLower):
+    if 'cola' in titleLower or REGEX_RED_BULL.search(titleLower):
         return True
     else:
         return False
 
 
-REGEX_PLU_WITH_AT_LEAST_ONE_LETTER = re.compile(r'(?i)^([A-Z]+)\d+[A-Z]?$')
-
-
 def isCouponShortPLUWithAtLeastOneLetter(plu: str) -> bool:
     """ 2021-04-13: Examples of allowed shortPLUs: "X11", "X11B"
     2021-05-25: New e.g. "KDM2"
@@ -390,6 +434,8 @@ def formatSeconds(seconds: float) -> str:
 
 def isValidImageFile(path: str) -> bool:
     """ Checks if a valid image file exists under given filepath. """
+    # Imported here as it is not needed for the bot to start
+    from PIL import Image
     try:
         im = Image.open(path)
         im.verify()
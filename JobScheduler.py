@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import random
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, Awaitable, Union, List, Tuple, Dict
+
+from couchdb import Database
+
+""" Runs recurring background jobs of the bot.
+ Last run timestamps are stored in DB so runs missed while the bot was offline can be caught up on startup. """
+
+# ID of the document in info DB which contains the last run timestamps of all jobs
+JOB_SCHEDULER_DOC_ID = 'job_scheduler'
+
+
+class Job:
+
+    def __init__(self, name: str, callback: Callable[[], Awaitable], dailyAt: Union[Tuple[int, int], None] = None, intervalSeconds: Union[float, None] = None,
+                 catchUp: bool = True, jitterSeconds: float = 0, triggers: Union[List[str], None] = None):
+        """
+        :param dailyAt: (hour, minute): Run job once per day at this time.
+        :param intervalSeconds: Run job every X seconds.
+        :param catchUp: Run job immediately if its last scheduled run has been missed e.g. because the bot was offline.
+        :param jitterSeconds: Delay scheduled runs by a random amount of seconds up to this value.
+        :param triggers: Names of events which make this job run immediately, see JobScheduler.trigger
+        """
+        self.name = name
+        self.callback = callback
+        self.dailyAt = dailyAt
+        self.intervalSeconds = intervalSeconds
+        self.catchUp = catchUp
+        self.jitterSeconds = jitterSeconds
+        self.triggers = triggers if triggers is not None else []
+        self.lastRunTimestamp: Union[float, None] = None
+        self.nextRunTimestamp: Union[float, None] = None
+        self.task: Union[asyncio.Task, None] = None
+        # Job has been triggered while it was running -> Run it again once it is done
+        self.runAgain = False
+        self.numberofRuns = 0
+        self.numberofFailedRuns = 0
+        self.lastRunDurationSeconds: Union[float, None] = None
+        self.totalRunDurationSeconds = 0
+        # Current run has been interrupted by a shutdown of the bot
+        self.isInterrupted = False
+        # Current run continues a run which has been interrupted by the last shutdown of the bot
+        self.isResumingInterruptedRun = False
+
+    def isRunning(self) -> bool:
+        return self.task is not None
+
+    def isRunPending(self, now: float) -> bool:
+        """ Returns True if this job has been interrupted or is supposed to run right now e.g. because it has been triggered. """
+        return self.isInterrupted or self.runAgain or (self.nextRunTimestamp is not None and self.nextRunTimestamp <= now)
+
+    def getPreviousScheduledTimestamp(self, now: float) -> Union[float, None]:
+        """ Returns the last point in time <= now at which this job was supposed to run. """
+        if self.dailyAt is not None:
+            nowDatetime = datetime.fromtimestamp(now)
+            scheduledDatetime = nowDatetime.replace(hour=self.dailyAt[0], minute=self.dailyAt[1], second=0, microsecond=0)
+            if scheduledDatetime > nowDatetime:
+                scheduledDatetime -= timedelta(days=1)
+            return scheduledDatetime.timestamp()
+        elif self.intervalSeconds is not None and self.lastRunTimestamp is not None:
+            scheduledTimestamp = self.lastRunTimestamp + self.intervalSeconds
+            return scheduledTimestamp if scheduledTimestamp <= now else None
+        else:
+            return None
+
+    def getNextScheduledTimestamp(self, now: float) -> Union[float, None]:
+        """ Returns the next point in time > now at which this job is supposed to run. """
+        if self.dailyAt is not None:
+            return (datetime.fromtimestamp(self.getPreviousScheduledTimestamp(now)) + timedelta(days=1)).timestamp()
+        elif self.intervalSeconds is not None:
+            if self.lastRunTimestamp is None or self.lastRunTimestamp + self.intervalSeconds <= now:
+                # Missed runs are skipped here, see catchUp
+                return now + self.intervalSeconds
+            return self.lastRunTimestamp + self.intervalSeconds
+        else:
+            # Job only runs on events
+            return None
+
+    def scheduleNextRun(self, now: float, isStartup: bool = False):
+        previousScheduledTimestamp = self.getPreviousScheduledTimestamp(now)
+        if isStartup and self.catchUp and self.lastRunTimestamp is not None and previousScheduledTimestamp is not None \
+                and self.lastRunTimestamp < previousScheduledTimestamp:
+            logging.info(f'Job {self.name}: Catching up missed run')
+            self.nextRunTimestamp = now
+            return
+        nextScheduledTimestamp = self.getNextScheduledTimestamp(now)
+        if nextScheduledTimestamp is not None and self.jitterSeconds > 0:
+            nextScheduledTimestamp += random.uniform(0, self.jitterSeconds)
+        self.nextRunTimestamp = nextScheduledTimestamp
+
+    def getStatusText(self) -> str:
+        if self.isRunning():
+            status = 'läuft'
+        elif self.nextRunTimestamp is not None:
+            status = f'nächster Lauf {datetime.fromtimestamp(self.nextRunTimestamp).strftime("%d.%m. %H:%M")}'
+        else:
+            status = 'wartet auf Event'
+        text = f'{self.name}: {status} | Läufe: {self.numberofRuns}'
+        if self.numberofFailedRuns > 0:
+            text += f' | Fehler: {self.numberofFailedRuns}'
+        if self.lastRunDurationSeconds is not None:
+            text += f' | Dauer zuletzt: {self.lastRunDurationSeconds:0.1f}s | Ø {self.totalRunDurationSeconds / self.numberofRuns:0.1f}s'
+        return text
+
+
+class JobScheduler:
+
+    def __init__(self, infoDB: Database):
+        self.infoDB = infoDB
+        self.jobs: Dict[str, Job] = {}
+        # Gets set whenever the scheduler needs to re-check what to run next
+        self.wakeup = asyncio.Event()
+        # Jobs may finish at the same time -> Avoid conflicting writes of the same doc
+        self.storeLock = asyncio.Lock()
+        self.isStopping = False
+
+    def addJob(self, job: Job):
+        self.jobs[job.name] = job
+
+    def trigger(self, eventName: str):
+        """ Runs all jobs waiting for given event as soon as possible. Jobs which are already running will run once more afterwards. """
+        now = datetime.now().timestamp()
+        for job in self.jobs.values():
+            if eventName in job.triggers:
+                logging.info(f'Job {job.name}: Triggered by event {eventName}')
+                if job.isRunning():
+                    job.runAgain = True
+                else:
+                    job.nextRunTimestamp = now
+        self.wakeup.set()
+
+    def isResumingInterruptedRun(self, jobName: str) -> bool:
+        """ Jobs can use this to continue where the last run has been interrupted instead of starting from scratch. """
+        job = self.jobs.get(jobName)
+        return job is not None and job.isResumingInterruptedRun
+
+    def loadLastRunTimestamps(self):
+        doc = self.infoDB.get(JOB_SCHEDULER_DOC_ID)
+        if doc is None:
+            return
+        for jobName, lastRunTimestamp in doc.get('lastRunTimestamps', {}).items():
+            job = self.jobs.get(jobName)
+            if job is not None:
+                job.lastRunTimestamp = lastRunTimestamp
+        pendingRuns = doc.pop('pendingRuns', None)
+        if pendingRuns is None:
+            return
+        now = datetime.now().timestamp()
+        for jobName, wasInterrupted in pendingRuns.items():
+            job = self.jobs.get(jobName)
+            if job is not None:
+                logging.info(f'Job {job.name}: Running pending run from before last shutdown | Interrupted: {wasInterrupted}')
+                job.nextRunTimestamp = now
+                job.isResumingInterruptedRun = wasInterrupted
+        # Only run them once even if the bot gets killed before storing anything else
+        self.infoDB.save(doc)
+
+    def storePendingRuns(self):
+        """ Remembers jobs which have been interrupted or requested but not yet run so they will run on next start. """
+        now = datetime.now().timestamp()
+        pendingRuns = {job.name: job.isInterrupted for job in self.jobs.values() if job.isRunPending(now)}
+        if len(pendingRuns) == 0:
+            return
+        doc = self.infoDB.get(JOB_SCHEDULER_DOC_ID)
+        if doc is None:
+            doc = {'_id': JOB_SCHEDULER_DOC_ID, 'lastRunTimestamps': {}}
+        doc['pendingRuns'] = pendingRuns
+        self.infoDB.save(doc)
+        logging.info(f'Stored pending job runs: {pendingRuns}')
+
+    def storeLastRunTimestamp(self, job: Job):
+        doc = self.infoDB.get(JOB_SCHEDULER_DOC_ID)
+        if doc is None:
+            doc = {'_id': JOB_SCHEDULER_DOC_ID, 'lastRunTimestamps': {}}
+        doc['lastRunTimestamps'][job.name] = job.lastRunTimestamp
+        self.infoDB.save(doc)
+
+    async def run(self):
+        """ Runs scheduled jobs forever. """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.loadLastRunTimestamps)
+        now = datetime.now().timestamp()
+        for job in self.jobs.values():
+            # Keep runs which have already been requested via trigger
+            if job.nextRunTimestamp is None:
+                job.scheduleNextRun(now, isStartup=True)
+        while not self.isStopping:
+            self.wakeup.clear()
+            now = datetime.now().timestamp()
+            waitSeconds = None
+            for job in self.jobs.values():
+                if job.isRunning() or job.nextRunTimestamp is None:
+                    continue
+                if job.nextRunTimestamp <= now:
+                    job.nextRunTimestamp = None
+                    job.task = asyncio.create_task(self.runJob(job))
+                else:
+                    secondsUntilNextRun = job.nextRunTimestamp - now
+                    if waitSeconds is None or secondsUntilNextRun < waitSeconds:
+                        waitSeconds = secondsUntilNextRun
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=waitSeconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def runJob(self, job: Job):
+        timestampStart = datetime.now().timestamp()
+        logging.info(f'Job {job.name}: Starting')
+        try:
+            await job.callback()
+        except asyncio.CancelledError:
+            logging.info(f'Job {job.name}: Interrupted')
+            job.isInterrupted = True
+            job.task = None
+            raise
+        except Exception:
+            traceback.print_exc()
+            logging.warning(f'Job {job.name}: Failed')
+            job.numberofFailedRuns += 1
+        now = datetime.now().timestamp()
+        job.numberofRuns += 1
+        job.lastRunDurationSeconds = now - timestampStart
+        job.totalRunDurationSeconds += job.lastRunDurationSeconds
+        # Start of this run counts as last run so interval jobs do not drift by their duration
+        job.lastRunTimestamp = timestampStart
+        logging.info(f'Job {job.name}: Done | Duration: {job.lastRunDurationSeconds:0.1f} seconds')
+        try:
+            async with self.storeLock:
+                await asyncio.get_running_loop().run_in_executor(None, self.storeLastRunTimestamp, job)
+        except Exception:
+            traceback.print_exc()
+            logging.warning(f'Job {job.name}: Failed to store last run timestamp')
+        job.task = None
+        job.isResumingInterruptedRun = False
+        if job.runAgain and not self.isStopping:
+            job.runAgain = False
+            job.nextRunTimestamp = now
+        else:
+            job.scheduleNextRun(now)
+        self.wakeup.set()
+
+    async def stop(self, timeoutSeconds: float):
+        """ Stops starting new runs and gives running jobs timeoutSeconds to finish. Jobs still running after that get cancelled.
+         Interrupted and not yet started runs are stored so they will be done on next start. """
+        self.isStopping = True
+        self.wakeup.set()
+        runningTasks = [job.task for job in self.jobs.values() if job.task is not None]
+        if len(runningTasks) > 0:
+            logging.info(f'Waiting up to {timeoutSeconds} seconds for {len(runningTasks)} running jobs')
+            done, pending = await asyncio.wait(runningTasks, timeout=timeoutSeconds)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*runningTasks, return_exceptions=True)
+        async with self.storeLock:
+            await asyncio.get_running_loop().run_in_executor(None, self.storePendingRuns)
+
+    def getStatusText(self) -> str:
+        return '\n'.join(job.getStatusText() for job in self.jobs.values())
@@ -1,22 +1,40 @@
+import copy
 import os
 from datetime import datetime
 
 import Helper
-from Helper import saveJson, getTimezone, loadJson
+from Helper import saveJsonIfChanged, getTimezone, loadJsonCached, getFileSignature
 
 from BaseUtils import logging
 
 """ Helper to complete config file with data from 'paper_coupon_helper_ids.txt'. """
 
 
+""" Signature of all input files of the last run of main(). """
+lastInputSignature = None
+
+
+def getPaperCouponDataFilePath(paperIdentifier: str) -> str:
+    return 'paper_coupon_data/paper_coupon_helper_ids_' + paperIdentifier + '.txt'
+
+
 def main():
+    global lastInputSignature
     activePaperCouponInfo = getActivePaperCouponInfo()
     if len(activePaperCouponInfo) == 0:
         # logging.info("Failed to find any currently valid paper coupon candidates --> Cannot add additional information")
         return
-    paperCouponConfig = loadPaperCouponConfigFile()
+    # Nothing to do if neither the config nor any of the paper coupon data files have changed since the last run
+    inputSignature = [(Helper.Paths.paperCouponExtraDataPath, getFileSignature(Helper.Paths.paperCouponExtraDataPath))]
+    for paperIdentifier in activePaperCouponInfo.keys():
+        filepath = getPaperCouponDataFilePath(paperIdentifier)
+        inputSignature.append((filepath, getFileSignature(filepath)))
+    if inputSignature == lastInputSignature:
+        return
+    # Loaded config is shared with other callers -> Work on a copy
+    paperCouponConfig = copy.deepcopy(loadPaperCouponConfigFile())
     for paperIdentifier in activePaperCouponInfo.keys():
-        filepath = 'paper_coupon_data/paper_coupon_helper_ids_' + paperIdentifier + '.txt'
+        filepath = getPaperCouponDataFilePath(paperIdentifier)
         if not os.path.isfile(filepath):
             # Shouldn't happen but it's not too fatal - maybe there are just no paper coupons available at this moment.
             logging.warning('No file available for paper coupon char ' + paperIdentifier + ' | ' + filepath)
@@ -72,7 +90,10 @@ def main():
 
     # paperCouponConfig[paperChar]['mapping'] = mapping
     # Update our config file accordingly
-    saveJson(Helper.Paths.paperCouponExtraDataPath, paperCouponConfig)
+    if saveJsonIfChanged(Helper.Paths.paperCouponExtraDataPath, paperCouponConfig):
+        # Our own write has changed the signature of the config file
+        inputSignature[0] = (Helper.Paths.paperCouponExtraDataPath, getFileSignature(Helper.Paths.paperCouponExtraDataPath))
+    lastInputSignature = inputSignature
 
 
 if __name__ == "__main__":
@@ -85,11 +106,13 @@ def getActivePaperCouponInfo() -> dict:
     for paperIdentifier, paperData in loadPaperCouponConfigFile().items():
         validuntil = datetime.strptime(paperData['expire_date'] + ' 23:59:59', '%Y-%m-%d %H:%M:%S').astimezone(getTimezone()).timestamp()
         if validuntil > Helper.getCurrentDate().timestamp():
-            newPaperData = paperData
+            # Loaded config is shared with other callers -> Do not modify it
+            newPaperData = dict(paperData)
             newPaperData['expire_timestamp'] = validuntil
             paperCouponInfo[paperIdentifier] = newPaperData
     return paperCouponInfo
 
 
 def loadPaperCouponConfigFile() -> dict:
-    return loadJson(Helper.Paths.paperCouponExtraDataPath)
\ No newline at end of file
+    """ Returns cached config. Do not modify it! """
+    return loadJsonCached(Helper.Paths.paperCouponExtraDataPath)
\ No newline at end of file
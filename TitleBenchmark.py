@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+import timeit
+
+from CrawlerPipeline import getAppCouponParsePipeline, iterateAppCouponsBK
+from Helper import shortenProductNames, sanitizeCouponTitle, SYMBOLS, loadJson
+
+""" Benchmarks shortenProductNames against its former implementation and makes sure that both return the same results.
+ Usage: python TitleBenchmark.py [number of loops]
+ Uses all titles of 'crawler/coupons1.json' (stored API response, see BKCrawler.setStoreCouponAPIDataAsJson) if available. """
+
+titleCorpus = [
+    "Long Chicken + Crispy Chicken + mittlere KING Pommes + 0,4 L Coca-Cola",
+    "2 X-Tra Long Chili Cheese + King Fries Medium + Coca-Cola® medium",
+    "King Shake Espresso medium",
+    "2 MITTLERE KING POMMES ZUM PREIS VON EINER",
+    "2X 6 KING NUGGETS ZUM PREIS VON EINER 6ER PORTION",
+    "2 Crispy Chicken - Buy 1 get 1 free",
+    "2 Crispy Chicken 2 Crispy Chicken zum Preis von einem",
+    "Big King",
+    "Big KING + kleine KING Pommes",
+    "Fish King",
+    "KING FRIES Medium +1 DIP",
+    "KING NUGGETS 6 STK. + 1 DIP",
+    "Whopper",
+    "Whopper® + mittlere KING Pommes + 0,4 L Coca-Cola®",
+    "Double Whopper® Cheese + große KING Pommes + 0,5 L Coca-Cola®",
+    "Plant-based Whopper® + mittlere KING Pommes",
+    "Plant-Based Long Chicken® + 6 Plant-Based KING Nuggets®",
+    "Triple Whopper® Cheese",
+    "Tripple Cheeseburger",
+    "Bacon King + Onion Rings",
+    "Halloumi King + Chili-Cheese-Nuggets",
+    "Steakhouse Burger + 9er KING Nuggets + 2 Dips",
+    "9 Chicken Nuggets + 2 Dips",
+    "20er KING Nuggets® + 4 Dips",
+    "KING Jr. Meal Hamburger oder Cheeseburger",
+    "KING Jr Menü mit Nuggets",
+    "Veggie Burger + kleine Pommes",
+    "Long Chicken® Deluxe",
+    "X-tra Long Chili Cheese",
+    "Crispy Chicken + 0,3 L Red Bull",
+    "Cheddar Cheese Whopper® Im King Menü (+ 50 Cent)",
+    "2x Cheeseburger",
+    "6er Chicken Wings",
+    "KING Wings 6er",
+    "Chicken Fries + Cheese Nachos",
+    "Brownie + KING Shake",
+    "Double Cheeseburger + 6 KING Nuggets + 2 Dips",
+    "Long Chicken oder Long Fish",
+]
+
+
+def shortenProductNamesLegacy(couponTitle: str) -> str:
+    """ Former implementation of shortenProductNames: One re.sub call with an inline pattern per rule. Used as reference. """
+    """ Let's start with fixing the fries -> Using an emoji as replacement really shortens product titles with fries! """
+    couponTitle = sanitizeCouponTitle(couponTitle)
+    pommesReplacement = SYMBOLS.FRIES
+    colaReplacement = "🥤"
+    couponTitle = re.sub(r"kleine(\s*KING)?\s*Pommes", r"S" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"mittlere(\s*KING)?\s*Pommes", r"M" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"große(\s*KING)?\s*Pommes", r"L" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
+    """ Just in case we missed one fries-case... """
+    couponTitle = re.sub(r"KING\s*(Pommes)", pommesReplacement, couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Coca[\s-]*Cola", colaReplacement, couponTitle, flags=re.IGNORECASE)
+    """ E.g. "Big KING" --> "Big K" """
+    couponTitle = re.sub(r"(Big|Bacon|Fish|Halloumi)\s*KING", r"\1", couponTitle, flags=re.IGNORECASE)
+    """ E.g. "KING Shake" --> "Shake" """
+    couponTitle = re.sub(r"KING\s*(Jr\.?\s*Meal|Jr\.?\s*Menü|Shake|Nuggets?|Wings?)", r"\1", couponTitle, flags=re.IGNORECASE)
+    """ 'Meta' replaces """
+    # Normalize- and fix drink unit e.g. "0,3 L" or "0.3l" to "0.3" (remove unit character to save even more space)
+    couponTitle = re.sub(r"(0[.,]\d{1,2})\s*L", r"\1", couponTitle, flags=re.IGNORECASE)
+    # Normalize 'nugget unit e.g. "6er KING Nuggets" -> "6 KING Nuggets"
+    couponTitle = re.sub(r"(\d{1,2})er\s*", r"\1", couponTitle, flags=re.IGNORECASE)
+    # E.g. "2x Crispy Chicken" --> 2 Crispy Chicken
+    couponTitle = re.sub(r"((\d+)[Xx] )([A-Za-z]+)", r"\2 \3", couponTitle, flags=re.IGNORECASE)
+    # "Chicken Nuggets" -> "Nuggets"
+    couponTitle = re.sub(r"Chicken\s*(Nuggets)", r"\1", couponTitle, flags=re.IGNORECASE)
+    # Cheeseburger -> Cheesebrgr
+    couponTitle = re.sub(r"(b)urger", r"\1rgr", couponTitle, flags=re.IGNORECASE)
+
+    # Assume that all users know that "Cheddar" is cheese so let's remove this double entry
+    couponTitle = re.sub(r"Cheddar\s*Cheese", r"Cheddar", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Chicken", r"Ckn", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Chili[\s-]*Cheese", r"CC", couponTitle, flags=re.IGNORECASE)
+    # couponTitle = re.sub(r"Coca[\s-]*Cola", r"Cola", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Deluxe", r"Dlx", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Dips", r"Dip", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Double", r"Dbl", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Long", r"Lng", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Nuggets?", r"Nug", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Plant[\s-]*Based", r"Plnt", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Tripp?le", r"Trple", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Veggie", r"Veg", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Whopper", r"Wppr", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Steakhouse", r"SteakH", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"X[\s-]*tra", r"Xtra", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Onion[\s-]*Rings", r"Rings", couponTitle, flags=re.IGNORECASE)
+    # Remove 'oder'
+    couponTitle = re.sub(r"\s*oder\s*", r"", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"\s*zum\s*Preis\s*von\s*(1!?|einem|einer)", r"", couponTitle, flags=re.IGNORECASE)
+    # Remove e.g. "Im KING Menü (+ 50 Cent)"
+    couponTitle = re.sub(r"Im King Menü \(\+[^)]+\)", r"", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r" mit ", r"&", couponTitle, flags=re.IGNORECASE)
+    couponTitle = re.sub(r"Jr\s*\.", r"Jr", couponTitle, flags=re.IGNORECASE)
+    # Do some more basic replacements
+    couponTitle = couponTitle.replace(' ', '')
+    # E.g. "...Chili-Cheese"
+    couponTitle = couponTitle.replace('-', '')
+    # couponTitle = couponTitle.replace(' + ', '+')
+    return couponTitle
+
+
+def getCrawledTitles() -> list:
+    path = 'crawler/coupons1.json'
+    if not os.path.exists(path):
+        return []
+    apiResponse = loadJson(path)
+    pipeline = getAppCouponParsePipeline()
+    titles = []
+    for context in pipeline.runBatch(iterateAppCouponsBK(apiResponse['data']['LoyaltyOffersUI']['sortedSystemwideOffers'])):
+        titles.append(context.coupon.title)
+    return titles
+
+
+def main():
+    numberofLoops = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    titles = titleCorpus + getCrawledTitles()
+    numberofMismatches = 0
+    for title in titles:
+        resultLegacy = shortenProductNamesLegacy(title)
+        result = shortenProductNames(title)
+        if result != resultLegacy:
+            numberofMismatches += 1
+            print(f'Mismatch: {title=} | {resultLegacy=} | {result=}')
+    print(f'Titles: {len(titles)} | Mismatches: {numberofMismatches}')
+
+    def runLegacy():
+        for title in titles:
+            shortenProductNamesLegacy(title)
+
+    def run():
+        for title in titles:
+            shortenProductNames(title)
+
+    durationLegacy = timeit.timeit(runLegacy, number=numberofLoops)
+    duration = timeit.timeit(run, number=numberofLoops)
+    print(f'Legacy: {durationLegacy:.3f}s | Current: {duration:.3f}s | Speedup: {durationLegacy / duration:.2f}x | Loops: {numberofLoops}')
+    if numberofMismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
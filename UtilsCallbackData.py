@@ -0,0 +1,144 @@
+import base64
+import binascii
+from functools import lru_cache
+from typing import NamedTuple, Union, List, Tuple
+from urllib.parse import parse_qs
+
+""" Compact callback_data for coupon list/coupon buttons.
+ Format: Prefix + version + action char + base64url encoded varints.
+ The back-link of a single coupon is the flat state of the list it was opened from so callback_data can't grow with every click. """
+
+CALLBACK_DATA_VERSION = 1
+CALLBACK_DATA_PREFIX = '#' + str(CALLBACK_DATA_VERSION)
+# Max length of callback_data allowed by Telegram
+CALLBACK_DATA_MAX_BYTES = 64
+
+
+class CallbackActions:
+    DISPLAY_COUPONS = 'l'
+    DISPLAY_COUPONS_CHANGE_SORT = 's'
+    DISPLAY_COUPON = 'c'
+
+
+class CallbackPattern:
+    """ Regular expressions for CallbackQueryHandlers. Also match legacy callback_data which may still be present in old chats. """
+    DISPLAY_COUPONS = '^(' + CALLBACK_DATA_PREFIX + '[' + CallbackActions.DISPLAY_COUPONS + CallbackActions.DISPLAY_COUPONS_CHANGE_SORT + r']|\?a=dcss?(&|$))'
+    DISPLAY_COUPON = '^(' + CALLBACK_DATA_PREFIX + CallbackActions.DISPLAY_COUPON + r'|\?a=dc(&|$))'
+
+
+class CouponCallback(NamedTuple):
+    """ Decoded callback_data of coupon list/coupon buttons. """
+    action: str
+    viewCode: int
+    couponType: Union[int, None] = None
+    page: int = 1
+    couponID: Union[str, None] = None
+
+    def getCouponListCallback(self, action: str = CallbackActions.DISPLAY_COUPONS, page: Union[int, None] = None) -> 'CouponCallback':
+        """ Returns callback pointing to the coupon list this callback belongs to. """
+        return self._replace(action=action, page=self.page if page is None else page, couponID=None)
+
+    def getCouponCallback(self, couponID: str) -> 'CouponCallback':
+        """ Returns callback to display given coupon which leads back to the coupon list of this callback. """
+        return self._replace(action=CallbackActions.DISPLAY_COUPON, couponID=couponID)
+
+    def encode(self) -> str:
+        return encodeCouponCallback(self)
+
+
+def encodeVarints(values: List[int]) -> bytes:
+    data = bytearray()
+    for value in values:
+        while value > 0x7F:
+            data.append((value & 0x7F) | 0x80)
+            value >>= 7
+        data.append(value)
+    return bytes(data)
+
+
+def decodeVarint(data: bytes, position: int) -> Tuple[int, int]:
+    """ Returns decoded value and position of the next value. """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def encodeCouponCallback(callback: CouponCallback) -> str:
+    """ Returns callback_data string for given callback. Raises ValueError if the result would exceed the size limit of Telegram. """
+    values = [callback.viewCode, 0 if callback.couponType is None else callback.couponType + 1, callback.page]
+    payload = encodeVarints(values)
+    if callback.action == CallbackActions.DISPLAY_COUPON:
+        couponID = callback.couponID
+        if couponID.isdigit() and not couponID.startswith('0'):
+            # Most coupon IDs are numbers -> Store them as number
+            payload += encodeVarints([0, int(couponID)])
+        else:
+            couponIDBytes = couponID.encode()
+            payload += encodeVarints([1, len(couponIDBytes)]) + couponIDBytes
+    callbackData = CALLBACK_DATA_PREFIX + callback.action + base64.urlsafe_b64encode(payload).decode().rstrip('=')
+    if len(callbackData.encode()) > CALLBACK_DATA_MAX_BYTES:
+        raise ValueError(f'callback_data is too long: {callbackData}')
+    return callbackData
+
+
+@lru_cache(maxsize=4096)
+def decodeCallbackData(callbackData: str) -> CouponCallback:
+    """ Decodes callback_data created via encodeCouponCallback and legacy '?a=' callback_data.
+     Raises ValueError on invalid data. """
+    if not callbackData.startswith(CALLBACK_DATA_PREFIX):
+        return decodeLegacyCallbackData(callbackData)
+    action = callbackData[len(CALLBACK_DATA_PREFIX):len(CALLBACK_DATA_PREFIX) + 1]
+    payloadBase64 = callbackData[len(CALLBACK_DATA_PREFIX) + 1:]
+    try:
+        payload = base64.urlsafe_b64decode(payloadBase64 + '=' * (-len(payloadBase64) % 4))
+        viewCode, position = decodeVarint(payload, 0)
+        couponType, position = decodeVarint(payload, position)
+        page, position = decodeVarint(payload, position)
+        couponID = None
+        if action == CallbackActions.DISPLAY_COUPON:
+            couponIDType, position = decodeVarint(payload, position)
+            couponIDValue, position = decodeVarint(payload, position)
+            if couponIDType == 0:
+                couponID = str(couponIDValue)
+            else:
+                couponID = payload[position:position + couponIDValue].decode()
+        elif action not in (CallbackActions.DISPLAY_COUPONS, CallbackActions.DISPLAY_COUPONS_CHANGE_SORT):
+            raise ValueError(f'Unknown action: {action}')
+    except (IndexError, UnicodeDecodeError, binascii.Error) as error:
+        raise ValueError(f'Invalid callback_data: {callbackData}') from error
+    return CouponCallback(action=action, viewCode=viewCode, couponType=None if couponType == 0 else couponType - 1, page=page, couponID=couponID)
+
+
+def decodeLegacyCallbackData(callbackData: str) -> CouponCallback:
+    """ Decodes old URL-like callback_data e.g. "?a=dc&plu=123&cb=%3Fa%3Ddcs%26m%3D0%26cs%3D". """
+    args = parse_qs(callbackData.lstrip('?'), keep_blank_values=True)
+    legacyAction = args.get('a', [None])[0]
+    if legacyAction == 'dc':
+        if 'cb' not in args or 'plu' not in args:
+            raise ValueError(f'Invalid callback_data: {callbackData}')
+        # The list state is only available in the back-link
+        listCallback = decodeLegacyCallbackData(args['cb'][0])
+        return listCallback.getCouponCallback(args['plu'][0])
+    elif legacyAction == 'dcs':
+        action = CallbackActions.DISPLAY_COUPONS
+    elif legacyAction == 'dcss':
+        action = CallbackActions.DISPLAY_COUPONS_CHANGE_SORT
+    else:
+        raise ValueError(f'Invalid callback_data: {callbackData}')
+    try:
+        couponTypeStr = args.get('cs', [''])[0]
+        return CouponCallback(action=action, viewCode=int(args['m'][0]), couponType=int(couponTypeStr) if len(couponTypeStr) > 0 else None,
+                              page=int(args.get('p', ['1'])[0]))
+    except (KeyError, ValueError) as error:
+        raise ValueError(f'Invalid callback_data: {callbackData}') from error
+
+
+def getDisplayCouponsCallbackData(viewCode: int, couponType: Union[int, None] = None) -> str:
+    """ Returns callback_data to display first page of given coupon view. """
+    return encodeCouponCallback(CouponCallback(action=CallbackActions.DISPLAY_COUPONS, viewCode=viewCode, couponType=couponType))
@@ -3,18 +3,16 @@ import os
 import re
 from datetime import datetime
 from io import BytesIO
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Tuple, Callable, Any
 
-from barcode.ean import EuropeanArticleNumber13
-from barcode.writer import ImageWriter
 from couchdb.mapping import TextField, FloatField, ListField, IntegerField, BooleanField, Document, DictField, Mapping, \
     DateTimeField
 from pydantic import BaseModel
 
 from BotUtils import getImageBasePath
-from Helper import getTimezone, getCurrentDate, getFilenameFromURL, SYMBOLS, normalizeString, formatDateGerman, couponTitleContainsFriesAndDrink, BotAllowedCouponTypes, \
+from Helper import getTimezone, getCurrentDate, getCurrentTimestamp, getFilenameFromURL, SYMBOLS, normalizeString, formatDateGerman, couponTitleContainsFriesAndDrink, BotAllowedCouponTypes, \
     CouponType, \
-    formatPrice, couponTitleContainsVeggieFood, shortenProductNames, couponTitleContainsPlantBasedFood
+    formatPrice, couponTitleContainsVeggieFood, shortenProductNames, couponTitleContainsPlantBasedFood, getPathImagesPaybackCards
 
 
 class CouponFilter(BaseModel):
@@ -36,69 +34,87 @@ class CouponFilter(BaseModel):
 
 class CouponSortMode:
 
-    def __init__(self, text: str, isDescending: bool = False):
+    def __init__(self, text: str, sortKey: Callable[[Any, float], Any], isDescending: bool = False):
         self.text = text
+        # Composite key: Every sort mode is a single stable sort with this key
+        self.sortKey = sortKey
         self.isDescending = isDescending
+        # Assigned once on import, see registerSortModes()
+        self.sortCode: Union[int, None] = None
+        self.nextSortMode: Union[CouponSortMode, None] = None
 
     def getSortCode(self) -> Union[int, None]:
         """ Returns position of current sort mode in array of all sort modes. """
-        sortModes = getAllSortModes()
-        index = 0
-        for sortMode in sortModes:
-            if sortMode == self:
-                return index
-            index += 1
-        # This should never happen
-        return None
+        return self.sortCode
 
 
-class CouponSortModes:
-    PRICE = CouponSortMode("Preis " + SYMBOLS.ARROW_UP)
-    PRICE_DESCENDING = CouponSortMode("Preis " + SYMBOLS.ARROW_DOWN, isDescending=True)
-    DISCOUNT = CouponSortMode("Rabatt " + SYMBOLS.ARROW_UP)
-    DISCOUNT_DESCENDING = CouponSortMode("Rabatt " + SYMBOLS.ARROW_DOWN, isDescending=True)
-    NEW = CouponSortMode("Neue Coupons " + SYMBOLS.ARROW_UP)
-    NEW_DESCENDING = CouponSortMode("Neue Coupons " + SYMBOLS.ARROW_DOWN, isDescending=True)
-    MENU_PRICE = CouponSortMode("Menü_Preis")
-    TYPE_MENU_PRICE = CouponSortMode("Typ_Menü_Preis")
+def sortKeyPrice(coupon, now: float):
+    return coupon.getSortKeys()[2]
+
+
+def sortKeyDiscount(coupon, now: float):
+    return coupon.getSortKeys()[3]
+
+
+def sortKeyNew(coupon, now: float):
+    return coupon.isNewCoupon(now)
+
+
+def sortKeyMenuPrice(coupon, now: float):
+    return coupon.getSortKeys()[1:3]
+
 
+def sortKeyTypeMenuPrice(coupon, now: float):
+    return coupon.getSortKeys()[0:3]
 
-def getAllSortModes() -> list:
+
+class CouponSortModes:
+    PRICE = CouponSortMode("Preis " + SYMBOLS.ARROW_UP, sortKey=sortKeyPrice)
+    PRICE_DESCENDING = CouponSortMode("Preis " + SYMBOLS.ARROW_DOWN, sortKey=sortKeyPrice, isDescending=True)
+    DISCOUNT = CouponSortMode("Rabatt " + SYMBOLS.ARROW_UP, sortKey=sortKeyDiscount)
+    DISCOUNT_DESCENDING = CouponSortMode("Rabatt " + SYMBOLS.ARROW_DOWN, sortKey=sortKeyDiscount, isDescending=True)
+    NEW = CouponSortMode("Neue Coupons " + SYMBOLS.ARROW_UP, sortKey=sortKeyNew)
+    NEW_DESCENDING = CouponSortMode("Neue Coupons " + SYMBOLS.ARROW_DOWN, sortKey=sortKeyNew, isDescending=True)
+    # Coupons without menu first, then by price
+    MENU_PRICE = CouponSortMode("Menü_Preis", sortKey=sortKeyMenuPrice)
+    # App coupons(source == 0) > Paper coupons, then same as MENU_PRICE
+    TYPE_MENU_PRICE = CouponSortMode("Typ_Menü_Preis", sortKey=sortKeyTypeMenuPrice)
+
+
+def registerSortModes() -> Tuple[CouponSortMode, ...]:
+    """ Assigns sort codes and successors to all sort modes. Only call this once on import. """
     # Important! The order of this will also determine the sort order which gets presented to the user!
-    res = []
-    for obj in CouponSortModes.__dict__.values():
-        if isinstance(obj, CouponSortMode):
-            res.append(obj)
-    return res
+    sortModes = tuple(obj for obj in CouponSortModes.__dict__.values() if isinstance(obj, CouponSortMode))
+    for sortCode, sortMode in enumerate(sortModes):
+        sortMode.sortCode = sortCode
+        # Last sortMode in list --> Next is the first one
+        sortMode.nextSortMode = sortModes[(sortCode + 1) % len(sortModes)]
+    return sortModes
+
+
+ALL_SORT_MODES = registerSortModes()
+
+
+def getAllSortModes() -> Tuple[CouponSortMode, ...]:
+    return ALL_SORT_MODES
 
 
 def getNextSortMode(currentSortMode: CouponSortMode) -> CouponSortMode:
-    allSortModes = getAllSortModes()
     if currentSortMode is None:
-        return allSortModes[0]
-    for index in range(len(allSortModes)):
-        sortMode = allSortModes[index]
-        if sortMode == currentSortMode:
-            if index == (len(allSortModes) - 1):
-                # Last sortMode in list --> Return first
-                return allSortModes[0]
-            else:
-                # Return next sortMode
-                return allSortModes[index + 1]
-    # Fallback, should not be needed
-    return currentSortMode
+        return ALL_SORT_MODES[0]
+    return currentSortMode.nextSortMode
 
 
 def getSortModeBySortCode(sortCode: int) -> CouponSortMode:
-    allSortModes = getAllSortModes()
-    if sortCode < len(allSortModes):
-        return allSortModes[sortCode]
+    if sortCode < len(ALL_SORT_MODES):
+        return ALL_SORT_MODES[sortCode]
     else:
         # Fallback
-        return allSortModes[0]
+        return ALL_SORT_MODES[0]
 
 
 class CouponView:
+    """ Views are shared by all users: Never modify them or their filter. Use getDerivedFilter for user specific filters. """
 
     def getFilter(self) -> CouponFilter:
         return self.couponfilter
@@ -110,17 +126,31 @@ class CouponView:
         self.includeVeggieSymbol = includeVeggieSymbol
         self.highlightFavorites = highlightFavorites
         self.allowModifyFilter = allowModifyFilter
+        # Assigned once on import, see registerCouponViews()
+        self.viewCode: Union[int, None] = None
+        self.derivedFilters = {}
 
     def getViewCode(self) -> Union[int, None]:
-        """ Returns position of current sort mode in array of all sort modes. """
-        couponViews = getAllCouponViews()
-        index = 0
-        for couponView in couponViews:
-            if couponView == self:
-                return index
-            index += 1
-        # This should never happen
-        return None
+        """ Returns position of current view in array of all views. """
+        return self.viewCode
+
+    def getDerivedFilter(self, couponType: Union[int, None], hideHidden: bool, hidePlantBased: bool) -> CouponFilter:
+        """ Returns filter of this view with user specific overrides applied. Filters only get created once per combination of overrides. """
+        key = (couponType, hideHidden, hidePlantBased)
+        derivedFilter = self.derivedFilters.get(key)
+        if derivedFilter is None:
+            overrides = {}
+            if couponType is not None:
+                overrides['allowedCouponTypes'] = [couponType]
+            if hideHidden and self.couponfilter.isHidden is None:
+                # User does not want to see hidden coupons within generic categories
+                overrides['isHidden'] = False
+            if hidePlantBased and self.couponfilter.isPlantBased is None:
+                # User does not want to see plant based coupons within generic categories
+                overrides['isPlantBased'] = False
+            derivedFilter = self.couponfilter.copy(update=overrides, deep=True)
+            self.derivedFilters[key] = derivedFilter
+        return derivedFilter
 
 
 class CouponViews:
@@ -139,54 +169,37 @@ class CouponViews:
                            title=f"{SYMBOLS.STAR}Favoriten{SYMBOLS.STAR}")
 
 
-def getAllCouponViews() -> List[CouponView]:
-    res = []
-    for obj in CouponViews.__dict__.values():
-        if isinstance(obj, CouponView):
-            res.append(obj)
-    return res
+def registerCouponViews() -> Tuple[CouponView, ...]:
+    """ Assigns view codes to all views. Only call this once on import. """
+    couponViews = tuple(obj for obj in CouponViews.__dict__.values() if isinstance(obj, CouponView))
+    for viewCode, couponView in enumerate(couponViews):
+        couponView.viewCode = viewCode
+    return couponViews
+
+
+ALL_COUPON_VIEWS = registerCouponViews()
+
+
+def getAllCouponViews() -> Tuple[CouponView, ...]:
+    return ALL_COUPON_VIEWS
 
 
 def getCouponViewByIndex(index: int) -> Union[CouponView, None]:
-    allCouponViews = getAllCouponViews()
-    if index < len(allCouponViews):
-        return allCouponViews[index]
+    if index < len(ALL_COUPON_VIEWS):
+        return ALL_COUPON_VIEWS[index]
     else:
         # Fallback
-        return allCouponViews[0]
+        return ALL_COUPON_VIEWS[0]
 
 
 COUPON_IS_NEW_FOR_SECONDS = 24 * 60 * 60
+""" Increase this whenever the handling of derived coupon fields changes to make sure that they will be re-computed. """
+COUPON_DERIVED_FIELDS_VERSION = 1
 
 
-class Coupon(Document):
-    plu = TextField()
-    uniqueID = TextField()
-    price = IntegerField()
-    priceCompare = IntegerField()
-    staticReducedPercent = IntegerField()
-    title = TextField()
-    subtitle = TextField()
-    timestampAddedToDB = FloatField(default=0)
-    timestampLastModifiedDB = FloatField(default=0)
-    timestampStart = FloatField(default=0)
-    timestampExpireInternal = FloatField()  # Internal expire-date
-    timestampExpire = FloatField()  # Expire date used by BK in their apps -> "Real" expire date.
-    timestampCouponNotInAPIAnymore = FloatField() # 2023-05-09: Not used at this moment
-    timestampIsNew = FloatField(default=0)  # Last timestamp from which on this coupon was new
-    dateFormattedExpire = TextField()
-    imageURL = TextField()
-    paybackMultiplicator = IntegerField()
-    productIDs = ListField(IntegerField())
-    type = IntegerField(name='source')  # Legacy. This is called "type" now!
-    isNewUntilDate = TextField()  # Date until which this coupon shall be treated as new. Use this as an override of default handling.
-    isHidden = BooleanField(default=False)  # Typically only available for upsell App coupons
-    description = TextField()
-    # TODO: Make use of this once it is possible for users to add coupons to DB via API
-    # addedVia = IntegerField()
-    tags = ListField(TextField())
-    webviewID = TextField()
-    webviewURL = TextField()
+class CouponBase:
+    """ All read methods shared by Coupon (DB document) and CouponRecord (compact in-memory representation). """
+    __slots__ = ()
 
     def __str__(self):
         return f'{self.id=} | {self.plu} | {self.getTitle()} | {self.getPriceFormatted()} | START: {self.getStartDateFormatted()} | END {self.getExpireDateFormatted()}  | WEBVIEW: {self.getWebviewURL()}'
@@ -198,7 +211,28 @@ class Coupon(Document):
         else:
             return False
 
+    def hasUpToDateDerivedFields(self) -> bool:
+        return self.derivedFieldsVersion == COUPON_DERIVED_FIELDS_VERSION
+
+    def updateDerivedFields(self):
+        """ (Re-)computes all derived texts needed to render this coupon so rendering becomes simple string concatenation.
+         Call this whenever a coupon is about to be added to/updated in DB. """
+        self.titleShortened = shortenProductNames(self.getTitle())
+        self.nutritionSymbol = self.computeNutritionSymbols()
+        self.redemptionHint = self.computePLUOrUniqueIDOrRedemptionHint()
+        self.priceInfoText = self.computePriceInfoText()
+        self.derivedFieldsVersion = COUPON_DERIVED_FIELDS_VERSION
+
+    def ensureDerivedFields(self):
+        """ Computes derived texts for coupons which haven't been stored via updateDerivedFields e.g. old favorites. """
+        if not self.hasUpToDateDerivedFields():
+            self.updateDerivedFields()
+
     def getPLUOrUniqueIDOrRedemptionHint(self) -> str:
+        self.ensureDerivedFields()
+        return self.redemptionHint
+
+    def computePLUOrUniqueIDOrRedemptionHint(self) -> str:
         """ Returns PLU if existant, returns UNIQUE_ID otherwise. """
         if self.plu is not None:
             return self.plu
@@ -222,7 +256,8 @@ class Coupon(Document):
         return self.subtitle
 
     def getTitleShortened(self, includeVeggieSymbol: bool) -> Union[str, None]:
-        shortenedTitle = shortenProductNames(self.getTitle())
+        self.ensureDerivedFields()
+        shortenedTitle = self.titleShortened
         if includeVeggieSymbol:
             nutritionSymbol = self.getNutritionSymbols()
             if nutritionSymbol is not None:
@@ -230,6 +265,10 @@ class Coupon(Document):
         return shortenedTitle
 
     def getNutritionSymbols(self) -> Union[str, None]:
+        self.ensureDerivedFields()
+        return self.nutritionSymbol
+
+    def computeNutritionSymbols(self) -> Union[str, None]:
         if not self.isEatable():
             return None
         enableMeatSymbol = False
@@ -255,26 +294,31 @@ class Coupon(Document):
             """ Coupon is not expired or not "long enough". """
             return False
 
-    def isExpired(self) -> bool:
-        expireDatetime = self.getExpireDatetime()
-        if expireDatetime is None or expireDatetime < getCurrentDate():
+    def isExpired(self, now: Union[float, None] = None) -> bool:
+        """ :param now: Timestamp to check against. Pass this to evaluate multiple coupons against the same point in time. """
+        if now is None:
+            now = getCurrentTimestamp()
+        if self.timestampExpire is None or self.timestampExpire < now:
             # Coupon is expired
             return True
         else:
             return False
 
-    def isNotYetActive(self) -> bool:
-        startDatetime = self.getStartDatetime()
-        if startDatetime is not None and startDatetime > getCurrentDate():
+    def isNotYetActive(self, now: Union[float, None] = None) -> bool:
+        if now is None:
+            now = getCurrentTimestamp()
+        if self.timestampStart is not None and self.timestampStart > 0 and self.timestampStart > now:
             # Start time hasn't been reached yet -> Coupon is not valid yet
             return True
         else:
             return False
 
-    def isValid(self) -> bool:
+    def isValid(self, now: Union[float, None] = None) -> bool:
         """ If this returns true, we can present the coupon to the user.
          If this returns false, this usually means that the coupon is expired or not yet available. """
-        if self.isExpired() or self.isNotYetActive():
+        if now is None:
+            now = getCurrentTimestamp()
+        if self.isExpired(now) or self.isNotYetActive(now):
             return False
         else:
             return True
@@ -282,6 +326,17 @@ class Coupon(Document):
     def isContainsFriesAndDrink(self) -> bool:
         return couponTitleContainsFriesAndDrink(self.getTitle())
 
+    def getCouponStats(self) -> 'CouponStats':
+        """ Returns contribution of this coupon to aggregated information about sets of coupons e.g. used by CouponCategory. """
+        return CouponStats.fromCoupon(self)
+
+    def getSortKeys(self) -> Tuple[int, bool, float, float]:
+        """ Returns all time independent values used by CouponSortModes: (type, containsFriesAndDrink, price, reducedPercentage).
+         Missing prices/discounts are replaced by values which place those coupons at the beginning. """
+        price = self.getPrice()
+        reducedPercentage = self.getReducedPercentage()
+        return self.type, self.isContainsFriesAndDrink(), -1 if price is None else price, 0 if reducedPercentage is None else reducedPercentage
+
     def isPlantBased(self) -> bool:
         if self.tags is not None:
             # First check tags
@@ -367,9 +422,9 @@ class Coupon(Document):
         else:
             return True
 
-    def isNewCoupon(self) -> bool:
+    def isNewCoupon(self, now: Union[float, None] = None) -> bool:
         """ Determines whether or not this coupon is considered 'new'. """
-        currentTimestamp = getCurrentDate().timestamp()
+        currentTimestamp = now if now is not None else getCurrentTimestamp()
         timePassedSinceCouponWasAddedToDB = currentTimestamp - self.timestampAddedToDB
         if timePassedSinceCouponWasAddedToDB < COUPON_IS_NEW_FOR_SECONDS:
             return True
@@ -389,7 +444,7 @@ class Coupon(Document):
             try:
                 enforceIsNewOverrideUntilDate = datetime.strptime(self.isNewUntilDate + ' 23:59:59',
                                                                   '%Y-%m-%d %H:%M:%S').astimezone(getTimezone())
-                if enforceIsNewOverrideUntilDate.timestamp() > getCurrentDate().timestamp():
+                if enforceIsNewOverrideUntilDate.timestamp() > currentTimestamp:
                     return True
                 else:
                     return False
@@ -510,10 +565,10 @@ class Coupon(Document):
         else:
             return None
 
-    def generateCouponShortText(self, highlightIfNew: bool, includeVeggieSymbol: bool) -> str:
+    def generateCouponShortText(self, highlightIfNew: bool, includeVeggieSymbol: bool, now: Union[float, None] = None) -> str:
         """ Returns e.g. "Y15 | 2Whopper+M🍟+0,4Cola | 8,99€" """
         couponText = ''
-        if highlightIfNew and self.isNewCoupon():
+        if highlightIfNew and self.isNewCoupon(now):
             couponText += SYMBOLS.NEW
         couponText += self.getPLUOrUniqueIDOrRedemptionHint() + " | " + self.getTitleShortened(includeVeggieSymbol=includeVeggieSymbol)
         couponText = self.appendPriceInfoText(couponText)
@@ -593,15 +648,16 @@ class Coupon(Document):
         return couponText
 
     def appendPriceInfoText(self, couponText: str) -> str:
-        priceFormatted = self.getPriceFormatted()
-        if priceFormatted is not None:
-            couponText += " | " + priceFormatted
-        reducedPercentage = self.getReducedPercentageFormatted()
-        if reducedPercentage is not None:
-            couponText += " | " + reducedPercentage
+        priceInfoText = self.getPriceInfoText()
+        if priceInfoText is not None:
+            couponText += " | " + priceInfoText
         return couponText
 
     def getPriceInfoText(self) -> Union[str, None]:
+        self.ensureDerivedFields()
+        return self.priceInfoText
+
+    def computePriceInfoText(self) -> Union[str, None]:
         priceInfoText = None
         priceFormatted = self.getPriceFormatted()
         if priceFormatted is not None:
@@ -615,6 +671,135 @@ class Coupon(Document):
         return priceInfoText
 
 
+class Coupon(Document, CouponBase):
+    """ Coupon as stored in DB. Use CouponRecord for coupons which are only held in memory for reading. """
+    plu = TextField()
+    uniqueID = TextField()
+    price = IntegerField()
+    priceCompare = IntegerField()
+    staticReducedPercent = IntegerField()
+    title = TextField()
+    subtitle = TextField()
+    timestampAddedToDB = FloatField(default=0)
+    timestampLastModifiedDB = FloatField(default=0)
+    timestampStart = FloatField(default=0)
+    timestampExpireInternal = FloatField()  # Internal expire-date
+    timestampExpire = FloatField()  # Expire date used by BK in their apps -> "Real" expire date.
+    timestampCouponNotInAPIAnymore = FloatField() # 2023-05-09: Not used at this moment
+    timestampIsNew = FloatField(default=0)  # Last timestamp from which on this coupon was new
+    dateFormattedExpire = TextField()
+    imageURL = TextField()
+    paybackMultiplicator = IntegerField()
+    productIDs = ListField(IntegerField())
+    type = IntegerField(name='source')  # Legacy. This is called "type" now!
+    isNewUntilDate = TextField()  # Date until which this coupon shall be treated as new. Use this as an override of default handling.
+    isHidden = BooleanField(default=False)  # Typically only available for upsell App coupons
+    description = TextField()
+    # TODO: Make use of this once it is possible for users to add coupons to DB via API
+    # addedVia = IntegerField()
+    tags = ListField(TextField())
+    webviewID = TextField()
+    webviewURL = TextField()
+    # Derived texts: Computed once per coupon version, see updateDerivedFields()
+    derivedFieldsVersion = IntegerField()
+    titleShortened = TextField()
+    nutritionSymbol = TextField()
+    redemptionHint = TextField()
+    priceInfoText = TextField()
+
+
+class CouponRecord(CouponBase):
+    """ Compact read-only representation of a Coupon: Plain attributes without any field conversion or per-instance dict.
+     Use this for coupons which are held in memory and scanned a lot e.g. for filtering, sorting and rendering. """
+    __slots__ = ('id', 'sortKeys', 'couponStats') + tuple(Coupon._fields)
+
+    @staticmethod
+    def fromCoupon(coupon: Coupon) -> 'CouponRecord':
+        record = CouponRecord()
+        record.id = coupon.id
+        for fieldName in Coupon._fields:
+            value = getattr(coupon, fieldName)
+            if isinstance(value, list):
+                value = tuple(value)
+            setattr(record, fieldName, value)
+        record.sortKeys = None
+        record.couponStats = None
+        return record
+
+    def getSortKeys(self) -> Tuple[int, bool, float, float]:
+        """ Records are never modified -> Sort keys only need to be computed once. """
+        if self.sortKeys is None:
+            self.sortKeys = CouponBase.getSortKeys(self)
+        return self.sortKeys
+
+    def getCouponStats(self) -> 'CouponStats':
+        """ Records are never modified -> Contribution only needs to be computed once. """
+        if self.couponStats is None:
+            self.couponStats = CouponStats.fromCoupon(self)
+        return self.couponStats
+
+    def toCoupon(self) -> Coupon:
+        """ Returns Coupon document containing the data of this record e.g. to store it in DB. """
+        values = {}
+        for fieldName in Coupon._fields:
+            value = getattr(self, fieldName)
+            if isinstance(value, tuple):
+                value = list(value)
+            values[fieldName] = value
+        return Coupon(id=self.id, **values)
+
+
+class CouponStats:
+    """ Time independent aggregated information about a set of coupons.
+     Stats can be merged: Stats of any set of coupons can be built from the stats of single coupons without evaluating the coupons again. """
+    __slots__ = ('couponTypes', 'numberofCouponsTotal', 'numberofCouponsHidden', 'numberofCouponsEatable', 'numberofCouponsEatableWithPrice', 'numberofCouponsWithFriesAndDrink',
+                 'numberofVeggieCoupons', 'totalPrice', 'expireTimestampLowest', 'expireTimestampHighest')
+
+    def __init__(self):
+        """ Creates stats of an empty set of coupons. """
+        self.couponTypes = set()
+        self.numberofCouponsTotal = 0
+        self.numberofCouponsHidden = 0
+        self.numberofCouponsEatable = 0
+        self.numberofCouponsEatableWithPrice = 0
+        self.numberofCouponsWithFriesAndDrink = 0
+        self.numberofVeggieCoupons = 0
+        self.totalPrice = 0
+        self.expireTimestampLowest = None
+        self.expireTimestampHighest = None
+
+    @staticmethod
+    def fromCoupon(coupon: CouponBase) -> 'CouponStats':
+        stats = CouponStats()
+        stats.couponTypes.add(coupon.type)
+        stats.numberofCouponsTotal = 1
+        stats.numberofCouponsHidden = 1 if coupon.isHidden else 0
+        stats.numberofCouponsEatable = 1 if coupon.isEatable() else 0
+        stats.numberofCouponsWithFriesAndDrink = 1 if coupon.isContainsFriesAndDrink() else 0
+        stats.numberofVeggieCoupons = 1 if coupon.isVeggie() else 0
+        if coupon.getPrice() is not None:
+            stats.totalPrice = coupon.getPrice()
+            stats.numberofCouponsEatableWithPrice = 1
+        stats.expireTimestampLowest = coupon.timestampExpire
+        stats.expireTimestampHighest = coupon.timestampExpire
+        return stats
+
+    def merge(self, other: 'CouponStats'):
+        """ Adds given stats to this one. Given stats are not modified. """
+        self.couponTypes.update(other.couponTypes)
+        self.numberofCouponsTotal += other.numberofCouponsTotal
+        self.numberofCouponsHidden += other.numberofCouponsHidden
+        self.numberofCouponsEatable += other.numberofCouponsEatable
+        self.numberofCouponsEatableWithPrice += other.numberofCouponsEatableWithPrice
+        self.numberofCouponsWithFriesAndDrink += other.numberofCouponsWithFriesAndDrink
+        self.numberofVeggieCoupons += other.numberofVeggieCoupons
+        self.totalPrice += other.totalPrice
+        if other.expireTimestampLowest is not None and (self.expireTimestampLowest is None or other.expireTimestampLowest < self.expireTimestampLowest):
+            self.expireTimestampLowest = other.expireTimestampLowest
+        if other.expireTimestampHighest is not None and (self.expireTimestampHighest is None or other.expireTimestampHighest > self.expireTimestampHighest):
+            self.expireTimestampHighest = other.expireTimestampHighest
+
+
 class UserFavoritesInfo:
     """ Helper class for users favorites. """
 
@@ -649,6 +834,8 @@ MAX_SECONDS_WITHOUT_USAGE_UNTIL_SEND_WARNING_TO_USER = MAX_SECONDS_WITHOUT_USAGE
 MAX_HOURS_ACTIVITY_TRACKING = 48
 MAX_TIMES_INFORM_ABOUT_UPCOMING_AUTO_ACCOUNT_DELETION = 3
 MIN_SECONDS_BETWEEN_UPCOMING_AUTO_DELETION_WARNING = 2 * 24 * 60 * 60
+# Key under which custom SortModes of all modifiable CouponViews used to be stored in User.couponViewSortModes
+LEGACY_COUPON_VIEW_SORT_MODE_KEY = 'None'
 
 
 class User(Document):
@@ -760,8 +947,9 @@ class User(Document):
         else:
             return False
 
-    def addFavoriteCoupon(self, coupon: Coupon):
-        self.favoriteCoupons[coupon.id] = coupon._data
+    def addFavoriteCoupon(self, coupon: Union[Coupon, CouponRecord]):
+        """ Only stores a reference to the coupon. The coupon itself can be found in the coupon archive DB even after it has expired. """
+        self.favoriteCoupons[coupon.id] = {'normalizedTitle': coupon.getNormalizedTitle(), 'timestampAdded': getCurrentTimestamp()}
 
     def deleteFavoriteCoupon(self, coupon: Coupon):
         self.deleteFavoriteCouponID(coupon.id)
@@ -789,11 +977,32 @@ class User(Document):
         else:
             return None
 
+    def getPaybackCardImagePath(self) -> str:
+        return getPaybackCardImagePath(self.getPaybackCardNumber())
+
     def getPaybackCardImage(self) -> bytes:
+        """ Returns barcode of the users' Payback card. Rendered barcodes are kept on disk so every card number only gets rendered once. """
+        imagePath = self.getPaybackCardImagePath()
+        if os.path.isfile(imagePath):
+            with open(imagePath, mode='rb') as infile:
+                return infile.read()
+        # Imported here as barcode + PIL take a while to import and are rarely needed
+        from barcode.ean import EuropeanArticleNumber13
+        from barcode.writer import ImageWriter
         ean = EuropeanArticleNumber13(ean='240' + self.getPaybackCardNumber(), writer=ImageWriter())
         file = BytesIO()
         ean.write(file, options={'foreground': 'black'})
-        return file.getvalue()
+        image = file.getvalue()
+        try:
+            os.makedirs(getPathImagesPaybackCards(), exist_ok=True)
+            # Write to temp file first so other bot processes never read half written images
+            tempPath = f'{imagePath}.{os.getpid()}.tmp'
+            with open(tempPath, mode='wb') as outfile:
+                outfile.write(image)
+            os.replace(tempPath, imagePath)
+        except OSError:
+            logging.warning(f'Failed to store Payback card image: {imagePath}', exc_info=True)
+        return image
 
     def addPaybackCard(self, paybackCardNumber: str):
         if self.paybackCard is None or len(self.paybackCard) == 0:
@@ -806,31 +1015,40 @@ class User(Document):
         dummyUser = User()
         self.paybackCard = dummyUser.paybackCard
 
-    def getUserFavoritesInfo(self, couponsFromDB: dict, returnSortedCoupons: bool) -> UserFavoritesInfo:
+    def getUserFavoritesInfo(self, couponsFromDB: dict, returnSortedCoupons: bool, now: Union[float, None] = None,
+                             archivedCoupons: Union[dict, None] = None, duplicateIndex: Union['CouponDuplicateIndex', None] = None) -> UserFavoritesInfo:
         """
         Gathers information about the given users' favorite available/unavailable coupons.
         Coupons from DB are required to get current dataset of available favorites.
+        Archived coupons are used to display unavailable favorites. If they are not given, unavailable favorites will only contain ID and normalized title.
+        Duplicate index of coupons from DB is used to remove duplicates if the user wishes so.
         """
         if len(self.favoriteCoupons) == 0:
             # User does not have any favorites set --> There is no point to look for the additional information
             return UserFavoritesInfo()
+        if now is None:
+            now = getCurrentTimestamp()
         availableFavoriteCoupons = []
         unavailableFavoriteCoupons = []
-        for uniqueCouponID, coupon in self.favoriteCoupons.items():
+        for uniqueCouponID, favorite in self.favoriteCoupons.items():
             couponFromProductiveDB = couponsFromDB.get(uniqueCouponID)
-            if couponFromProductiveDB is not None and couponFromProductiveDB.isValid():
+            if couponFromProductiveDB is not None and couponFromProductiveDB.isValid(now):
                 availableFavoriteCoupons.append(couponFromProductiveDB)
             else:
                 # User chosen favorite coupon has expired or is not in DB
-                coupon = Coupon.wrap(coupon)  # We want a 'real' coupon object
+                coupon = None
+                if archivedCoupons is not None:
+                    coupon = archivedCoupons.get(uniqueCouponID)
+                if coupon is None:
+                    coupon = getCouponFromFavorite(uniqueCouponID, favorite)
                 unavailableFavoriteCoupons.append(coupon)
         # Sort all coupon arrays by price
         if self.settings.hideDuplicates:
-            availableFavoriteCoupons = removeDuplicatedCoupons(availableFavoriteCoupons)
+            availableFavoriteCoupons = list(removeDuplicatedCoupons(availableFavoriteCoupons, duplicateIndex=duplicateIndex).values())
         if returnSortedCoupons:
             favoritesFilter = CouponViews.FAVORITES.getFilter()
-            availableFavoriteCoupons = sortCouponsAsList(availableFavoriteCoupons, favoritesFilter.sortCode)
-            unavailableFavoriteCoupons = sortCouponsAsList(unavailableFavoriteCoupons, favoritesFilter.sortCode)
+            availableFavoriteCoupons = sortCouponsAsList(availableFavoriteCoupons, favoritesFilter.sortCode, now=now)
+            unavailableFavoriteCoupons = sortCouponsAsList(unavailableFavoriteCoupons, favoritesFilter.sortCode, now=now)
         return UserFavoritesInfo(favoritesAvailable=availableFavoriteCoupons,
                                  favoritesUnavailable=unavailableFavoriteCoupons)
 
@@ -838,6 +1056,9 @@ class User(Document):
         if self.couponViewSortModes is not None:
             # User has at least one custom sortCode for one CouponView.
             sortCode = self.couponViewSortModes.get(str(couponView.getViewCode()))
+            if sortCode is None and couponView.allowModifyFilter:
+                # Legacy: Custom SortModes of all modifiable CouponViews used to be stored under key "None"
+                sortCode = self.couponViewSortModes.get(LEGACY_COUPON_VIEW_SORT_MODE_KEY)
             if sortCode is not None:
                 # User has saved SortMode for this CouponView.
                 return getSortModeBySortCode(sortCode=sortCode)
@@ -962,6 +1183,13 @@ class InfoEntry(Document):
     couponTypeOverviewMessageIDs = DictField(default={})
     messageIDsToDelete = ListField(IntegerField(), default=[])
     lastMaintenanceModeState = BooleanField()
+    databaseVersion = IntegerField(default=0)  # Used to determine which DB migrations need to be done
+    # Steps of the current/last channel update and how many of them are done, see BotNotificator.updatePublicChannel
+    channelUpdatePlan = DictField()
+
+    def hasUnfinishedChannelUpdatePlan(self) -> bool:
+        plan = self.channelUpdatePlan
+        return plan is not None and len(plan) > 0 and plan['numberofDoneSteps'] < len(plan['steps'])
 
     def addMessageIDToDelete(self, messageID: int) -> bool:
         # Avoid duplicates
@@ -1028,6 +1256,31 @@ class ChannelCoupon(Document):
         return self.channelMessageID_image
 
 
+def getPaybackCardImagePath(paybackCardNumber: str) -> str:
+    return f'{getPathImagesPaybackCards()}/{paybackCardNumber}.png'
+
+
+def deletePaybackCardImage(paybackCardNumber: str) -> None:
+    """ Deletes rendered barcode of given Payback card number from disk if it exists. """
+    try:
+        os.remove(getPaybackCardImagePath(paybackCardNumber))
+    except FileNotFoundError:
+        pass
+
+
+def isLegacyFavorite(favorite: dict) -> bool:
+    """ Old user documents contain a full copy of each favorite coupon instead of only a reference to it. """
+    return 'normalizedTitle' not in favorite
+
+
+def getCouponFromFavorite(uniqueCouponID: str, favorite: dict) -> Coupon:
+    """ Returns coupon object for given favorite entry. For new entries this will only contain ID and normalized title. """
+    if isLegacyFavorite(favorite):
+        return Coupon.wrap(favorite)
+    else:
+        return Coupon(id=uniqueCouponID, title=favorite['normalizedTitle'])
+
+
 def getCouponsTotalPrice(coupons: List[Coupon]) -> float:
     """ Returns the total summed price of a list of coupons. """
     totalSum = 0
@@ -1039,10 +1292,13 @@ def getCouponsTotalPrice(coupons: List[Coupon]) -> float:
 
 def getCouponsSeparatedByType(coupons: dict) -> dict:
     """ Returns dict containing lists of coupons by type """
+    couponsByType = {}
+    for coupon in coupons.values():
+        couponsByType.setdefault(coupon.type, []).append(coupon)
     couponsSeparatedByType = {}
     for couponType in BotAllowedCouponTypes:
-        couponsTmp = list(filter(lambda x: x[Coupon.type.name] == couponType, list(coupons.values())))
-        if couponsTmp is not None and len(couponsTmp) > 0:
+        couponsTmp = couponsByType.get(couponType)
+        if couponsTmp is not None:
             couponsSeparatedByType[couponType] = couponsTmp
     return couponsSeparatedByType
 
@@ -1063,12 +1319,14 @@ def sortCouponsByDiscount(couponList: List[Coupon], descending: bool = False) ->
                   key=lambda x: 0 if x.getReducedPercentage() is None else x.getReducedPercentage(), reverse=descending)
 
 
-def sortCouponsByNew(couponList: List[Coupon], descending: bool = False) -> List[Coupon]:
+def sortCouponsByNew(couponList: List[Coupon], descending: bool = False, now: Union[float, None] = None) -> List[Coupon]:
     """Sort by price -> But price is not always given -> Place items without prices at the BEGINNING of each list."""
     if isinstance(couponList, dict):
         couponList = couponList.values()
+    if now is None:
+        now = getCurrentTimestamp()
     return sorted(couponList,
-                  key=lambda x: x.isNewCoupon(), reverse=descending)
+                  key=lambda x: x.isNewCoupon(now), reverse=descending)
 
 
 def getCouponTitleMapping(coupons: Union[dict, list]) -> dict:
@@ -1086,17 +1344,12 @@ class SettingCategory:
 
     def __init__(self, title: str):
         self.title = title
+        # Assigned once on import, see registerSettingCategories()
+        self.viewCode: Union[int, None] = None
 
     def getViewCode(self) -> Union[int, None]:
-        """ Returns position of current sort mode in array of all sort modes. """
-        couponViews = getAllCouponViews()
-        index = 0
-        for couponView in couponViews:
-            if couponView == self:
-                return index
-            index += 1
-        # This should never happen
-        return None
+        """ Returns position of current setting category in array of all setting categories. """
+        return self.viewCode
 
 
 class SettingCategories:
@@ -1107,6 +1360,17 @@ class SettingCategories:
     MISC = SettingCategory(title='Sonstige')
 
 
+def registerSettingCategories() -> Tuple[SettingCategory, ...]:
+    """ Assigns view codes to all setting categories. Only call this once on import. """
+    settingCategories = tuple(obj for obj in SettingCategories.__dict__.values() if isinstance(obj, SettingCategory))
+    for viewCode, settingCategory in enumerate(settingCategories):
+        settingCategory.viewCode = viewCode
+    return settingCategories
+
+
+ALL_SETTING_CATEGORIES = registerSettingCategories()
+
+
 USER_SETTINGS_ON_OFF = {
     # TODO: Obtain these Keys and default values from "User" Mapping class and remove this mess!
     "displayCouponCategoryAllCouponsLongListWithLongTitles": {
@@ -1243,118 +1507,76 @@ if DISPLAY_BETA_SETTING:
     }
 
 
-def removeDuplicatedCoupons(coupons: Union[List[Coupon], dict]) -> dict:
-    couponTitleMappingTmp = getCouponTitleMapping(coupons)
-    # Now clean our mapping: Sometimes one product may be available twice with multiple prices -> We want exactly one mapping per title
-    couponsWithoutDuplicates = {}
-    for normalizedTitle, coupons in couponTitleMappingTmp.items():
-        couponsForDuplicateRemoval = []
+def getDuplicateRank(coupon) -> Tuple[float, bool]:
+    """ Returns rank of a coupon within a group of coupons containing the same products: Cheapest first, App coupons preferred on same price. """
+    return coupon.getSortKeys()[2], coupon.type != CouponType.APP
+
+
+class CouponDuplicateIndex:
+    """ Groups coupons containing the same products (= same normalized title) and ranks them within their group.
+     Build this once per set of coupons, then duplicates can be removed from any subset of it without normalizing titles or sorting again. """
+
+    def __init__(self, coupons: Union[List[CouponBase], dict]):
+        # couponID -> (normalizedTitle, rank within group). Coupons which are not eligible for duplicate removal are not contained.
+        self.ranks = {}
+        # couponID -> ID of the preferred coupon of its group
+        self.canonicalCouponIDs = {}
+        for normalizedTitle, couponsOfGroup in getCouponTitleMapping(coupons).items():
+            couponsForDuplicateRemoval = sorted((coupon for coupon in couponsOfGroup if coupon.isEligibleForDuplicateRemoval()), key=getDuplicateRank)
+            for rank, coupon in enumerate(couponsForDuplicateRemoval):
+                self.ranks[coupon.id] = (normalizedTitle, rank)
+                self.canonicalCouponIDs[coupon.id] = couponsForDuplicateRemoval[0].id
+
+    def getCanonicalCouponID(self, couponID: str) -> str:
+        return self.canonicalCouponIDs.get(couponID, couponID)
+
+    def removeDuplicates(self, coupons: Union[List[CouponBase], dict]) -> dict:
+        """ Returns dict of given coupons containing only the best ranked coupon of each group present in the given coupons. Order is preserved. """
+        if isinstance(coupons, dict):
+            coupons = coupons.values()
+        bestRanks = {}
         for coupon in coupons:
-            if coupon.isEligibleForDuplicateRemoval():
-                couponsForDuplicateRemoval.append(coupon)
-            else:
-                # We cannot remove this coupon as duplicate by title -> Add it to our final results list
+            rankInfo = self.ranks.get(coupon.id)
+            if rankInfo is None:
+                continue
+            normalizedTitle, rank = rankInfo
+            bestRank = bestRanks.get(normalizedTitle)
+            if bestRank is None or rank < bestRank:
+                bestRanks[normalizedTitle] = rank
+        couponsWithoutDuplicates = {}
+        for coupon in coupons:
+            rankInfo = self.ranks.get(coupon.id)
+            if rankInfo is None or bestRanks[rankInfo[0]] == rankInfo[1]:
+                # Coupon is either not eligible for duplicate removal/unknown to this index or it is the best one of its group
                 couponsWithoutDuplicates[coupon.id] = coupon
-        # Check if anything is left to do
-        if len(couponsForDuplicateRemoval) == 0:
-            continue
-        # Sort these ones by price and pick the first (= cheapest) one for our mapping.
-        isDifferentPrices = False
-        firstPrice = None
-        appCoupon = None
-        if len(couponsForDuplicateRemoval) == 1:
-            coupon = couponsForDuplicateRemoval[0]
-            couponsWithoutDuplicates[coupon.id] = coupon
-            continue
-        for coupon in couponsForDuplicateRemoval:
-            if firstPrice is None:
-                firstPrice = coupon.getPrice()
-            elif coupon.getPrice() != firstPrice:
-                isDifferentPrices = True
-            if coupon.type == CouponType.APP:
-                appCoupon = coupon
-        if isDifferentPrices:
-            # Prefer cheapest coupon
-            couponsSorted = sortCouponsByPrice(couponsForDuplicateRemoval)
-            coupon = couponsSorted[0]
-        elif appCoupon is not None:
-            # Same prices but different sources -> Prefer App coupon
-            coupon = appCoupon
-        else:
-            # Same prices but all coupons are from the same source -> Should never happen but we'll cover it anyways -> Select first item.
-            coupon = couponsForDuplicateRemoval[0]
-        couponsWithoutDuplicates[coupon.id] = coupon
-    numberofRemovedDuplicates = len(coupons) - len(couponsWithoutDuplicates)
-    logging.debug("Number of removed duplicates: " + str(numberofRemovedDuplicates))
-    return couponsWithoutDuplicates
+        logging.debug("Number of removed duplicates: " + str(len(coupons) - len(couponsWithoutDuplicates)))
+        return couponsWithoutDuplicates
+
+
+def removeDuplicatedCoupons(coupons: Union[List[Coupon], dict], duplicateIndex: Union[CouponDuplicateIndex, None] = None) -> dict:
+    """ Removes coupons containing the same products. Pass an index containing all given coupons to avoid building one on every call. """
+    if duplicateIndex is None:
+        duplicateIndex = CouponDuplicateIndex(coupons)
+    return duplicateIndex.removeDuplicates(coupons)
 
 
-def sortCoupons(coupons: Union[list, dict], sortCode: Union[int, CouponSortMode]) -> dict:
-    coupons = sortCouponsAsList(coupons, sortCode)
+def sortCoupons(coupons: Union[list, dict], sortCode: Union[int, CouponSortMode], now: Union[float, None] = None) -> dict:
+    coupons = sortCouponsAsList(coupons, sortCode, now=now)
     filteredAndSortedCouponsDict = {}
     for coupon in coupons:
         filteredAndSortedCouponsDict[coupon.id] = coupon
     return filteredAndSortedCouponsDict
 
 
-def sortCouponsAsList(coupons: Union[list, dict], sortCode: Union[int, CouponSortMode]) -> dict:
+def sortCouponsAsList(coupons: Union[list, dict], sortCode: Union[int, CouponSortMode], now: Union[float, None] = None) -> list:
+    """ Sorts coupons with one stable sort via the composite key of the given sort mode. """
     if isinstance(coupons, dict):
-        coupons = list(coupons.values())
+        coupons = coupons.values()
     if isinstance(sortCode, CouponSortMode):
         sortMode = sortCode
     else:
         sortMode = getSortModeBySortCode(sortCode)
-    if sortMode == CouponSortModes.TYPE_MENU_PRICE:
-        couponsWithoutFriesAndDrink = []
-        couponsWithFriesAndDrink = []
-        allContainedCouponTypes = []
-        for coupon in coupons:
-            if coupon.type not in allContainedCouponTypes:
-                allContainedCouponTypes.append(coupon.type)
-            if coupon.isContainsFriesAndDrink():
-                couponsWithFriesAndDrink.append(coupon)
-            else:
-                couponsWithoutFriesAndDrink.append(coupon)
-        couponsWithoutFriesAndDrink = sortCouponsByPrice(couponsWithoutFriesAndDrink)
-        couponsWithFriesAndDrink = sortCouponsByPrice(couponsWithFriesAndDrink)
-        # Merge them together again.
-        coupons = couponsWithoutFriesAndDrink + couponsWithFriesAndDrink
-        # App coupons(source == 0) > Paper coupons
-        allContainedCouponTypes.sort()
-        # Separate sorted coupons by type
-        couponsSeparatedByType = {}
-        for couponType in allContainedCouponTypes:
-            couponsTmp = list(filter(lambda x: x.type == couponType, coupons))
-            couponsSeparatedByType[couponType] = couponsTmp
-        # Put our list sorted by type together again -> Sort done
-        coupons = []
-        for allCouponsOfOneSourceType in couponsSeparatedByType.values():
-            coupons += allCouponsOfOneSourceType
-    elif sortMode == CouponSortModes.MENU_PRICE:
-        couponsWithoutFriesAndDrink = []
-        couponsWithFriesAndDrink = []
-        for coupon in coupons:
-            if coupon.isContainsFriesAndDrink():
-                couponsWithFriesAndDrink.append(coupon)
-            else:
-                couponsWithoutFriesAndDrink.append(coupon)
-        couponsWithoutFriesAndDrink = sortCouponsByPrice(couponsWithoutFriesAndDrink)
-        couponsWithFriesAndDrink = sortCouponsByPrice(couponsWithFriesAndDrink)
-        # Merge them together again.
-        coupons = couponsWithoutFriesAndDrink + couponsWithFriesAndDrink
-    elif sortMode == CouponSortModes.PRICE:
-        coupons = sortCouponsByPrice(coupons)
-    elif sortMode == CouponSortModes.PRICE_DESCENDING:
-        coupons = sortCouponsByPrice(coupons, descending=True)
-    elif sortMode == CouponSortModes.DISCOUNT:
-        coupons = sortCouponsByDiscount(coupons)
-    elif sortMode == CouponSortModes.DISCOUNT_DESCENDING:
-        coupons = sortCouponsByDiscount(coupons, descending=True)
-    elif sortMode == CouponSortModes.NEW:
-        coupons = sortCouponsByNew(coupons)
-    elif sortMode == CouponSortModes.NEW_DESCENDING:
-        coupons = sortCouponsByNew(coupons, descending=True)
-    else:
-        # This should never happen
-        logging.warning("Developer mistake!! Unknown sortMode: " + str(sortMode))
-    return coupons
+    if now is None:
+        now = getCurrentTimestamp()
+    sortKey = sortMode.sortKey
+    return sorted(coupons, key=lambda coupon: sortKey(coupon, now), reverse=sortMode.isDescending)
@@ -0,0 +1,68 @@
+import re
+
+""" All regular expressions used on hot paths (coupon title parsing/shortening, crawler). Every pattern is compiled only once on import. """
+
+REGEX_PLU_WITH_AT_LEAST_ONE_LETTER = re.compile(r'(?i)^([A-Z]+)\d+[A-Z]?$')
+REGEX_NON_WORD_CHARACTERS = re.compile(r'[\W_]+')
+REGEX_FILENAME_FROM_URL = re.compile(r'(?i)^http.*[/=]([\w-]+\.(jpe?g|png))')
+REGEX_KING_JR_MEAL = re.compile(r'.*king\s*jr\s*\.?\s*meal.*')
+REGEX_KING_JR_MENU = re.compile(r'.*king\s*jr\s*\.?\s*menü.*')
+REGEX_RED_BULL = re.compile(r'red\s*bull')
+
+""" Crawler """
+REGEX_APP_COUPON_INTERNAL_NAME = re.compile(r'[A-Za-z0-9]+_\d+_(?:UPSELL_|CRM_MYBK_|MYBK_|\d{3,}_)?(.+)')
+REGEX_APP_COUPON_FOOTNOTE_EXPIRE_DATE = re.compile(r'(?i)Abgabe bis (\d{1,2}\.\d{1,2}\.\d{4})')
+
+""" Coupon title shortening: Rules which depend on each other and thus need to be applied one after another. """
+REGEX_SHORTEN_BIG_KING = re.compile(r"(Big|Bacon|Fish|Halloumi)\s*KING", flags=re.IGNORECASE)
+REGEX_SHORTEN_KING_PRODUCTS = re.compile(r"KING\s*(Jr\.?\s*Meal|Jr\.?\s*Menü|Shake|Nuggets?|Wings?)", flags=re.IGNORECASE)
+REGEX_SHORTEN_DRINK_UNIT = re.compile(r"(0[.,]\d{1,2})\s*L", flags=re.IGNORECASE)
+REGEX_SHORTEN_NUGGET_UNIT = re.compile(r"(\d{1,2})er\s*", flags=re.IGNORECASE)
+REGEX_SHORTEN_QUANTITY = re.compile(r"((\d+)[Xx] )([A-Za-z]+)", flags=re.IGNORECASE)
+REGEX_SHORTEN_CHICKEN_NUGGETS = re.compile(r"Chicken\s*(Nuggets)", flags=re.IGNORECASE)
+REGEX_SHORTEN_BURGER = re.compile(r"(b)urger", flags=re.IGNORECASE)
+REGEX_SHORTEN_ODER = re.compile(r"\s*oder\s*", flags=re.IGNORECASE)
+REGEX_SHORTEN_ZUM_PREIS_VON = re.compile(r"\s*zum\s*Preis\s*von\s*(1!?|einem|einer)", flags=re.IGNORECASE)
+REGEX_SHORTEN_MENU_SURCHARGE = re.compile(r"Im King Menü \(\+[^)]+\)", flags=re.IGNORECASE)
+REGEX_SHORTEN_MIT = re.compile(r" mit ", flags=re.IGNORECASE)
+REGEX_SHORTEN_JR = re.compile(r"Jr\s*\.", flags=re.IGNORECASE)
+
+
+def compileReplacementRules(rules: list):
+    """ Merges given list of (pattern, replacement) rules into a single regex so all of them can be applied in one pass.
+     Only use this for rules whose matches never overlap and whose replacements can never be matched by another rule of the same list,
+     otherwise the result will differ from applying them one after another.
+     Returns function which applies all rules to a given string. """
+    regex = re.compile('|'.join(f'(?P<rule{index}>{pattern})' for index, (pattern, replacement) in enumerate(rules)), flags=re.IGNORECASE)
+    replacements = {f'rule{index}': replacement for index, (pattern, replacement) in enumerate(rules)}
+
+    def replace(match) -> str:
+        return replacements[match.lastgroup]
+
+    def applyRules(string: str) -> str:
+        return regex.sub(replace, string)
+
+    return applyRules
+
+
+""" Simple abbreviations """
+SHORTEN_ABBREVIATIONS = compileReplacementRules([
+    # Assume that all users know that "Cheddar" is cheese so let's remove this double entry
+    (r"Cheddar\s*Cheese", "Cheddar"),
+    (r"Chicken", "Ckn"),
+    (r"Chili[\s-]*Cheese", "CC"),
+    # "Deluxe" would become "Dlx" and the "x" would then be part of "X-tra"
+    (r"Deluxe[\s-]*tra", "DlXtra"),
+    (r"Deluxe", "Dlx"),
+    (r"Dips", "Dip"),
+    (r"Double", "Dbl"),
+    (r"Long", "Lng"),
+    (r"Nuggets?", "Nug"),
+    (r"Plant[\s-]*Based", "Plnt"),
+    (r"Tripp?le", "Trple"),
+    (r"Veggie", "Veg"),
+    (r"Whopper", "Wppr"),
+    (r"Steakhouse", "SteakH"),
+    (r"X[\s-]*tra", "Xtra"),
+    (r"Onion[\s-]*Rings", "Rings"),
+])
@@ -0,0 +1,40 @@
+import argparse
+import json
+import time
+from urllib.parse import urlparse
+
+import requests
+
+""" Sends recorded Telegram updates to a locally running bot in webhook mode e.g. for testing or load tests without Telegram.
+ Input file: Either a JSON array of updates or one update per line. """
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('updates', help='Path to file containing recorded updates')
+    parser.add_argument('-u', '--url', help='URL of the local webhook endpoint', default='http://127.0.0.1:8443/')
+    parser.add_argument('-s', '--secret', help='Value of config "webhook_secret_token"', required=True)
+    parser.add_argument('-r', '--repeat', help='Number of times to send all updates', type=int, default=1)
+    args = parser.parse_args()
+    with open(args.updates, encoding='utf-8') as infile:
+        content = infile.read().strip()
+    if content.startswith('['):
+        updates = json.loads(content)
+    else:
+        updates = [json.loads(line) for line in content.splitlines() if len(line.strip()) > 0]
+    session = requests.Session()
+    statusCounts = {}
+    timestampStart = time.time()
+    for _ in range(args.repeat):
+        for update in updates:
+            while True:
+                response = session.post(args.url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': args.secret})
+                statusCounts[response.status_code] = statusCounts.get(response.status_code, 0) + 1
+                if response.status_code != 503:
+                    break
+                # Backpressure -> Retry like Telegram would do
+                time.sleep(float(response.headers.get('Retry-After', '1')))
+    duration = time.time() - timestampStart
+    numberofRequests = sum(statusCounts.values())
+    print(f'Sent {numberofRequests} requests in {duration:0.2f} seconds | Status codes: {statusCounts}')
+    url = urlparse(args.url)
+    print(requests.get(f'{url.scheme}://{url.netloc}/health').text)
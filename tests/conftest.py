@@ -0,0 +1,32 @@
+import os
+import sys
+
+# Modules of this project are plain top-level modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from typing import List
+
+import pytest
+
+from Helper import CouponType
+from UtilsCouponsDB import Coupon
+
+
+def createCoupon(couponID: str, title: str, price=None, couponType: int = CouponType.APP, timestampExpire: float = 2000000000, **kwargs) -> Coupon:
+    return Coupon(id=couponID, uniqueID=couponID, plu=couponID, title=title, price=price, type=couponType, timestampExpire=timestampExpire, **kwargs)
+
+
+@pytest.fixture
+def coupons() -> List[Coupon]:
+    """ Mixed set of coupons covering all classifiers used for stats, duplicate detection and sorting. """
+    return [
+        createCoupon('100', '2 Whopper', price=599, priceCompare=998, timestampExpire=1900000000, tags=['Tag1']),
+        createCoupon('101', 'Long Chicken + Small King Pommes + 0,4 L Coca-Cola', price=699, priceCompare=1099),
+        createCoupon('102', 'Plant-based Whopper + Medium King Pommes + 0,4 L Coca-Cola', price=749, couponType=CouponType.PAPER),
+        createCoupon('103', 'Veggie Burger', price=None, timestampExpire=1800000000),
+        createCoupon('104', '2 Whopper', price=599, priceCompare=998, couponType=CouponType.PAPER, timestampAddedToDB=1700000000),
+        createCoupon('105', '10fach Punkte', couponType=CouponType.PAYBACK, paybackMultiplicator=10),
+        createCoupon('106', 'King Nuggets 6 Stück', price=299, isHidden=True, timestampExpire=2100000000),
+        createCoupon('107', 'KING Jr. Meal', price=399, priceCompare=499, couponType=CouponType.SPECIAL),
+        createCoupon('108', '2 whopper', price=549, priceCompare=998),
+    ]
@@ -0,0 +1,69 @@
+from typing import List
+
+from Helper import CouponType
+from UtilsCouponsDB import Coupon, CouponDuplicateIndex, CouponRecord, getCouponTitleMapping, removeDuplicatedCoupons, sortCouponsByPrice
+from conftest import createCoupon
+
+
+def removeDuplicatedCouponsLegacy(coupons: List[Coupon]) -> dict:
+    """ Duplicate removal as it was done before CouponDuplicateIndex existed. """
+    couponsWithoutDuplicates = {}
+    for normalizedTitle, couponsOfGroup in getCouponTitleMapping(coupons).items():
+        couponsForDuplicateRemoval = []
+        for coupon in couponsOfGroup:
+            if coupon.isEligibleForDuplicateRemoval():
+                couponsForDuplicateRemoval.append(coupon)
+            else:
+                couponsWithoutDuplicates[coupon.id] = coupon
+        if len(couponsForDuplicateRemoval) == 0:
+            continue
+        prices = set(coupon.getPrice() for coupon in couponsForDuplicateRemoval)
+        appCoupons = [coupon for coupon in couponsForDuplicateRemoval if coupon.type == CouponType.APP]
+        if len(prices) > 1:
+            coupon = sortCouponsByPrice(couponsForDuplicateRemoval)[0]
+        elif len(appCoupons) > 0:
+            coupon = appCoupons[-1]
+        else:
+            coupon = couponsForDuplicateRemoval[0]
+        couponsWithoutDuplicates[coupon.id] = coupon
+    return couponsWithoutDuplicates
+
+
+def test_matchesLegacyDuplicateRemoval(coupons):
+    expectedCouponIDs = set(removeDuplicatedCouponsLegacy(coupons).keys())
+    assert set(removeDuplicatedCoupons(coupons).keys()) == expectedCouponIDs
+    records = [CouponRecord.fromCoupon(coupon) for coupon in coupons]
+    assert set(CouponDuplicateIndex(records).removeDuplicates(records).keys()) == expectedCouponIDs
+
+
+def test_keepsCheapestCouponOfGroup(coupons):
+    couponIDs = removeDuplicatedCoupons(coupons).keys()
+    assert '108' in couponIDs
+    assert '100' not in couponIDs
+    assert '104' not in couponIDs
+
+
+def test_prefersAppCouponOnSamePrice():
+    coupons = [createCoupon('1', 'Big King', price=399, couponType=CouponType.PAPER), createCoupon('2', 'Big King', price=399)]
+    assert list(removeDuplicatedCoupons(coupons).keys()) == ['2']
+
+
+def test_subsetsUseIndexOfAllCoupons(coupons):
+    """ Removing duplicates from a subset via the index of all coupons must give the same result as building an index for the subset. """
+    duplicateIndex = CouponDuplicateIndex(coupons)
+    for index in range(len(coupons)):
+        subset = coupons[index:]
+        assert list(duplicateIndex.removeDuplicates(subset).keys()) == list(removeDuplicatedCoupons(subset).keys())
+
+
+def test_preservesOrderAndKeepsNonEligibleCoupons(coupons):
+    couponIDs = list(removeDuplicatedCoupons(coupons).keys())
+    assert couponIDs == [coupon.id for coupon in coupons if coupon.id in couponIDs]
+    assert '105' in couponIDs
+
+
+def test_canonicalCouponID(coupons):
+    duplicateIndex = CouponDuplicateIndex(coupons)
+    assert duplicateIndex.getCanonicalCouponID('100') == '108'
+    assert duplicateIndex.getCanonicalCouponID('108') == '108'
+    assert duplicateIndex.getCanonicalCouponID('unknown') == 'unknown'
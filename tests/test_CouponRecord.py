@@ -0,0 +1,32 @@
+from UtilsCouponsDB import Coupon, CouponRecord
+
+
+def test_fromCouponToCouponRoundTrip(coupons):
+    for coupon in coupons:
+        coupon.updateDerivedFields()
+        restoredCoupon = CouponRecord.fromCoupon(coupon).toCoupon()
+        assert isinstance(restoredCoupon, Coupon)
+        assert restoredCoupon.id == coupon.id
+        for fieldName in Coupon._fields:
+            assert getattr(restoredCoupon, fieldName) == getattr(coupon, fieldName), fieldName
+
+
+def test_recordBehavesLikeCoupon(coupons):
+    for coupon in coupons:
+        record = CouponRecord.fromCoupon(coupon)
+        assert record.getTitle() == coupon.getTitle()
+        assert record.getPrice() == coupon.getPrice()
+        assert record.isVeggie() == coupon.isVeggie()
+        assert record.isContainsFriesAndDrink() == coupon.isContainsFriesAndDrink()
+        assert record.getSortKeys() == coupon.getSortKeys()
+
+
+def test_listsBecomeTuples(coupons):
+    record = CouponRecord.fromCoupon(coupons[0])
+    assert record.tags == ('Tag1',)
+    assert record.toCoupon().tags == ['Tag1']
+
+
+def test_recordCachesStats(coupons):
+    record = CouponRecord.fromCoupon(coupons[0])
+    assert record.getCouponStats() is record.getCouponStats()
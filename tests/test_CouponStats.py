@@ -0,0 +1,76 @@
+from typing import List
+
+from CouponCategory import CouponCategory
+from UtilsCouponsDB import Coupon, CouponRecord, CouponStats
+
+
+def getLegacyCategoryCounters(coupons: List[Coupon]) -> dict:
+    """ Counters as CouponCategory computed them before they were merged from CouponStats. """
+    counters = {'couponTypes': set(), 'numberofCouponsTotal': 0, 'numberofCouponsHidden': 0, 'numberofCouponsEatable': 0, 'numberofCouponsEatableWithPrice': 0,
+                'numberofCouponsWithFriesAndDrink': 0, 'numberofVeggieCoupons': 0, 'totalPrice': 0, 'expireTimestampLowest': None, 'expireTimestampHighest': None}
+    for coupon in coupons:
+        counters['couponTypes'].add(coupon.type)
+        counters['numberofCouponsTotal'] += 1
+        if coupon.isHidden:
+            counters['numberofCouponsHidden'] += 1
+        if coupon.isEatable():
+            counters['numberofCouponsEatable'] += 1
+        if coupon.isContainsFriesAndDrink():
+            counters['numberofCouponsWithFriesAndDrink'] += 1
+        if coupon.isVeggie():
+            counters['numberofVeggieCoupons'] += 1
+        timestampExpire = coupon.timestampExpire
+        if counters['expireTimestampLowest'] is None and counters['expireTimestampHighest'] is None:
+            counters['expireTimestampLowest'] = timestampExpire
+            counters['expireTimestampHighest'] = timestampExpire
+        elif timestampExpire < counters['expireTimestampLowest']:
+            counters['expireTimestampLowest'] = timestampExpire
+        elif timestampExpire > counters['expireTimestampHighest']:
+            counters['expireTimestampHighest'] = timestampExpire
+        if coupon.getPrice() is not None:
+            counters['totalPrice'] += coupon.getPrice()
+            counters['numberofCouponsEatableWithPrice'] += 1
+    return counters
+
+
+def assertCategoryMatchesLegacyCounters(category: CouponCategory, coupons: List[Coupon]):
+    for name, expectedValue in getLegacyCategoryCounters(coupons).items():
+        assert getattr(category, name) == expectedValue, name
+
+
+def test_categoryMatchesLegacyCounters(coupons):
+    assertCategoryMatchesLegacyCounters(CouponCategory(coupons), coupons)
+    records = [CouponRecord.fromCoupon(coupon) for coupon in coupons]
+    assertCategoryMatchesLegacyCounters(CouponCategory(records), coupons)
+
+
+def test_categorySubsetsMatchLegacyCounters(coupons):
+    for index in range(len(coupons)):
+        assertCategoryMatchesLegacyCounters(CouponCategory(coupons[:index + 1]), coupons[:index + 1])
+        assertCategoryMatchesLegacyCounters(CouponCategory(coupons[index:]), coupons[index:])
+
+
+def test_mergeIsIndependentOfOrder(coupons):
+    stats = CouponStats()
+    for coupon in coupons:
+        stats.merge(coupon.getCouponStats())
+    statsReversed = CouponStats()
+    for coupon in reversed(coupons):
+        statsReversed.merge(coupon.getCouponStats())
+    for name in CouponStats.__slots__:
+        assert getattr(stats, name) == getattr(statsReversed, name), name
+
+
+def test_mergeDoesNotModifyOther(coupons):
+    other = coupons[0].getCouponStats()
+    stats = coupons[1].getCouponStats()
+    stats.merge(other)
+    assert other.numberofCouponsTotal == 1
+    assert stats.numberofCouponsTotal == 2
+
+
+def test_emptyCategory():
+    category = CouponCategory([])
+    assert category.numberofCouponsTotal == 0
+    assert category.expireTimestampLowest is None
+    assert category.getExpireDateInfoText() == 'Gültig bis ??'
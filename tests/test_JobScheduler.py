@@ -0,0 +1,141 @@
+import asyncio
+from datetime import datetime
+
+from JobScheduler import Job, JobScheduler, JOB_SCHEDULER_DOC_ID
+
+
+class FakeInfoDB(dict):
+    """ Minimal stand-in for the info DB: Only get and save are used by JobScheduler. """
+
+    def save(self, doc: dict):
+        self[doc['_id']] = doc
+
+
+async def doNothing():
+    return
+
+
+def getTimestamp(day: int, hour: int, minute: int = 0) -> float:
+    return datetime(2026, 10, day, hour, minute).timestamp()
+
+
+def test_dailyJobCatchesUpMissedRunOnStartup():
+    job = Job(name='daily', callback=doNothing, dailyAt=(3, 0))
+    job.lastRunTimestamp = getTimestamp(17, 3)
+    now = getTimestamp(19, 10)
+    job.scheduleNextRun(now, isStartup=True)
+    assert job.nextRunTimestamp == now
+
+
+def test_dailyJobWithoutMissedRun():
+    job = Job(name='daily', callback=doNothing, dailyAt=(3, 0))
+    job.lastRunTimestamp = getTimestamp(19, 3)
+    job.scheduleNextRun(getTimestamp(19, 10), isStartup=True)
+    assert job.nextRunTimestamp == getTimestamp(20, 3)
+
+
+def test_catchUpOnlyOnStartup():
+    job = Job(name='daily', callback=doNothing, dailyAt=(3, 0))
+    job.lastRunTimestamp = getTimestamp(17, 3)
+    job.scheduleNextRun(getTimestamp(19, 10))
+    assert job.nextRunTimestamp == getTimestamp(20, 3)
+
+
+def test_noCatchUpIfDisabled():
+    job = Job(name='interval', callback=doNothing, intervalSeconds=3600, catchUp=False)
+    job.lastRunTimestamp = getTimestamp(19, 1)
+    now = getTimestamp(19, 10)
+    job.scheduleNextRun(now, isStartup=True)
+    assert job.nextRunTimestamp == now + 3600
+
+
+def test_intervalJobCatchesUpMissedRunOnStartup():
+    job = Job(name='interval', callback=doNothing, intervalSeconds=3600)
+    job.lastRunTimestamp = getTimestamp(19, 1)
+    now = getTimestamp(19, 10)
+    job.scheduleNextRun(now, isStartup=True)
+    assert job.nextRunTimestamp == now
+
+
+def test_intervalJobWithoutMissedRun():
+    job = Job(name='interval', callback=doNothing, intervalSeconds=3600)
+    job.lastRunTimestamp = getTimestamp(19, 9, 30)
+    job.scheduleNextRun(getTimestamp(19, 10), isStartup=True)
+    assert job.nextRunTimestamp == getTimestamp(19, 10, 30)
+
+
+def test_eventJobIsNotScheduled():
+    job = Job(name='event', callback=doNothing, triggers=['event'])
+    job.scheduleNextRun(getTimestamp(19, 10), isStartup=True)
+    assert job.nextRunTimestamp is None
+
+
+def test_triggerSchedulesIdleJob():
+    scheduler = JobScheduler(FakeInfoDB())
+    job = Job(name='event', callback=doNothing, triggers=['event'])
+    otherJob = Job(name='other', callback=doNothing, triggers=['otherEvent'])
+    scheduler.addJob(job)
+    scheduler.addJob(otherJob)
+    scheduler.trigger('event')
+    assert job.nextRunTimestamp is not None
+    assert not job.runAgain
+    assert otherJob.nextRunTimestamp is None
+
+
+def test_triggerWhileRunningRunsJobAgain():
+    infoDB = FakeInfoDB()
+    scheduler = JobScheduler(infoDB)
+    numberofRuns = 0
+
+    async def callback():
+        nonlocal numberofRuns
+        numberofRuns += 1
+        if numberofRuns == 1:
+            scheduler.trigger('event')
+
+    job = Job(name='event', callback=callback, triggers=['event'])
+    scheduler.addJob(job)
+
+    async def runScheduler():
+        schedulerTask = asyncio.create_task(scheduler.run())
+        scheduler.trigger('event')
+        for _ in range(100):
+            if numberofRuns == 2 and not job.isRunning():
+                break
+            await asyncio.sleep(0.01)
+        await scheduler.stop(timeoutSeconds=1)
+        await asyncio.wait_for(schedulerTask, timeout=1)
+
+    asyncio.run(runScheduler())
+    assert numberofRuns == 2
+    assert not job.runAgain
+    assert job.nextRunTimestamp is None
+    assert infoDB[JOB_SCHEDULER_DOC_ID]['lastRunTimestamps']['event'] is not None
+
+
+def test_interruptedRunIsResumedOnNextStart():
+    infoDB = FakeInfoDB()
+    scheduler = JobScheduler(infoDB)
+    started = asyncio.Event()
+
+    async def callback():
+        started.set()
+        await asyncio.sleep(60)
+
+    scheduler.addJob(Job(name='event', callback=callback, triggers=['event']))
+
+    async def runScheduler():
+        schedulerTask = asyncio.create_task(scheduler.run())
+        scheduler.trigger('event')
+        await asyncio.wait_for(started.wait(), timeout=1)
+        await scheduler.stop(timeoutSeconds=0.01)
+        await asyncio.wait_for(schedulerTask, timeout=1)
+
+    asyncio.run(runScheduler())
+    assert infoDB[JOB_SCHEDULER_DOC_ID]['pendingRuns'] == {'event': True}
+    nextScheduler = JobScheduler(infoDB)
+    nextScheduler.addJob(Job(name='event', callback=doNothing, triggers=['event']))
+    nextScheduler.loadLastRunTimestamps()
+    assert nextScheduler.isResumingInterruptedRun('event')
+    assert nextScheduler.jobs['event'].nextRunTimestamp is not None
+    assert 'pendingRuns' not in infoDB[JOB_SCHEDULER_DOC_ID]
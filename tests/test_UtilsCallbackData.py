@@ -0,0 +1,48 @@
+from urllib.parse import quote
+
+import pytest
+
+from UtilsCallbackData import CallbackActions, CouponCallback, decodeCallbackData, encodeCouponCallback, CALLBACK_DATA_MAX_BYTES
+
+
+@pytest.mark.parametrize('callback', [
+    CouponCallback(action=CallbackActions.DISPLAY_COUPONS, viewCode=0),
+    CouponCallback(action=CallbackActions.DISPLAY_COUPONS, viewCode=3, couponType=0, page=12),
+    CouponCallback(action=CallbackActions.DISPLAY_COUPONS_CHANGE_SORT, viewCode=200, couponType=5, page=300),
+    CouponCallback(action=CallbackActions.DISPLAY_COUPON, viewCode=1, couponType=2, page=4, couponID='12345'),
+    CouponCallback(action=CallbackActions.DISPLAY_COUPON, viewCode=1, couponID='0815'),
+    CouponCallback(action=CallbackActions.DISPLAY_COUPON, viewCode=1, couponID='PAPER_A1'),
+])
+def test_roundTrip(callback: CouponCallback):
+    callbackData = encodeCouponCallback(callback)
+    assert len(callbackData.encode()) <= CALLBACK_DATA_MAX_BYTES
+    assert decodeCallbackData(callbackData) == callback
+
+
+def test_couponCallbackKeepsListState():
+    listCallback = CouponCallback(action=CallbackActions.DISPLAY_COUPONS, viewCode=2, couponType=1, page=3)
+    couponCallback = decodeCallbackData(listCallback.getCouponCallback('987').encode())
+    assert couponCallback.couponID == '987'
+    assert couponCallback.getCouponListCallback() == listCallback
+
+
+def test_tooLongCouponIDIsRejected():
+    with pytest.raises(ValueError):
+        encodeCouponCallback(CouponCallback(action=CallbackActions.DISPLAY_COUPON, viewCode=0, couponID='x' * 64))
+
+
+def test_legacyCouponList():
+    assert decodeCallbackData('?a=dcs&m=0&cs=') == CouponCallback(action=CallbackActions.DISPLAY_COUPONS, viewCode=0)
+    assert decodeCallbackData('?a=dcs&m=4&cs=2&p=3') == CouponCallback(action=CallbackActions.DISPLAY_COUPONS, viewCode=4, couponType=2, page=3)
+    assert decodeCallbackData('?a=dcss&m=1&cs=') == CouponCallback(action=CallbackActions.DISPLAY_COUPONS_CHANGE_SORT, viewCode=1)
+
+
+def test_legacyCoupon():
+    callbackData = '?a=dc&plu=123&cb=' + quote('?a=dcs&m=2&cs=1&p=5', safe='')
+    assert decodeCallbackData(callbackData) == CouponCallback(action=CallbackActions.DISPLAY_COUPON, viewCode=2, couponType=1, page=5, couponID='123')
+
+
+@pytest.mark.parametrize('callbackData', ['?a=foo', '?a=dcs', '?a=dc&plu=1', '#1x', '#1lA'])
+def test_invalidCallbackData(callbackData: str):
+    with pytest.raises(ValueError):
+        decodeCallbackData(callbackData)
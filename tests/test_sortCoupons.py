@@ -0,0 +1,54 @@
+from typing import List
+
+import pytest
+
+from UtilsCouponsDB import Coupon, CouponRecord, CouponSortMode, ALL_SORT_MODES, CouponSortModes, sortCouponsAsList, sortCouponsByDiscount, sortCouponsByNew, \
+    sortCouponsByPrice
+
+NOW = 1700050000
+
+
+def sortByMenuAndPrice(coupons: List[Coupon]) -> List[Coupon]:
+    couponsWithoutFriesAndDrink = [coupon for coupon in coupons if not coupon.isContainsFriesAndDrink()]
+    couponsWithFriesAndDrink = [coupon for coupon in coupons if coupon.isContainsFriesAndDrink()]
+    return sortCouponsByPrice(couponsWithoutFriesAndDrink) + sortCouponsByPrice(couponsWithFriesAndDrink)
+
+
+def sortCouponsAsListLegacy(coupons: List[Coupon], sortMode: CouponSortMode) -> List[Coupon]:
+    """ Sorting as it was done before every sort mode got its composite sort key. """
+    if sortMode == CouponSortModes.TYPE_MENU_PRICE:
+        coupons = sortByMenuAndPrice(coupons)
+        sortedCoupons = []
+        for couponType in sorted(set(coupon.type for coupon in coupons)):
+            sortedCoupons += [coupon for coupon in coupons if coupon.type == couponType]
+        return sortedCoupons
+    elif sortMode == CouponSortModes.MENU_PRICE:
+        return sortByMenuAndPrice(coupons)
+    elif sortMode == CouponSortModes.PRICE:
+        return sortCouponsByPrice(coupons)
+    elif sortMode == CouponSortModes.PRICE_DESCENDING:
+        return sortCouponsByPrice(coupons, descending=True)
+    elif sortMode == CouponSortModes.DISCOUNT:
+        return sortCouponsByDiscount(coupons)
+    elif sortMode == CouponSortModes.DISCOUNT_DESCENDING:
+        return sortCouponsByDiscount(coupons, descending=True)
+    elif sortMode == CouponSortModes.NEW:
+        return sortCouponsByNew(coupons, now=NOW)
+    elif sortMode == CouponSortModes.NEW_DESCENDING:
+        return sortCouponsByNew(coupons, descending=True, now=NOW)
+    raise ValueError(f'Unknown sort mode {sortMode}')
+
+
+@pytest.mark.parametrize('sortMode', ALL_SORT_MODES, ids=lambda sortMode: str(sortMode.getSortCode()))
+def test_matchesLegacySortOrder(coupons, sortMode: CouponSortMode):
+    expectedCouponIDs = [coupon.id for coupon in sortCouponsAsListLegacy(coupons, sortMode)]
+    assert [coupon.id for coupon in sortCouponsAsList(coupons, sortMode, now=NOW)] == expectedCouponIDs
+    records = [CouponRecord.fromCoupon(coupon) for coupon in coupons]
+    assert [coupon.id for coupon in sortCouponsAsList(records, sortMode.getSortCode(), now=NOW)] == expectedCouponIDs
+
+
+def test_priceSortPlacesCouponsWithoutPriceFirst(coupons):
+    sortedCoupons = sortCouponsAsList(coupons, CouponSortModes.PRICE, now=NOW)
+    assert sortedCoupons[0].getPrice() is None
+    prices = [coupon.getPrice() for coupon in sortedCoupons if coupon.getPrice() is not None]
+    assert prices == sorted(prices)